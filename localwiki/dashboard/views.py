@@ -1,4 +1,5 @@
 from datetime import date, datetime, timedelta
+import heapq
 
 from django.core.cache import cache
 from django.contrib.auth.models import User
@@ -16,6 +17,7 @@ from maps.models import MapData
 from redirects.models import Redirect
 from utils.views import JSONView
 
+from versionutils.versioning import archive
 from versionutils.versioning.constants import *
 
 import time
@@ -79,9 +81,11 @@ class DashboardRenderView(JSONView):
         if oldest is None:
             qs = Page.versions.filter(**filters).order_by('history_date')
             qs = qs.filter(history_date__gte=date(2000, 1, 1))
-            if not qs.exists():
+            # The oldest records may have been archived.
+            oldest = qs.with_archive()[:1]
+            if not oldest:
                 return None
-            oldest = qs[0].version_info.date
+            oldest = oldest[0].version_info.date
             cache.set('%s:dashboard_oldest' % prefix, oldest, FOREVER_CACHE_TIME)
         return oldest
 
@@ -167,39 +171,56 @@ def _sum_from_add_del(added_series, deleted_series):
     return l
 
 
+def _time_series(versions, oldest_page):
+    """
+    The number of historical records in ``versions`` per day, including
+    the archived ones (see versionutils.versioning.archive).
+    """
+    series = qsstats.QuerySetStats(versions, 'history_date').time_series(
+        oldest_page)
+    archived = archive.archived_count_by_day(versions)
+    if not archived:
+        return series
+    l = []
+    for (d, num) in series:
+        day = d.date() if isinstance(d, datetime) else d
+        l.append((d, num + archived.get(day, 0)))
+    return l
+
+
 def items_over_time(oldest_page, filters):
     graph = pyflot.Flot()
 
-    pages_added = qsstats.QuerySetStats(
+    pages_added = _time_series(
         Page.versions.filter(version_info__type__in=ADDED_TYPES, **filters),
-        'history_date').time_series(oldest_page)
-    pages_deleted = qsstats.QuerySetStats(
+        oldest_page)
+    pages_deleted = _time_series(
         Page.versions.filter(version_info__type__in=DELETED_TYPES, **filters),
-        'history_date').time_series(oldest_page)
+        oldest_page)
     num_pages_over_time = _sum_from_add_del(pages_added, pages_deleted)
 
-    maps_added = qsstats.QuerySetStats(
+    maps_added = _time_series(
         MapData.versions.filter(version_info__type__in=ADDED_TYPES, **filters),
-        'history_date').time_series(oldest_page)
-    maps_deleted = qsstats.QuerySetStats(
+        oldest_page)
+    maps_deleted = _time_series(
         MapData.versions.filter(version_info__type__in=DELETED_TYPES, **filters),
-        'history_date').time_series(oldest_page)
+        oldest_page)
     num_maps_over_time = _sum_from_add_del(maps_added, maps_deleted)
 
-    files_added = qsstats.QuerySetStats(
+    files_added = _time_series(
         PageFile.versions.filter(version_info__type__in=ADDED_TYPES, **filters),
-        'history_date').time_series(oldest_page)
-    files_deleted = qsstats.QuerySetStats(
+        oldest_page)
+    files_deleted = _time_series(
         PageFile.versions.filter(version_info__type__in=DELETED_TYPES, **filters),
-        'history_date').time_series(oldest_page)
+        oldest_page)
     num_files_over_time = _sum_from_add_del(files_added, files_deleted)
 
-    redir_added = qsstats.QuerySetStats(
+    redir_added = _time_series(
         Redirect.versions.filter(version_info__type__in=ADDED_TYPES, **filters),
-        'history_date').time_series(oldest_page)
-    redir_deleted = qsstats.QuerySetStats(
+        oldest_page)
+    redir_deleted = _time_series(
         Redirect.versions.filter(version_info__type__in=DELETED_TYPES, **filters),
-        'history_date').time_series(oldest_page)
+        oldest_page)
     num_redirects_over_time = _sum_from_add_del(redir_added, redir_deleted)
 
     graph.add_time_series(num_pages_over_time, label=_("pages"))
@@ -214,38 +235,48 @@ def items_over_time(oldest_page, filters):
 def edits_over_time(oldest_page, filters):
     graph = pyflot.Flot()
 
-    qss = qsstats.QuerySetStats(Page.versions.filter(**filters), 'history_date')
-    graph.add_time_series(qss.time_series(oldest_page), label=_("pages"))
-
-    qss = qsstats.QuerySetStats(MapData.versions.filter(**filters), 'history_date')
-    graph.add_time_series(qss.time_series(oldest_page), label=_("maps"))
-
-    qss = qsstats.QuerySetStats(PageFile.versions.filter(**filters), 'history_date')
-    graph.add_time_series(qss.time_series(oldest_page), label=_("files"))
-
-    qss = qsstats.QuerySetStats(Redirect.versions.filter(**filters), 'history_date')
-    graph.add_time_series(qss.time_series(oldest_page), label=_("redirects"))
+    graph.add_time_series(
+        _time_series(Page.versions.filter(**filters), oldest_page),
+        label=_("pages"))
+    graph.add_time_series(
+        _time_series(MapData.versions.filter(**filters), oldest_page),
+        label=_("maps"))
+    graph.add_time_series(
+        _time_series(PageFile.versions.filter(**filters), oldest_page),
+        label=_("files"))
+    graph.add_time_series(
+        _time_series(Redirect.versions.filter(**filters), oldest_page),
+        label=_("redirects"))
 
     return [graph.prepare_series(s) for s in graph._series]
 
 
 def page_content_over_time(oldest_page, filters):
+    # Older versions may store their content as a delta (see
+    # versionutils.versioning.delta), so we skip those and count a page
+    # as the size of its latest full version.
     qs = Page.versions.filter(**filters).extra(
-        {'content_length': "length(content)",
+        {'content_length': "CASE WHEN strpos(content, chr(1) || 'delta:') = 1 "
+                           "THEN NULL ELSE length(content) END",
          'history_day': "date(history_date)"})
     qs = qs.order_by('history_day')
-    qs = qs.values('content_length', 'history_day', 'slug')
+    qs = qs.values_list('history_day', 'content_length', 'slug')
+    # Both are ordered by day, so we can go through them together.
+    versions = heapq.merge(qs.iterator(),
+        archive.archived_values_list(qs, 'history_day', 'content_length',
+                                     'slug'))
 
     graph = pyflot.Flot()
     page_dict = {}
     page_contents = []
     current_day = oldest_page.date()
 
-    for page in qs.iterator():
-        if page['history_day'] > current_day:
+    for history_day, content_length, slug in versions:
+        if history_day > current_day:
             page_contents.append((current_day, sum(page_dict.values())))
-            current_day = page['history_day']
-        page_dict[page['slug']] = page['content_length']
+            current_day = history_day
+        if content_length is not None:
+            page_dict[slug] = content_length
 
     if page_contents:
         graph.add_time_series(page_contents)
@@ -17,13 +17,20 @@ from maps.widgets import InfoMap, map_options_for_region
 from regions.views import RegionMixin, RegionAdminRequired, TemplateView, region_404_response
 from regions.models import Region
 from localwiki.utils.views import Custom404Mixin, CacheMixin
+from localwiki.utils.cache import (frontpage_key, page_key, map_key,
+    get_region_generation)
 
 from .models import FrontPage
 
 
 class FrontPageView(CacheMixin, Custom404Mixin, TemplateView):
     template_name = 'frontpage/base.html'
-    cache_timeout = 60 * 60  # 1 hr, and we invalidate after Front Page save
+    cache_timeout = 60 * 60 * 2
+    # Regenerated after 1 hr, and we invalidate after Front Page save.  In
+    # the meantime, the stale front page is served.
+    cache_soft_timeout = 60 * 60
+    cache_serve_stale = True
+    cache_warm = True
 
     def get(self, *args, **kwargs):
         # If there's no FrontPage defined, let's send the "Front Page" Page object.
@@ -102,8 +109,14 @@ class FrontPageView(CacheMixin, Custom404Mixin, TemplateView):
         from django.core.urlresolvers import get_urlconf
         urlconf = get_urlconf() or settings.ROOT_URLCONF
         region = CacheMixin.get_region_slug_param(*args, **kwargs)
+        generation = get_region_generation(region, kwargs.get('request'))
 
-        return '%s/%s/' % (urlconf, region)
+        return '%s/%s/%s/' % (urlconf, region, generation)
+
+    def get_cache_dependencies(self):
+        region = self.get_region()
+        return [frontpage_key(region.id), page_key(region.id, 'front page'),
+                map_key(region.id)]
 
 
 class CoverUploadView(RegionMixin, RegionAdminRequired, View):
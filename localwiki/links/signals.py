@@ -1,5 +1,7 @@
 from django.db.models.signals import post_save, pre_delete, post_delete
 
+from versionutils.versioning import bulk_saved
+
 from pages.models import Page, slugify
 from tags.models import Tag
 
@@ -158,6 +160,17 @@ def _record_tag_includes(sender, instance, created, raw, **kws):
         return
     record_tag_includes(instance)
 
+def _pages_bulk_saved(sender, instances, created, **kws):
+    # Pages saved with versionutils' bulk_save(), in place of the
+    # post_save handlers above.
+    for page in instances:
+        is_new = page.pk in created
+        _record_page_links(sender, page, is_new, False)
+        _check_destination_created(sender, page, is_new, False)
+        _record_page_includes(sender, page, is_new, False)
+        _check_included_page_created(sender, page, is_new, False)
+        _record_tag_includes(sender, page, is_new, False)
+
 #########################
 # Attach all the signals
 #########################
@@ -173,3 +186,6 @@ post_save.connect(_check_included_page_created, sender=Page)
 
 # Included tag list signals
 post_save.connect(_record_tag_includes, sender=Page)
+
+# Bulk saves
+bulk_saved.connect(_pages_bulk_saved, sender=Page)
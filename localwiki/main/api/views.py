@@ -31,3 +31,17 @@ class AllowFieldLimitingMixin(object):
             return self.get_serializer_class_for_fields(serializer_class, fields)
         return serializer_class
 
+
+
+class ArchivedHistoryMixin(object):
+    """
+    A mixin for a generic APIView listing historical records.  Listings
+    follow the history through into the archive (see
+    versionutils.versioning.archive), which is only read when a page of
+    results reaches back that far.
+    """
+    def paginate_queryset(self, queryset, *args, **kwargs):
+        if hasattr(queryset, 'with_archive'):
+            queryset = queryset.with_archive()
+        return super(ArchivedHistoryMixin, self).paginate_queryset(
+            queryset, *args, **kwargs)
@@ -161,6 +161,21 @@ SHOW_IP_ADDRESSES = True
 LOGIN_REDIRECT_URL = '/'
 
 THUMBNAIL_BACKEND = 'utils.sorl_backends.AutoFormatBackend'
+# Generated alongside each thumbnail, for the srcset of resized images.
+THUMBNAIL_ALTERNATIVE_RESOLUTIONS = [1.5, 2]
+# Generate thumbnails in the background rather than when rendering a page.
+THUMBNAIL_GENERATE_ASYNC = True
+
+# Re-render invalidated pages, tag lists and front pages in the background
+# (see utils.warming), most visited first.
+CACHE_WARM_ENABLED = True
+# At most this many responses are re-rendered per invalidation.
+CACHE_WARM_MAX = 100
+# Renders per second, per invalidation.
+CACHE_WARM_RATE = 4
+
+# Number of regions each process keeps resolved (see regions.resolver).
+REGION_RESOLVER_CACHE_SIZE = 1000
 
 OL_API = STATIC_URL + 'openlayers/OpenLayers.js?tm=1348975452'
 OLWIDGET_CSS = '%solwidget/css/sapling.css?tm=1317359250' % STATIC_URL
@@ -195,8 +210,10 @@ MIDDLEWARE_CLASSES = (
     'johnny.middleware.LocalStoreClearMiddleware',
     'johnny.middleware.QueryCacheMiddleware',
     'django_hosts.middleware.HostsMiddlewareRequest',
+    'regions.middleware.HostRoutingMiddleware',
     'django.middleware.common.CommonMiddleware',
     'x_forwarded_for.middleware.XForwardedForMiddleware',
+    'utils.middleware.OnCommitMiddleware',
     'django.middleware.transaction.TransactionMiddleware',
     'utils.middleware.SessionMiddleware',
     'django_xsession.middleware.XSessionMiddleware',
@@ -437,6 +454,11 @@ IN_API_TEST = False
 # list of regular expressions for white listing embedded URLs
 EMBED_ALLOWED_SRC = ['.*']
 
+# Render included pages and tag lists as edge-side includes, for Varnish
+# to cache separately (see config/varnish/default.vcl).  Clear the page
+# caches after changing this.
+PAGE_ESI_INCLUDES = False
+
 HAYSTACK_SIGNAL_PROCESSOR = 'celery_haystack.signals.CelerySignalProcessor'
 
 CACHE_BACKEND = 'dummy:///'
@@ -4,7 +4,7 @@ from rest_framework_gis.filters import GeoFilterSet
 
 from main.api import router
 from main.api.filters import HistoricalFilter
-from main.api.views import AllowFieldLimitingMixin
+from main.api.views import AllowFieldLimitingMixin, ArchivedHistoryMixin
 from regions.api import RegionFilter
 from pages.api import PageFilter, PagePermissionsMixin
 
@@ -62,7 +62,7 @@ class MapDataViewSet(PagePermissionsMixin, AllowFieldLimitingMixin, viewsets.Mod
     ordering_fields = ('length',)
 
 
-class HistoricalMapDataViewSet(AllowFieldLimitingMixin, viewsets.ReadOnlyModelViewSet):
+class HistoricalMapDataViewSet(ArchivedHistoryMixin, AllowFieldLimitingMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint that allows map history to be viewed.
 
@@ -3,11 +3,12 @@ from django.core.urlresolvers import reverse
 
 from regions.models import Region
 from versionutils import versioning
+from versionutils.versioning.models import LastEditFields
 
 from .fields import FlatCollectionFrom
 
 
-class MapData(models.Model):
+class MapData(LastEditFields):
     points = models.MultiPointField(null=True, blank=True)
     lines = models.MultiLineStringField(null=True, blank=True)
     polys = models.MultiPolygonField(null=True, blank=True)
@@ -24,9 +25,16 @@ class MapData(models.Model):
             args=[self.region.slug, self.page.pretty_slug])
 
     def save(self, *args, **kwargs):
-        self.length = self.geom.length
+        self.prepare_save()
         super(MapData, self).save(*args, **kwargs)
 
+    def prepare_save(self):
+        """
+        Sets the fields derived from the others.  Called by save(), and by
+        versioning.bulk_save() in its place.
+        """
+        self.length = self.geom.length
+
     def exists(self):
         """
         Returns:
@@ -30,6 +30,7 @@ from regions.views import RegionMixin, region_404_response
 from regions.models import Region
 from users.views import AddContributorsMixin
 from localwiki.utils.views import CacheMixin
+from localwiki.utils.cache import map_key, get_region_generation
 
 from .widgets import InfoMap, map_options_for_region
 from .models import MapData
@@ -66,7 +67,7 @@ class MapDetailView(Custom404Mixin, AddContributorsMixin, RegionMixin, DetailVie
         return mapdata
 
     def get_object_date(self):
-        return self.object.versions.most_recent().version_info.date
+        return self.object.last_edit_date
 
     def get_context_data(self, **kwargs):
         context = super(MapDetailView, self).get_context_data(**kwargs)
@@ -172,8 +173,12 @@ class MapFullRegionView(CacheMixin, BaseMapRegionView):
 
         urlconf = get_urlconf() or settings.ROOT_URLCONF
         region = CacheMixin.get_region_slug_param(*args, **kwargs)
+        generation = get_region_generation(region, kwargs.get('request'))
         # Control characters and whitespace not allowed in memcached keys
-        return 'map:%s/%s/main_map' % (urlconf, name_to_url(region))
+        return 'map:%s/%s/%s/main_map' % (urlconf, name_to_url(region), generation)
+
+    def get_cache_dependencies(self):
+        return [map_key(self.get_region().id)]
 
     def get_context_data(self, *args, **kwargs):
         context = super(MapFullRegionView, self).get_context_data(*args, **kwargs)
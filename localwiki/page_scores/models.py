@@ -1,7 +1,4 @@
 from celery import shared_task
-from lxml.html import fragments_fromstring
-import urllib
-import urlparse
 
 from django.utils.translation import ugettext as _
 from django.utils.encoding import smart_str
@@ -29,13 +26,6 @@ class PageScore(models.Model):
         return (_("Page score %s: %s") % (self.page, self.score))
 
 
-def is_internal(url):
-    return (not urlparse.urlparse(url).netloc)
-
-def is_plugin(elem):
-    classes = elem.attrib.get('class', '')
-    return ('plugin' in classes.split())
-
 def avg_incoming_links_for_region(region):    
     avg = cache.get('avg_incoming_links:%s' % region.slug)
     if avg is not None:
@@ -75,7 +65,7 @@ def avg_page_length(region):
 
 def _compute_score(page):
     from maps.models import MapData
-    from pages.plugins import _files_url
+    from pages.analysis import analyze_page
 
     score = 0
     num_images = 0
@@ -91,21 +81,15 @@ def _compute_score(page):
     if MapData.objects.filter(page=page).exists():
         score += 1
 
-    # Parse the page HTML and look for good stuff
-    for e in fragments_fromstring(page.content):
-        if isinstance(e, basestring):
-            continue
-        for i in e.iter('img'):
-            src = i.attrib.get('src', '')
-            if src.startswith(_files_url):
-                num_images += 1
-        for i in e.iter('a'):
-            src = i.attrib.get('href', '')
-            if is_internal(src) and not is_plugin(i):
-                slug = slugify(unicode(urllib.unquote(src), 'utf-8', errors='ignore'))
-                # Only count links to pages that exist
-                if Page.objects.filter(slug=slug, region=page.region).exists():
-                    link_num += 1
+    analysis = analyze_page(page)
+    num_images = len(analysis.local_images)
+
+    # Only count links to pages that exist
+    existing = set(Page.objects.filter(slug__in=analysis.links.keys(),
+        region=page.region).values_list('slug', flat=True))
+    for slug, (name, count) in analysis.links.iteritems():
+        if slug in existing:
+            link_num += count
 
     # One point for each image, up to three points
     score += min(num_images, 3)
@@ -0,0 +1,197 @@
+"""
+Single-pass analysis of page content.
+
+Several things want to know what's in a page's content: the internal
+links (links app), included pages and tag lists (links app), images
+(page scores, cards) and so on.  Rather than have each of them parse the
+HTML, `analyze_content` walks the parsed tree once and records all of it
+in a `PageAnalysis`.  Results are memoized by content hash, so the
+consumers that run after a page is saved share a single parse.
+"""
+import hashlib
+import urlparse
+from collections import namedtuple
+
+import html5lib
+
+from django.conf import settings
+
+from ckeditor.models import parse_style
+from localwiki.utils import LRUCache
+
+from .models import slugify, url_to_name
+
+TAGS_PATH_LEN = len('tags/')
+
+_analyses = LRUCache(max_size=getattr(settings, 'PAGE_ANALYSIS_CACHE_SIZE', 100))
+
+
+# A reference to an image in the page content.  `name` is the name of the
+# attached file for local (_files/) images, None otherwise.  `width` and
+# `height` are the styled dimensions, if any.
+ImageReference = namedtuple('ImageReference', ['src', 'name', 'width', 'height'])
+
+
+def _is_absolute(href):
+    return bool(urlparse.urlparse(href).scheme)
+
+
+def _is_anchor_link(href):
+    return href.startswith('#')
+
+
+def _has_classes(elem, *classes):
+    elem_classes = elem.attrib.get('class', '').split()
+    return all(c in elem_classes for c in classes)
+
+
+def _is_plugin(a):
+    if 'class' in a.attrib:
+        return 'plugin' in a.attrib['class']
+    return False
+
+
+def _invalid(href):
+    return len(href) > 255
+
+
+def _style_px(style, name):
+    try:
+        return int(style[name].replace('px', ''))
+    except (KeyError, ValueError):
+        return None
+
+
+class PageAnalysis(object):
+    """
+    What's in a page's content.
+
+    Attributes:
+        links: Dictionary of linked-to page slug -> (page name, number of
+            times it's linked to).
+        included_pages: List of the included page names.
+        included_tags: List of the included tag slugs.
+        images: List of `ImageReference`s, in document order.
+        linked_files: List of the names of the attached files linked to.
+        text_length: The length of the text content.
+        external_link_count: The number of links to other sites.
+    """
+    def __init__(self):
+        self.links = {}
+        self.included_pages = []
+        self.included_tags = []
+        self.images = []
+        self.linked_files = []
+        self.text_length = 0
+        self.external_link_count = 0
+
+    @property
+    def internal_links(self):
+        """
+        A dictionary of the linked-to page names and the number of times that
+        link has been made.  E.g. {'Downtown Park': 3, 'Rollercoaster': 1}
+        """
+        return dict(self.links.itervalues())
+
+    @property
+    def local_images(self):
+        """
+        The file names of the local images, in document order.
+        """
+        return [i.name for i in self.images if i.name is not None]
+
+    @property
+    def first_local_image(self):
+        local_images = self.local_images
+        return local_images[0] if local_images else None
+
+    def _add_link(self, a):
+        from .plugins import _files_url, file_url_to_name
+
+        if 'href' not in a.attrib:
+            return
+        href = a.attrib['href']
+        if _is_plugin(a):
+            return
+        if _is_absolute(href):
+            self.external_link_count += 1
+            return
+        if _is_anchor_link(href) or _invalid(href):
+            return
+        if href.startswith(_files_url):
+            self.linked_files.append(file_url_to_name(href).decode('utf-8'))
+        try:
+            slug = slugify(href)
+            if not slug in self.links:
+                self.links[slug] = (url_to_name(href), 1)
+            else:
+                name, count = self.links[slug]
+                self.links[slug] = (name, count + 1)
+        except UnicodeDecodeError:
+            pass
+
+    def _add_plugin(self, a):
+        if _has_classes(a, 'plugin', 'includepage'):
+            self.included_pages.append(url_to_name(a.attrib.get('href')))
+        elif _has_classes(a, 'plugin', 'includetag'):
+            from tags.models import slugify as tag_slugify
+            try:
+                item = tag_slugify(
+                    url_to_name(a.attrib.get('href'))[TAGS_PATH_LEN:].lower())
+            except UnicodeDecodeError:
+                return
+            self.included_tags.append(item)
+
+    def _add_image(self, img):
+        from .plugins import _files_url, file_url_to_name
+
+        src = img.attrib.get('src', '')
+        name = None
+        if src.startswith(_files_url):
+            name = file_url_to_name(src).decode('utf-8')
+        style = parse_style(img.attrib.get('style', ''))
+        self.images.append(ImageReference(src, name,
+            _style_px(style, 'width'), _style_px(style, 'height')))
+
+
+def _parse(html):
+    parser = html5lib.HTMLParser(
+        tree=html5lib.treebuilders.getTreeBuilder("lxml"),
+        namespaceHTMLElements=False)
+    # Wrap to make the tree lookup easier
+    return parser.parseFragment('<div>%s</div>' % html)[0]
+
+
+def analyze_content(html):
+    """
+    Args:
+        html: A string containing an HTML5 fragment.
+
+    Returns:
+        A `PageAnalysis` of `html`.  The result is shared, so it must be
+        treated as read-only.
+    """
+    if isinstance(html, unicode):
+        key = hashlib.sha1(html.encode('utf-8')).hexdigest()
+    else:
+        key = hashlib.sha1(html).hexdigest()
+    analysis = _analyses.get(key)
+    if analysis is not None:
+        return analysis
+
+    analysis = PageAnalysis()
+    tree = _parse(html)
+    for elem in tree.iter('a', 'img'):
+        if elem.tag == 'img':
+            analysis._add_image(elem)
+            continue
+        analysis._add_link(elem)
+        analysis._add_plugin(elem)
+    analysis.text_length = len(''.join(tree.itertext()))
+
+    _analyses.set(key, analysis)
+    return analysis
+
+
+def analyze_page(page):
+    return analyze_content(page.content)
@@ -7,7 +7,7 @@ from rest_framework_gis.filters import GeoFilterSet
 
 from main.api import router
 from main.api.filters import HistoricalFilter
-from main.api.views import AllowFieldLimitingMixin
+from main.api.views import AllowFieldLimitingMixin, ArchivedHistoryMixin
 from tags.models import Tag, PageTagSet, slugify as tag_slugify
 from versionutils.versioning.constants import TYPE_CHOICES
 from regions.api import RegionFilter
@@ -165,7 +165,7 @@ class PageViewSet(AllowFieldLimitingMixin, viewsets.ModelViewSet):
             pts.tags = tags
 
 
-class HistoricalPageViewSet(AllowFieldLimitingMixin, viewsets.ReadOnlyModelViewSet):
+class HistoricalPageViewSet(ArchivedHistoryMixin, AllowFieldLimitingMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint for viewing page history.
 
@@ -249,7 +249,7 @@ class FileViewSet(PagePermissionsMixin, AllowFieldLimitingMixin, viewsets.ModelV
             return pgs[0]
 
 
-class HistoricalFileViewSet(AllowFieldLimitingMixin, viewsets.ReadOnlyModelViewSet):
+class HistoricalFileViewSet(ArchivedHistoryMixin, AllowFieldLimitingMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint for viewing file history.
 
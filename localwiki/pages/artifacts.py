@@ -0,0 +1,238 @@
+"""
+Pre-rendered page content.
+
+Rendering a page's content (links, included pages and tag lists,
+thumbnails, embeds) is the most expensive part of a page view.  Instead of
+doing it on every cache miss, we render it once, after the page is saved,
+and store the result as a `PageArtifact`.
+
+An artifact is only served if it was rendered from the page's current
+content (see `artifact_content_hash`).  Besides the page content, the
+rendered HTML depends on other pages (whether linked-to pages exist, the
+content of included pages), tags (included tag lists) and the page's
+files.  These are recorded on the artifact when rendering so that, when
+one of them changes, we only re-render the artifacts that depend on it.
+"""
+import hashlib
+import operator
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.contrib.auth.models import AnonymousUser
+from django.core.urlresolvers import set_urlconf, get_urlconf
+from django.http import HttpRequest
+from django.template import Template, Context
+
+from celery import shared_task
+
+from localwiki.utils.cache import get_dependencies, split_key
+
+from .models import Page, PageArtifact
+from .analysis import analyze_page
+
+# Bump this when the rendered output changes for the same page content,
+# e.g. when changing the plugins, to have all artifacts re-rendered.
+ARTIFACT_VERSION = 1
+
+# A page's artifacts are queued for rendering at most once in this many
+# seconds, however many stale reads there are.
+RENDER_QUEUED_TIMEOUT = 60
+
+
+def artifacts_enabled():
+    return getattr(settings, 'PAGE_ARTIFACTS_ENABLED', True)
+
+
+def artifact_content_hash(page):
+    h = hashlib.sha1()
+    # File links are rendered using the page's URL, so renaming or moving
+    # the page also makes the artifact stale.
+    h.update('%d|%s|%s|' % (ARTIFACT_VERSION, page.region_id, page.slug.encode('utf-8')))
+    h.update(page.content.encode('utf-8'))
+    return h.hexdigest()
+
+
+def artifact_urlconfs(page):
+    """
+    Returns:
+        The urlconfs the page is served under.
+    """
+    if page.region.regionsettings.domain:
+        return ['main.urls', 'main.urls_no_region']
+    return ['main.urls']
+
+
+def _referenced_files(page):
+    analysis = analyze_page(page)
+    return set(analysis.local_images + analysis.linked_files)
+
+
+def render_page_content(page, urlconf):
+    """
+    Renders the page content as the page detail view would.
+
+    Returns:
+        A tuple (html, request).  The dependency keys of the rendered
+        content are recorded on the request (see `utils.cache`).
+    """
+    current_urlconf = get_urlconf() or settings.ROOT_URLCONF
+    set_urlconf(urlconf)
+    try:
+        request = HttpRequest()
+        request.user = AnonymousUser()
+        request.path = page.get_absolute_url()
+        if urlconf == 'main.urls_no_region':
+            request.META['HTTP_HOST'] = page.region.regionsettings.domain
+        else:
+            request.META['HTTP_HOST'] = settings.MAIN_HOSTNAME
+
+        template = Template('{% load pages_tags %}{% render_plugins page.content %}')
+        context = Context({'page': page, 'region': page.region, 'request': request})
+        html = template.render(context)
+    finally:
+        set_urlconf(current_urlconf)
+    return (html, request)
+
+
+def render_artifact(page, urlconf):
+    html, request = render_page_content(page, urlconf)
+
+    try:
+        artifact = PageArtifact.objects.get(page=page, urlconf=urlconf)
+    except PageArtifact.DoesNotExist:
+        artifact = PageArtifact(page=page, urlconf=urlconf)
+    keys = set(get_dependencies(request))
+    included_pages = set()
+    tags = set()
+    for kind, args in [split_key(k) for k in keys]:
+        if kind == 'page':
+            included_pages.add((int(args[0]), args[1]))
+        elif kind == 'tag':
+            tags.add(args[1])
+
+    artifact.content_hash = artifact_content_hash(page)
+    artifact.html = html
+    artifact.cache_keys = '\n'.join(sorted(keys))
+    artifact.depends_on_tags = '\n'.join(sorted(tags))
+    artifact.depends_on_files = '\n'.join(sorted(_referenced_files(page)))
+    artifact.save()
+
+    included_pages.discard((page.region_id, page.slug))
+    if included_pages:
+        q = reduce(operator.or_, [Q(region__id=region_id, slug=slug)
+                                  for region_id, slug in included_pages])
+        artifact.depends_on_pages = Page.objects.filter(q)
+    else:
+        artifact.depends_on_pages = []
+    return artifact
+
+
+def render_page_artifacts(page):
+    for urlconf in artifact_urlconfs(page):
+        render_artifact(page, urlconf)
+
+
+def get_page_artifact(page, urlconf=None):
+    """
+    Returns:
+        The `PageArtifact` for the page, or None if there's no up-to-date
+        artifact.  In that case, one is queued to be rendered.
+    """
+    if not artifacts_enabled():
+        return None
+    urlconf = urlconf or get_urlconf() or settings.ROOT_URLCONF
+    try:
+        artifact = PageArtifact.objects.get(page=page, urlconf=urlconf)
+    except PageArtifact.DoesNotExist:
+        artifact = None
+    if artifact is None or artifact.content_hash != artifact_content_hash(page):
+        queue_render_page_artifacts(page)
+        return None
+    return artifact
+
+
+def _render_queued_key(page_id):
+    return 'artifact_render_queued:%s' % page_id
+
+
+def queue_render_page_artifacts(page):
+    if cache.add(_render_queued_key(page.id), True, RENDER_QUEUED_TIMEOUT):
+        _async_render_page_artifacts.delay(page.id)
+
+
+def mark_stale_after_file_edit(region_id, slug, name):
+    """
+    Marks the artifacts of the page that were rendered with the file
+    `name` as stale, so they're not served until they're re-rendered.
+
+    Returns:
+        True if there were any.
+    """
+    artifacts = PageArtifact.objects.filter(page__region__id=region_id,
+        page__slug=slug, depends_on_files__contains=name)
+    stale = [a.id for a in artifacts.only('id', 'depends_on_files')
+             if name in a.depends_on_files.split('\n')]
+    if stale:
+        PageArtifact.objects.filter(id__in=stale).update(content_hash='')
+    return bool(stale)
+
+
+def render_dependent_artifacts(pages):
+    """
+    Re-renders the artifacts of the given pages, and of the pages whose
+    artifacts depend on them (e.g. pages including a page that includes
+    one of these pages).
+    """
+    pages = set(pages)
+    if not pages:
+        return
+    pages.update(Page.objects.filter(
+        artifacts__depends_on_pages__in=pages).distinct())
+    for p in pages:
+        render_page_artifacts(p)
+
+
+def render_artifacts_after_page_edit(page, created=False, deleted=False):
+    from links.models import Link, IncludedPage
+
+    if not artifacts_enabled():
+        return
+    if not deleted:
+        render_page_artifacts(page)
+
+    # Pages whose rendered content includes this page.
+    dependents = set(Page.objects.filter(
+        artifacts__depends_on_pages=page).distinct())
+    if created or deleted:
+        # Pages that link to, or include, this page render differently
+        # depending on whether or not it exists.
+        links = Link.objects.filter(destination_slug=page.slug,
+            region=page.region).select_related('source')
+        dependents.update([l.source for l in links])
+        includes = IncludedPage.objects.filter(included_page_slug=page.slug,
+            region=page.region).select_related('source')
+        dependents.update([i.source for i in includes])
+    dependents.discard(page)
+    render_dependent_artifacts(dependents)
+
+
+def render_artifacts_after_tag_edit(slugs):
+    from links.models import IncludedTagList
+
+    if not artifacts_enabled():
+        return
+    tag_lists = IncludedTagList.objects.filter(
+        included_tag__slug__in=slugs).select_related('source')
+    render_dependent_artifacts([tl.source for tl in tag_lists])
+
+
+@shared_task(ignore_result=True)
+def _async_render_page_artifacts(page_id):
+    try:
+        page = Page.objects.get(id=page_id)
+        render_page_artifacts(page)
+    except Page.DoesNotExist:
+        pass
+    finally:
+        cache.delete(_render_queued_key(page_id))
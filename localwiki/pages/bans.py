@@ -0,0 +1,208 @@
+"""
+Varnish ban dispatcher.
+
+Cached responses carry the dependency keys (see `utils.cache`) they were
+built from in an xkey header, and are banned by key.  URLs can be banned,
+too.
+
+Invalidating after one edit can mean banning dozens of keys or URLs.
+Issuing a ban, over a new management connection, for each of them
+saturates the Varnish CLI after bulk edits.  Instead, inside
+`batched_bans()` we queue the keys, and URLs per host, and when the batch
+is flushed we merge them into a few ban expressions that match any of
+them.  Management connections to the servers in VARNISH_MANAGEMENT_SERVERS
+are kept open between bans.
+"""
+import re
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+
+from varnish import VarnishHandler
+
+KEY_BAN_EXPRESSION = r'obj.http.xkey ~ (^|\\s)%(keys)s(\\s|$)'
+BAN_EXPRESSION = r'obj.http.x-url ~ ^(?i)(%(urls)s(/*)(\\?.*)?)$ && obj.http.x-host ~ ^((?i)(.*\\.)?%(host)s(:[0-9]*)?)$'
+
+# Regex special characters that can appear in a quoted URL.  The backslash
+# is doubled for the Varnish CLI.
+_REGEX_SPECIAL = re.compile(r'([.^$*+?()\[\]{}|])')
+
+
+def _escape(s):
+    return _REGEX_SPECIAL.sub(r'\\\\\1', s)
+
+
+def _alternation(items):
+    items = sorted(set(items))
+    if len(items) == 1:
+        return _escape(items[0])
+    return '(%s)' % '|'.join([_escape(i) for i in items])
+
+
+def ban_expression(urls, host):
+    """
+    Returns:
+        A ban expression matching any of the (quoted) `urls` on `host`.
+    """
+    return BAN_EXPRESSION % {'urls': _alternation(urls), 'host': host}
+
+
+def key_ban_expression(keys):
+    """
+    Returns:
+        A ban expression matching the objects tagged with any of the
+        dependency keys.
+    """
+    return KEY_BAN_EXPRESSION % {'keys': _alternation(keys)}
+
+
+class BanDispatcher(object):
+    """
+    Issues bans to all the Varnish servers, over persistent management
+    connections.
+
+    Attributes:
+        bans_issued: The number of ban expressions issued (per server).
+        urls_covered: The number of URLs and keys those bans covered.
+    """
+    def __init__(self, max_urls=None, flush_interval=None):
+        self.max_urls = max_urls or getattr(settings, 'VARNISH_BAN_MAX_URLS', 50)
+        self.flush_interval = flush_interval or getattr(
+            settings, 'VARNISH_BAN_FLUSH_INTERVAL', 2)
+        self.bans_issued = 0
+        self.urls_covered = 0
+        self._connections = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def stats(self):
+        return {'bans_issued': self.bans_issued, 'urls_covered': self.urls_covered}
+
+    def _connection(self, server):
+        if server not in self._connections:
+            self._connections[server] = VarnishHandler(server,
+                secret=settings.VARNISH_SECRET)
+        return self._connections[server]
+
+    def _send(self, expression):
+        for server in settings.VARNISH_MANAGEMENT_SERVERS:
+            try:
+                self._connection(server).ban(expression)
+            except (socket.error, EOFError):
+                # Connection went away, e.g. Varnish was restarted.  Try
+                # again once over a new connection.
+                self._close(server)
+                self._connection(server).ban(expression)
+
+    def _close(self, server):
+        connection = self._connections.pop(server, None)
+        if connection is not None:
+            try:
+                connection.close()
+            except (socket.error, EOFError):
+                pass
+
+    def issue(self, items, host):
+        """
+        Bans the given (quoted) URLs on `host`, or the given keys if `host`
+        is None, right away.
+        """
+        items = sorted(set(items))
+        with self._lock:
+            for i in range(0, len(items), self.max_urls):
+                chunk = items[i:i + self.max_urls]
+                if host is None:
+                    expression = key_ban_expression(chunk)
+                else:
+                    expression = ban_expression(chunk, host)
+                self._send(expression.encode('utf-8'))
+                self.bans_issued += 1
+                self.urls_covered += len(chunk)
+
+    def _batch(self):
+        return getattr(self._local, 'batch', None)
+
+    def _queue(self, items, host):
+        batch = self._batch()
+        if batch is None:
+            self.issue(items, host)
+            return
+        if not batch['urls']:
+            batch['started'] = time.time()
+        queued = batch['urls'].setdefault(host, set())
+        queued.update(items)
+        if (len(queued) >= self.max_urls or
+                time.time() - batch['started'] >= self.flush_interval):
+            self.flush()
+
+    def ban(self, url, host):
+        """
+        Bans the (quoted) URL on `host`, or queues it if we're batching.
+        """
+        self._queue([url], host)
+
+    def ban_keys(self, keys):
+        """
+        Bans the objects tagged with any of the dependency keys, or queues
+        them if we're batching.
+        """
+        self._queue(keys, None)
+
+    def flush(self):
+        """
+        Issues the queued bans.
+        """
+        batch = self._batch()
+        if not batch or not batch['urls']:
+            return
+        pending, batch['urls'] = batch['urls'], {}
+        for host, urls in pending.iteritems():
+            self.issue(urls, host)
+
+    @contextmanager
+    def batched(self):
+        batch = self._batch()
+        if batch is not None:
+            # Already batching, the outermost block flushes.
+            yield
+            return
+        self._local.batch = {'urls': {}, 'started': None}
+        try:
+            yield
+        finally:
+            try:
+                self.flush()
+            finally:
+                self._local.batch = None
+
+    def close(self):
+        with self._lock:
+            for server in self._connections.keys():
+                self._close(server)
+
+
+dispatcher = BanDispatcher()
+
+
+def batched_bans():
+    """
+    Queues the bans issued inside the `with` block and issues them,
+    merged, at the end of it.
+    """
+    return dispatcher.batched()
+
+
+def batch_bans(func):
+    """
+    Decorator that batches the bans issued by the function.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with batched_bans():
+            return func(*args, **kwargs)
+    return wrapper
@@ -3,47 +3,49 @@ import urllib
 from django.conf import settings
 from django.core.urlresolvers import set_urlconf, get_urlconf
 from django.core.cache import cache
+from django.db.models import get_model
 
 from celery import shared_task
-from varnish import VarnishManager
 
-from regions.models import Region
+from localwiki.utils.cache import (purge_cached, page_key, page_exists_key,
+    tag_key, global_tag_key, file_key, collapsed_key)
+from utils.transactions import on_commit
+from localwiki.utils.warming import queue_warming
+
+from .bans import dispatcher as ban_dispatcher, batch_bans
 
 rfc_3986_reserved = """!*'();:@&=+$,/?#[]"""
 rfc_3986_unreserved = """ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_.~"""
 VARNISH_SAFE = rfc_3986_reserved + rfc_3986_unreserved
 
+# Objects handled by each task after a bulk save.
+BULK_EDIT_CHUNK_SIZE = 100
+
 
 def varnish_invalidate_url(url, hostname=None):
     if not hostname:
         hostname = settings.MAIN_HOSTNAME
 
-    ban_path = r'obj.http.x-url ~ ^(?i)(%(url)s(/*)(\\?.*)?)$ && obj.http.x-host ~ ^((?i)(.*\\.)?%(host)s(:[0-9]*)?)$'
-
     # Varnish needs it quoted, but has a wonky way of encoding URLs :/
     url = urllib.unquote(url)
     url = urllib.quote(url, safe=VARNISH_SAFE)
     if type(url) != unicode:
         url = url.decode('utf-8')
-    ban_cmd = (ban_path % {'url': url, 'host': hostname}).encode('utf-8')
-    manager = VarnishManager(settings.VARNISH_MANAGEMENT_SERVERS)
-    manager.run('ban', ban_cmd, secret=settings.VARNISH_SECRET)
-
-def varnish_invalidate_page(p):
-    current_urlconf = get_urlconf() or settings.ROOT_URLCONF
-
-    if p.region.regionsettings.domain:
-        # Has a domain, ugh. Need to clear two URLs on two hosts, in this case
-        set_urlconf('main.urls_no_region')
-        varnish_invalidate_url(p.get_absolute_url(), hostname=p.region.regionsettings.domain)
-
-        # Now invalidate main path on LocalWiki hub
-        set_urlconf('main.urls')
-        varnish_invalidate_url(p.get_absolute_url())
-    else:
-        varnish_invalidate_url(p.get_absolute_url())
-
-    set_urlconf(current_urlconf)
+    ban_dispatcher.ban(url, hostname)
+
+def purge(keys):
+    """
+    Invalidates the cached responses built from any of the given dependency
+    keys (see utils.cache), both in memcached and in Varnish.
+    """
+    keys = set(keys)
+    if not keys:
+        return
+    invalidated = purge_cached(keys)
+    # Responses with too many keys are tagged with the collapsed ones,
+    # see utils.cache.xkey_header.
+    ban_dispatcher.ban_keys(keys | set([collapsed_key(k) for k in keys]))
+    queue_warming(invalidated)
 
 def django_invalidate_page(p):
     def _do_invalidate():
@@ -66,70 +68,44 @@ def django_invalidate_page(p):
 
     set_urlconf(current_urlconf)
 
-def invalidate_region_tag_views(slug, region):
-    from tags.cache import django_invalidate_tag_view, varnish_invalidate_tag_view
-
-    # Clear on the region itself
-    varnish_invalidate_tag_view(slug, region)
-    django_invalidate_tag_view(slug, region)
-
-    # Clear on nearby regions
-    center = region.regionsettings.region_center
-    if not center:
-        return
-    nearby_regions = Region.objects.filter(regionsettings__region_center__dwithin=(center, 0.5))
-    for region in nearby_regions:
-        varnish_invalidate_tag_view(slug, region)
-        django_invalidate_tag_view(slug, region)
-
-def invalidate_global_tag_view(slug):
-    from tags.cache import django_invalidate_global_tag_view, varnish_invalidate_global_tag_view
-
-    varnish_invalidate_global_tag_view(slug)
-    django_invalidate_global_tag_view(slug)
+def _tags_changed_keys(region_id, slugs):
+    keys = []
+    for slug in slugs:
+        keys.append(tag_key(region_id, slug))
+        keys.append(global_tag_key(slug))
+    return keys
 
 @shared_task(ignore_result=True)
+@batch_bans
 def _async_cache_post_edit(instance, created=False, deleted=False, raw=False):
     from pages.models import Page
     from maps.models import MapData
     from tags.models import PageTagSet
-    from links.models import Link, IncludedPage, IncludedTagList
-    from tags.cache import django_invalidate_tag_view, varnish_invalidate_tag_view
     from versionutils.diff import diff
+    from pages.artifacts import render_artifacts_after_page_edit, render_artifacts_after_tag_edit
+    from pages import include_cache
 
     if isinstance(instance, Page):
-        # First, let's clear out the Varnish cache for this page
-        varnish_invalidate_page(instance)
-
-        # Then we clear the cache for pages that depend on this page
+        # Re-render the stored content of this page and the pages that depend
+        # on it before clearing out the caches.
+        include_cache.page_changed(instance, created=created, deleted=deleted)
+        render_artifacts_after_page_edit(instance, created=created, deleted=deleted)
+
+        # Clears this page and the pages (and included fragments) that
+        # include it.
+        keys = [page_key(instance.region_id, instance.slug)]
         if created or deleted:
-            # Clear the cache for pages that link to this page, as the
-            # link dashed-underline-status has changed.
-
-            # First, make sure and get all the page links, whether or not the
-            # destination page exists:
-            links_to_here = set([l.source for l in instance.links_to_here.all()])
-            other_links = Link.objects.filter(destination_name__iexact=instance.slug)
-            other_links = [Page(name=l.source.name, slug=l.source.slug, region=instance.region) for l in other_links]
-            links_to_here = set.union(links_to_here, other_links)
-
-            for p in links_to_here:
-                varnish_invalidate_page(p)
-                django_invalidate_page(p)
-
-        # Clear out the cache for pages that include this page
-        for p in instance.pages_that_include_this.all():
-            varnish_invalidate_page(p.source)
-            django_invalidate_page(p.source)
+            # Clear the pages that link to this page, as the link
+            # dashed-underline-status has changed.
+            keys.append(page_exists_key(instance.region_id, instance.slug))
+        purge(keys)
 
     elif isinstance(instance, MapData):
-        varnish_invalidate_page(instance.page)
+        # The region map is cleared in maps.cache
+        purge([page_key(instance.page.region_id, instance.page.slug)])
 
     # Only ever deal with PageTagSet if deleted (otherwise we deal with m2m_changed)
     elif isinstance(instance, PageTagSet) and deleted:
-        varnish_invalidate_page(instance.page)
-        django_invalidate_page(instance.page)
-
         if instance.versions.all().count() == 1:
             changed = [t.slug for t in instance.tags.all()]
         else:
@@ -138,17 +114,16 @@ def _async_cache_post_edit(instance, created=False, deleted=False, raw=False):
             items = diff(v1, v2).get_diff()['tags'].get_diff()
             changed = [t.slug for t in set.union(items['added'], items['deleted'])]
 
-        # Clear tag list views
-        for slug in changed:
-            invalidate_region_tag_views(slug, instance.region)
-            invalidate_global_tag_view(slug)
-
-        # Clear out the pages that include a 'list of tagged pages' of the deleted
-        # tags:
+        # Re-render the pages that include a 'list of tagged pages' of the
+        # deleted tags:
         slugs_before_delete = [t.slug for t in instance.versions.all()[1].tags.all()]
-        for tl in IncludedTagList.objects.filter(included_tag__slug__in=slugs_before_delete):
-            varnish_invalidate_page(tl.source)
-            django_invalidate_page(tl.source)
+        include_cache.tags_changed(slugs_before_delete)
+        render_artifacts_after_tag_edit(slugs_before_delete)
+
+        # Clears the page, the tag list views and the pages including them
+        purge([page_key(instance.page.region_id, instance.page.slug)] +
+              _tags_changed_keys(instance.region_id,
+                                 set(changed + slugs_before_delete)))
 
 def _page_cache_post_edit(sender, instance, created=False, deleted=False, raw=False, **kwargs):
     # We want to syncronously clear the page cache when it's been edited directly, or an
@@ -171,11 +146,12 @@ def _page_cache_post_edit(sender, instance, created=False, deleted=False, raw=Fa
     _async_cache_post_edit.delay(instance, created=created, deleted=deleted, raw=raw)
 
 @shared_task(ignore_result=True)
+@batch_bans
 def _async_pagetagset_m2m_changed(instance):
-    from links.models import IncludedTagList
     from versionutils.diff import diff
+    from pages.artifacts import render_artifacts_after_tag_edit
+    from pages import include_cache
 
-    varnish_invalidate_page(instance.page)
     django_invalidate_page(instance.page)
 
     # This seems roundabout because it is. We clear() out the tag set each time
@@ -192,15 +168,36 @@ def _async_pagetagset_m2m_changed(instance):
         items = diff(v1, v2).get_diff()['tags'].get_diff()
         changed = [t.slug for t in set.union(items['added'], items['deleted'])]
 
-    # Clear tag list views
-    for slug in changed:
-        invalidate_region_tag_views(slug, instance.region)
-        invalidate_global_tag_view(slug)
+    # Re-render pages that include these tags as "list of tagged pages"
+    include_cache.tags_changed(changed)
+    render_artifacts_after_tag_edit(changed)
 
-    # Clear caches of pages that include these tags as "list of tagged pages"
-    for tl in IncludedTagList.objects.filter(included_tag__slug__in=changed):
-        varnish_invalidate_page(tl.source)
-        django_invalidate_page(tl.source)
+    # Clears the page, the tag list views and the pages including them
+    purge([page_key(instance.page.region_id, instance.page.slug)] +
+          _tags_changed_keys(instance.region_id, changed))
+
+@shared_task(ignore_result=True)
+@batch_bans
+def _async_cache_bulk_edit(app_label, model_name, pks, created):
+    model = get_model(app_label, model_name)
+    for instance in model.objects.filter(pk__in=pks):
+        _async_cache_post_edit(instance, created=(instance.pk in created))
+
+def _page_cache_bulk_saved(sender, instances, created, **kwargs):
+    # Objects saved with versionutils' bulk_save().  As in
+    # _page_cache_post_edit, but with a task per chunk of them, sent
+    # their primary keys rather than the (maybe large) objects.
+    from pages.models import Page
+
+    for instance in instances:
+        django_invalidate_page(instance if isinstance(instance, Page) else instance.page)
+    pks = [instance.pk for instance in instances]
+    for i in range(0, len(pks), BULK_EDIT_CHUNK_SIZE):
+        chunk = pks[i:i + BULK_EDIT_CHUNK_SIZE]
+        # Once committed, so the task finds them.
+        on_commit(_async_cache_bulk_edit.delay, sender._meta.app_label,
+                  sender._meta.object_name, chunk,
+                  [pk for pk in chunk if pk in created])
 
 def _page_cache_post_save(sender, instance, created, raw, **kwargs):
     _page_cache_post_edit(sender, instance, created=created, deleted=False, raw=raw, **kwargs)
@@ -217,3 +214,22 @@ def _pagetagset_m2m_changed(sender, instance, action, reverse, model, pk_set, *a
         # Get the tags in this transaction before handing off to celery
         instance.tags.all()
         _async_pagetagset_m2m_changed.delay(instance)
+
+@shared_task(ignore_result=True)
+@batch_bans
+def _async_pagefile_changed(region_id, slug, rerender=True):
+    from pages.models import Page
+    from pages.artifacts import render_dependent_artifacts
+
+    if rerender:
+        render_dependent_artifacts(Page.objects.filter(slug=slug, region__id=region_id))
+    purge([file_key(region_id, slug)])
+
+def _pagefile_cache_changed(sender, instance, **kwargs):
+    from pages.artifacts import mark_stale_after_file_edit, artifacts_enabled
+
+    if instance.slug:
+        # Only the artifacts rendered with this file need re-rendering.
+        rerender = artifacts_enabled() and mark_stale_after_file_edit(
+            instance.region_id, instance.slug, instance.name)
+        _async_pagefile_changed.delay(instance.region_id, instance.slug, rerender)
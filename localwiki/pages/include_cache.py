@@ -0,0 +1,161 @@
+"""
+Shared cache of rendered included pages.
+
+Pages like navigation bars are included on many pages, and often include
+other pages themselves.  We keep their rendered HTML in the shared cache
+so each inclusion doesn't have to look up and render the whole tree of
+included pages again.
+
+Each page has an include generation number that's folded into the cache
+key of its rendered fragment.  When a page changes we bump its
+generation, and the generation of every page that (directly or through
+other pages) includes it, by following `links.models.IncludedPage`.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.urlresolvers import get_urlconf
+from django.utils import translation
+
+from .analysis import analyze_page
+from .template_cache import SHARED_CACHE_TIMEOUT
+
+
+# Bump this when changing what's stored for a fragment.
+FRAGMENT_VERSION = 2
+
+
+def esi_includes_enabled():
+    """
+    When enabled, included pages and tag lists are rendered as edge-side
+    includes of their own fragment URL, for Varnish to cache separately.
+    """
+    return getattr(settings, 'PAGE_ESI_INCLUDES', False)
+
+
+def _include_generation_key(page_id):
+    return 'include_gen:%s' % page_id
+
+
+def get_include_generation(page_id):
+    return cache.get(_include_generation_key(page_id), 0)
+
+
+def _bump_generation(page_id):
+    key = _include_generation_key(page_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Key doesn't exist yet.
+        cache.set(key, 1, SHARED_CACHE_TIMEOUT)
+
+
+def including_pages(page_ids):
+    """
+    Returns:
+        The ids of the pages that include the given pages, however deeply
+        nested.
+    """
+    from links.models import IncludedPage
+
+    page_ids = set(page_ids)
+    found = set()
+    to_visit = page_ids
+    while to_visit:
+        sources = IncludedPage.objects.filter(included_page__id__in=to_visit)
+        to_visit = set(sources.values_list('source', flat=True)) - found - page_ids
+        found.update(to_visit)
+    return found
+
+
+def bump_include_generations(page_ids):
+    """
+    Bumps the include generation of the given pages and of all the pages
+    that include them.
+
+    Returns:
+        The ids of the pages whose generation was bumped.
+    """
+    page_ids = set(page_ids)
+    page_ids.update(including_pages(page_ids))
+    for page_id in page_ids:
+        _bump_generation(page_id)
+    return page_ids
+
+
+def page_changed(page, created=False, deleted=False):
+    """
+    Invalidates the rendered fragments affected by a change to `page`.
+
+    Returns:
+        The ids of the pages whose rendered fragments were invalidated.
+    """
+    from links.models import Link, IncludedPage
+
+    page_ids = set()
+    if not deleted and page.id:
+        page_ids.add(page.id)
+    # Pages that include this page by name.  We look these up by slug as the
+    # page may no longer, or not yet, exist.
+    page_ids.update(IncludedPage.objects.filter(included_page_slug=page.slug,
+        region=page.region).values_list('source', flat=True))
+    if created or deleted:
+        # Links to this page render differently depending on whether it
+        # exists.
+        page_ids.update(Link.objects.filter(destination_slug=page.slug,
+            region=page.region).values_list('source', flat=True))
+    return bump_include_generations(page_ids)
+
+
+def tags_changed(slugs):
+    from links.models import IncludedTagList
+
+    return bump_include_generations(IncludedTagList.objects.filter(
+        included_tag__slug__in=slugs).values_list('source', flat=True))
+
+
+def fragment_cache_key(page, context, args):
+    """
+    Returns:
+        The shared cache key for `page` as included, with the given include
+        arguments, in the page being rendered in `context`.
+    """
+    parts = [
+        FRAGMENT_VERSION,
+        page.id,
+        get_include_generation(page.id),
+        ','.join(sorted(args)),
+        int(bool(context.get('_render_nofollow', False))),
+        get_urlconf() or settings.ROOT_URLCONF,
+        translation.get_language(),
+    ]
+    # Links to files are rendered relative to the page doing the including.
+    outer_page = context.get('page', None)
+    if analyze_page(page).linked_files and outer_page is not None:
+        parts.append('%s:%s' % (outer_page.region_id, outer_page.id))
+    # Control characters and whitespace not allowed in memcached keys
+    h = hashlib.sha1(u':'.join([unicode(p) for p in parts]).encode('utf-8'))
+    return 'include:%s:%s' % (page.id, h.hexdigest())
+
+
+def get_fragment(key):
+    """
+    Returns:
+        A tuple (html, keys) or None.  `keys` are the dependency keys (see
+        `utils.cache`) recorded while rendering the fragment.
+    """
+    return cache.get(key)
+
+
+def set_fragment(key, html, keys):
+    cache.set(key, (html, list(keys)), SHARED_CACHE_TIMEOUT)
+
+
+def _pagefile_changed(sender, instance, **kwargs):
+    from .models import Page
+
+    if not instance.slug:
+        return
+    bump_include_generations(Page.objects.filter(slug=instance.slug,
+        region=instance.region_id).values_list('id', flat=True))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from regions.models import Region
+from pages.models import Page
+from pages.thumbnails import page_thumbnails, generate_thumbnail
+
+
+class Command(BaseCommand):
+    help = ('Generates the thumbnails used in the pages of the specified region.\n'+
+           'Usage: localwiki-manage pregenerate_thumbnails <region slug>')
+
+    def handle(self, region_slug=None, **options):
+        if region_slug is None:
+            raise CommandError("You must provide a region slug.")
+
+        try:
+            region = Region.objects.get(slug=region_slug)
+        except Region.DoesNotExist:
+            raise CommandError('Region "%s" does not exist.' % region_slug)
+
+        generated = 0
+        for page in Page.objects.filter(region=region).iterator():
+            for file_name, geometry in page_thumbnails(page):
+                if generate_thumbnail(file_name, geometry):
+                    generated += 1
+
+        self.stdout.write('Generated %d thumbnails for "%s".\n' % (
+                              generated, region_slug))
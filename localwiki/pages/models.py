@@ -3,7 +3,6 @@ from urllib import unquote_plus
 import mimetypes
 import re
 from urlparse import urljoin
-from lxml.html import fragments_fromstring
 from copy import copy
 
 from django.contrib.gis.db import models
@@ -19,6 +18,7 @@ from django_randomfilenamestorage.storage import (
     RandomFilenameFileSystemStorage)
 
 from versionutils import diff, versioning
+from versionutils.versioning.models import LastEditFields
 from versionutils.versioning.utils import is_versioned, unique_lookup_values_for
 from localwiki.utils.urlresolvers import reverse
 from regions.models import Region
@@ -35,7 +35,7 @@ def validate_page_slug(slug):
             'characters along with %(KEEP_CHARACTERS)s') % {'KEEP_CHARACTERS': SLUGIFY_KEEP})
 
 
-class Page(models.Model):
+class Page(LastEditFields):
     name = models.CharField(max_length=255, blank=False)
     slug = models.CharField(max_length=255, editable=False, blank=False, db_index=True,
         validators=[validate_page_slug])
@@ -63,9 +63,16 @@ class Page(models.Model):
             return url
 
     def save(self, *args, **kwargs):
-        self.slug = slugify(self.name)
+        self.prepare_save()
         super(Page, self).save(*args, **kwargs)
 
+    def prepare_save(self):
+        """
+        Sets the fields derived from the others.  Called by save(), and by
+        versioning.bulk_save() in its place.
+        """
+        self.slug = slugify(self.name)
+
     def clean(self):
         self.name = clean_name(self.name)
         if not slugify(self.name):
@@ -245,25 +252,22 @@ class Page(models.Model):
         Return either a good `PageFile` or None if the page
         doesn't contain any images (inside the content).
         """
-        from .plugins import _files_url, file_url_to_name
+        from .analysis import analyze_page
 
-        if not PageFile.objects.filter(slug=self.slug, region=self.region).exists():
+        names = analyze_page(self).local_images
+        if not names:
             return None
 
-        # Parse the page HTML and look for the first local image
-        for e in fragments_fromstring(self.content):
-            if isinstance(e, basestring):
-                continue
-            for i in e.iter('img'):
-                src = i.attrib.get('src', '')
-                if src.startswith(_files_url):
-                    _file = PageFile.objects.filter(
-                        slug__exact=self.slug,
-                        name__exact=file_url_to_name(src),
-                        region=self.region
-                    )
-                    if _file:
-                        return _file[0]
+        files = PageFile.objects.filter(
+            slug__exact=self.slug,
+            name__in=names,
+            region=self.region
+        )
+        files = dict((f.name, f) for f in files)
+        # The first local image in the page that's actually attached
+        for name in names:
+            if name in files:
+                return files[name]
 
 
 class PageDiff(diff.BaseModelDiff):
@@ -273,7 +277,9 @@ class PageDiff(diff.BaseModelDiff):
 
 
 diff.register(Page, PageDiff)
-versioning.register(Page)
+# Page content is most of the size of page history, so older versions
+# store their content as deltas.
+versioning.register(Page, delta_fields=['content'])
 
 
 class PageFile(models.Model):
@@ -336,6 +342,37 @@ class PageFile(models.Model):
 versioning.register(PageFile)
 
 
+class PageArtifact(models.Model):
+    """
+    The rendered HTML of a page's content, as output by the
+    `render_plugins` template tag.  See pages.artifacts.
+
+    Links are rendered using the current urlconf, so pages on regions with
+    a custom domain get one artifact per urlconf.
+    """
+    page = models.ForeignKey(Page, related_name='artifacts')
+    urlconf = models.CharField(max_length=255)
+    # Hash of the page content (and artifact format) this was rendered from.
+    content_hash = models.CharField(max_length=40)
+    html = models.TextField()
+    rendered_at = models.DateTimeField(auto_now=True)
+
+    # What the rendered HTML depends on, other than the page content.
+    depends_on_pages = models.ManyToManyField(Page, related_name='dependent_artifacts')
+    # Newline-separated tag slugs and file names.
+    depends_on_tags = models.TextField(blank=True)
+    depends_on_files = models.TextField(blank=True)
+    # Newline-separated dependency keys (see utils.cache), recorded for
+    # the responses served with this artifact.
+    cache_keys = models.TextField(blank=True)
+
+    class Meta:
+        unique_together = ('page', 'urlconf')
+
+    def __unicode__(self):
+        return "%s (%s)" % (self.page, self.urlconf)
+
+
 def clean_name(name):
     # underscores are used to namespace special URLs, so let's remove them
     name = re.sub('_', ' ', name).strip()
@@ -57,6 +57,7 @@ from django.conf import settings
 from ckeditor.models import parse_style, sanitize_html_fragment
 from redirects.models import Redirect
 from localwiki.utils.urlresolvers import reverse
+from localwiki.utils.cache import record_dependencies, page_exists_key, file_key
 
 from .fields import WikiHTMLField
 from .models import Page, name_to_url, url_to_name, PageFile
@@ -235,9 +236,13 @@ def handle_image(elem, context=None):
         # it's output.
         del elem.attrib['src']
         elem.attrib['src_thumb'] = '{{ im.url }}'
+        # Until the thumbnail's been generated we get the original image,
+        # which has no other resolutions.
         elem.attrib['srcset_thumb'] = (
+            '{% if not im.pending %}'
             '{{ im.url|resolution:"2x" }} 2x, '
-            '{{ im.url|resolution:"1.5x" }} 1.5x')
+            '{{ im.url|resolution:"1.5x" }} 1.5x'
+            '{% endif %}')
         insert_text_before(before, elem)
         elem.tail = after + (elem.tail or '')
     else:
@@ -332,11 +337,186 @@ def html_to_template_text(unsafe_html, context=None, render_plugins=True):
     return template_text.decode('utf-8')
 
 
+def _is_relative_link(url):
+    url_parts = urlparse(url)
+    return (not url_parts.scheme and not url_parts.netloc)
+
+
+def _classify_relative_link(url):
+    """
+    Args:
+        url: A relative link href, as found in page content.
+
+    Returns:
+        A tuple (kind, value).  `kind` is one of 'file', 'tag', 'anchor'
+        or 'page'.  For 'file' links `value` is the file name, for 'page'
+        links it is a (path, fragment) tuple.
+    """
+    if url.startswith('_files/'):
+        return ('file', file_url_to_name(url))
+    if unquote_plus(url).startswith('tags/'):
+        return ('tag', None)
+    # Convert to proper URL: My%20page -> My_page
+    url = name_to_url(url_to_name(url))
+    url_parts = urlparse(url)
+    path = url_parts.path
+    fragment = '#%s' % url_parts.fragment if url_parts.fragment else ''
+    if fragment and not path.strip():
+        return ('anchor', fragment)
+    return ('page', (path, fragment))
+
+
+class LinkResolver(object):
+    """
+    Resolves the targets of all the links in a page template up front.
+
+    Rendering a `LinkNode` needs to know whether the linked-to page (or
+    file) exists.  Rather than asking the database once per link, we
+    collect every link target in the template before rendering and look
+    them all up with one query each for pages, redirects and files.
+    `LinkNode` then asks the resolver, and falls back to querying
+    directly for anything that wasn't collected (e.g. links inside
+    included pages).
+    """
+    def __init__(self, region, page):
+        self.region = region
+        self.page = page
+        # slug -> pretty slug of the existing page, or None if missing.
+        self.pages = {}
+        self.redirects = set()
+        # file name -> rough type of the existing file, or None if missing.
+        self.files = {}
+        self.queries = 0
+        self.lookups = 0
+
+    @classmethod
+    def for_template(cls, template, context):
+        region = context.get('region', None)
+        page = context.get('page', None)
+        if region is None or page is None:
+            return None
+        resolver = cls(region, page)
+        resolver.resolve(get_link_targets(template))
+        return resolver
+
+    def resolve(self, urls):
+        page_slugs = set()
+        filenames = set()
+        for url in urls:
+            try:
+                kind, value = _classify_relative_link(url)
+                if kind == 'file':
+                    filenames.add(value)
+                elif kind == 'page':
+                    page_slugs.add(slugify(value[0]))
+            except:
+                # LinkNode will deal with this one on its own.
+                continue
+
+        if page_slugs:
+            self.pages = dict((slug, None) for slug in page_slugs)
+            existing = Page.objects.filter(
+                slug__in=page_slugs, region=self.region).values_list('slug', 'name')
+            for slug, name in existing:
+                self.pages[slug] = name_to_url(name) if name else slug
+            self.queries += 1
+
+            missing = [slug for slug, pretty in self.pages.iteritems() if pretty is None]
+            if missing:
+                self.redirects = set(Redirect.objects.filter(
+                    source__in=missing, region=self.region).values_list('source', flat=True))
+                self.queries += 1
+
+        if filenames and self.page.slug:
+            self.files = dict((name, None) for name in filenames)
+            existing = PageFile.objects.filter(slug__exact=self.page.slug,
+                region=self.region, name__in=filenames).values_list('name', flat=True)
+            for name in existing:
+                self.files[name] = PageFile(name=name).rough_type
+            self.queries += 1
+
+    def can_resolve_for(self, region, page):
+        return (region == self.region and page.slug == self.page.slug)
+
+    @property
+    def queries_saved(self):
+        return max(self.lookups - self.queries, 0)
+
+
+def record_link_queries_saved(context, resolver):
+    """
+    Adds the number of queries `resolver` saved to the running total for
+    the current request, `request.link_queries_saved`.
+    """
+    request = context.get('request', None)
+    if resolver is None or request is None:
+        return
+    total = getattr(request, 'link_queries_saved', 0)
+    request.link_queries_saved = total + resolver.queries_saved
+
+
+def get_link_targets(template):
+    """
+    Returns:
+        A list of the (constant) hrefs of the `LinkNode`s in `template`.
+    """
+    # Compiled page templates are shared (see pages.template_cache), so
+    # only walk the nodes once per template.
+    targets = getattr(template, '_link_targets', None)
+    if targets is None:
+        targets = [node.href for node in template.nodelist.get_nodes_by_type(LinkNode)
+                   if not isinstance(node.href, Variable) and _is_relative_link(node.href)]
+        template._link_targets = targets
+    return targets
+
+
 class LinkNode(Node):
     def __init__(self, href, nodelist):
         self.href = href
         self.nodelist = nodelist
 
+    def _get_resolver(self, context, region, page):
+        resolver = context.get('_link_resolver', None)
+        if resolver is not None and resolver.can_resolve_for(region, page):
+            return resolver
+        return None
+
+    def get_file_type(self, context, region, page, filename):
+        """
+        Returns:
+            The rough type of the attached file, or None if there's no
+            such file.
+        """
+        resolver = self._get_resolver(context, region, page)
+        if resolver is not None and filename in resolver.files:
+            resolver.lookups += 1
+            return resolver.files[filename]
+        try:
+            file = PageFile.objects.get(
+                slug__exact=page.slug, region=region, name__exact=filename)
+            return file.rough_type
+        except PageFile.DoesNotExist:
+            return None
+
+    def get_page_slug(self, context, region, page, slug):
+        """
+        Returns:
+            A tuple (pretty_slug, redirect_exists).  `pretty_slug` is None
+            if the page doesn't exist.
+        """
+        resolver = self._get_resolver(context, region, page)
+        if resolver is not None and slug in resolver.pages:
+            pretty_slug = resolver.pages[slug]
+            resolver.lookups += 1
+            if pretty_slug is None:
+                resolver.lookups += 1
+                return (None, slug in resolver.redirects)
+            return (pretty_slug, False)
+        try:
+            return (Page.objects.get(slug__exact=slug, region=region).pretty_slug, False)
+        except Page.DoesNotExist:
+            return (None, Redirect.objects.filter(source=slug, region=region).exists())
+
     def render(self, context):
         region = context['region']
         nofollow = context.get('_render_nofollow', False)
@@ -347,43 +527,40 @@ class LinkNode(Node):
                 url = url.resolve(context)
             page = context['page']
             if self.is_relative_link(url):
-                if url.startswith('_files/'):
-                    filename = file_url_to_name(url)
+                kind, value = _classify_relative_link(url)
+                if kind == 'file':
+                    filename = value
+                    record_dependencies(context.get('request', None),
+                        [file_key(region.id, page.slug)])
                     url = reverse('pages:file-info',
                             kwargs={
                                 'region': region.slug,
                                 'slug': page.pretty_slug,
                                 'file': filename}
                     )
-                    try:
-                        file = PageFile.objects.get(
-                            slug__exact=page.slug, region=region, name__exact=filename)
-                        cls = ' class="file_%s"' % file.rough_type
-                    except PageFile.DoesNotExist:
+                    rough_type = self.get_file_type(context, region, page, filename)
+                    if rough_type is not None:
+                        cls = ' class="file_%s"' % rough_type
+                    else:
                         cls = ' class="missing_link"'
-                elif unquote_plus(url).startswith('tags/'):
+                elif kind == 'tag':
                     cls = ' class="tag_link"'
                     url = unquote_plus(url)
+                elif kind == 'anchor':
+                    url = value
                 else:
-                    # Convert to proper URL: My%20page -> My_page
-                    url = name_to_url(url_to_name(url))
-
-                    # Handle relative page links with anchors
-                    url_parts = urlparse(url)
-                    path = url_parts.path
-                    fragment = '#%s' % url_parts.fragment if url_parts.fragment else ''
-
-                    if fragment and not path.strip():
-                        url = fragment
+                    path, fragment = value
+                    record_dependencies(context.get('request', None),
+                        [page_exists_key(region.id, slugify(path))])
+                    pretty_slug, has_redirect = self.get_page_slug(
+                        context, region, page, slugify(path))
+                    if pretty_slug is not None:
+                        url = reverse('pages:show', kwargs={'region': region.slug, 'slug': pretty_slug}) + fragment
                     else:
-                        try:
-                            page = Page.objects.get(slug__exact=slugify(path), region=region)
-                            url = reverse('pages:show', kwargs={'region': region.slug, 'slug': page.pretty_slug}) + fragment
-                        except Page.DoesNotExist:
-                            # Check if Redirect exists.
-                            if not Redirect.objects.filter(source=slugify(path), region=region):
-                                cls = ' class="missing_link"'
-                            url = reverse('pages:show', kwargs={'region': region.slug, 'slug': path}) + fragment
+                        # Check if Redirect exists.
+                        if not has_redirect:
+                            cls = ' class="missing_link"'
+                        url = reverse('pages:show', kwargs={'region': region.slug, 'slug': path}) + fragment
             # External links + nofollow flag (e.g. on User pages) => render as nofollow:
             elif nofollow:
                 return '<a rel="nofollow" href="%s"%s>%s</a>' % (url, cls, self.nodelist.render(context))
@@ -394,8 +571,7 @@ class LinkNode(Node):
             return ''
 
     def is_relative_link(self, url):
-        url_parts = urlparse(url)
-        return (not url_parts.scheme and not url_parts.netloc)
+        return _is_relative_link(url)
 
 
 class EmbedCodeNode(Node):
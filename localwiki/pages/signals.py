@@ -1,16 +1,23 @@
-from django.db.models.signals import pre_save, post_save, pre_delete, m2m_changed
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
 from django.utils.translation import ugettext as _
 from django.conf import settings
 
 from celery import shared_task
 from actstream import action
 
+from versionutils.versioning import bulk_saved
+
 from redirects.models import Redirect
 from tags.models import PageTagSet
 from maps.models import MapData
+from regions.nearby import _page_nearby_post_save, _page_nearby_post_delete
 
-from .models import Page
-from .cache import _page_cache_post_save, _page_cache_pre_delete, _pagetagset_m2m_changed
+from .models import Page, PageFile
+from .cache import (_page_cache_post_save, _page_cache_pre_delete,
+    _pagetagset_m2m_changed, _pagefile_cache_changed, _page_cache_bulk_saved)
+from .template_cache import _pagefile_changed
+from .thumbnails import _page_thumbnails_changed, _pagefile_thumbnails_changed
+from . import include_cache
 
 
 def _delete_page(sender, instance, raw, **kws):
@@ -42,7 +49,7 @@ def _created_page_action(sender, instance, created, raw, **kws):
         # we have to skip signals here :/
         return
 
-    user_edited = instance.versions.most_recent().version_info.user
+    user_edited = instance.last_editor
     if not user_edited:
         return
     
@@ -53,7 +60,7 @@ def _created_page_action(sender, instance, created, raw, **kws):
 def _maybe_follow_region(page):
     from follow.models import Follow
 
-    user_edited = page.versions.most_recent().version_info.user
+    user_edited = page.last_editor
     if not user_edited:
         return
 
@@ -79,6 +86,15 @@ def _post_save_maybe_follow(sender, instance, created, raw, **kws):
     _maybe_follow_region.delay(instance)
 
 
+def _search_bulk_saved(sender, instances, **kws):
+    # Queue the search index updates, as haystack's signal processor does
+    # on post_save.
+    from haystack import signal_processor
+
+    for instance in instances:
+        signal_processor.handle_save(sender, instance)
+
+
 # When a Redirect is created we want to delete the source Page if it
 # exists.  This is so the redirect (which works via 404 fall-through)
 # will be immediately functional.
@@ -110,3 +126,27 @@ m2m_changed.connect(_pagetagset_m2m_changed, sender=PageTagSet.tags.through)
 
 post_save.connect(_page_cache_post_save, sender=MapData)
 pre_delete.connect(_page_cache_pre_delete, sender=MapData)
+
+# Objects saved in bulk with versionutils' bulk_save() get one signal per
+# model, rather than a post_save each.
+bulk_saved.connect(_page_cache_bulk_saved, sender=Page)
+bulk_saved.connect(_page_cache_bulk_saved, sender=MapData)
+bulk_saved.connect(_search_bulk_saved)
+
+# The compiled page template depends on which files are attached to the page.
+post_save.connect(_pagefile_changed, sender=PageFile)
+post_delete.connect(_pagefile_changed, sender=PageFile)
+# ..as do the rendered fragments of included pages, the pre-rendered page
+# content and the cached page views.
+post_save.connect(include_cache._pagefile_changed, sender=PageFile)
+post_delete.connect(include_cache._pagefile_changed, sender=PageFile)
+post_save.connect(_pagefile_cache_changed, sender=PageFile)
+post_delete.connect(_pagefile_cache_changed, sender=PageFile)
+
+# Page counts are kept in the nearby regions table.
+post_save.connect(_page_nearby_post_save, sender=Page)
+post_delete.connect(_page_nearby_post_delete, sender=Page)
+
+# Generate the thumbnails used in page content ahead of time.
+post_save.connect(_page_thumbnails_changed, sender=Page)
+post_save.connect(_pagefile_thumbnails_changed, sender=PageFile)
@@ -0,0 +1,106 @@
+"""
+Caching of compiled page templates.
+
+Rendering page content means turning the stored HTML into template text
+(see `pages.plugins.html_to_template_text`) and then compiling that text
+into a `django.template.Template`.  Both steps are expensive and their
+result only changes when the page content (or the set of files attached
+to the page) changes, so we cache them:
+
+  * An in-process LRU of compiled `Template` objects.
+  * A shared (memcached) tier holding the template text, so that a fresh
+    process only has to compile, not re-parse, the content.
+
+Entries are keyed by a hash of the content and the rendering options, so
+editing a page never needs to explicitly clear anything here.  The
+output of `html_to_template_text` also depends on which files are
+attached to the page (see `pages.plugins.handle_image`), so a per-page
+file generation number is folded into the key and bumped whenever a
+`PageFile` changes.  The file URLs it bakes in depend on the active
+urlconf (regions on a custom domain have their own), so that's folded
+into the key, too.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.urlresolvers import get_urlconf
+from django.template import Template
+
+from localwiki.utils import LRUCache
+
+from .plugins import html_to_template_text
+
+# 29 days, see utils.views.DEFAULT_MEMCACHED_TIMEOUT
+SHARED_CACHE_TIMEOUT = 60 * 60 * 24 * 29
+
+_compiled_templates = LRUCache(
+    max_size=getattr(settings, 'PAGE_TEMPLATE_CACHE_SIZE', 500))
+
+
+def _pagefiles_generation_key(region_id, slug):
+    # Control characters and whitespace not allowed in memcached keys
+    return 'pagefiles_gen:%s:%s' % (
+        region_id, hashlib.sha1(slug.encode('utf-8')).hexdigest())
+
+
+def get_pagefiles_generation(page):
+    return cache.get(_pagefiles_generation_key(page.region_id, page.slug), 0)
+
+
+def bump_pagefiles_generation(region_id, slug):
+    key = _pagefiles_generation_key(region_id, slug)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Key doesn't exist yet.
+        cache.set(key, 1, SHARED_CACHE_TIMEOUT)
+
+
+def template_cache_key(html, context=None, render_plugins=True, nofollow=False):
+    """
+    Returns:
+        A key that uniquely identifies the template generated from `html`
+        with the provided rendering options.
+    """
+    h = hashlib.sha1()
+    h.update(html.encode('utf-8'))
+    h.update('|%d|%d|%s' % (bool(render_plugins), bool(nofollow),
+                            get_urlconf() or settings.ROOT_URLCONF))
+
+    page = context.get('page', None) if context else None
+    if page is not None and page.slug:
+        h.update('|%s|%s|%s' % (
+            page.region_id, page.slug.encode('utf-8'),
+            get_pagefiles_generation(page)))
+    return 'pagetemplate:%s' % h.hexdigest()
+
+
+def get_page_template(html, context=None, render_plugins=True, nofollow=False):
+    """
+    Like `Template(html_to_template_text(html, context, render_plugins))`,
+    but cached.
+
+    Returns:
+        A compiled `Template`.  The returned object is shared, so it must
+        be treated as read-only.
+    """
+    key = template_cache_key(html, context, render_plugins, nofollow)
+
+    t = _compiled_templates.get(key)
+    if t is not None:
+        return t
+
+    template_text = cache.get(key)
+    if template_text is None:
+        template_text = html_to_template_text(html, context, render_plugins)
+        cache.set(key, template_text, SHARED_CACHE_TIMEOUT)
+
+    t = Template(template_text)
+    _compiled_templates.set(key, t)
+    return t
+
+
+def _pagefile_changed(sender, instance, **kwargs):
+    if instance.slug:
+        bump_pagefiles_generation(instance.region_id, instance.slug)
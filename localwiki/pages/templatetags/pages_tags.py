@@ -1,19 +1,31 @@
+import logging
+from copy import copy
+
 from django import template
 from django.template.loader_tags import BaseIncludeNode
 from django.template import Template
 from django.utils.translation import ugettext as _
 from django.conf import settings
 from django.utils.text import unescape_string_literal
+from django.utils.html import escape
+from django.utils.http import urlencode
 
 from localwiki.utils.urlresolvers import reverse
+from localwiki.utils.cache import (record_dependencies, get_dependencies,
+    page_key, file_key)
 
 from pages.plugins import html_to_template_text, SearchBoxNode
 from pages.plugins import LinkNode, EmbedCodeNode
+from pages.plugins import LinkResolver, record_link_queries_saved
+from pages.template_cache import get_page_template
+from pages import include_cache
 from pages import models
 from pages.models import Page, slugify
 
 register = template.Library()
 
+logger = logging.getLogger(__name__)
+
 
 @register.filter(is_safe=True)
 def name_to_url(value):
@@ -33,18 +45,79 @@ class PageContentNode(BaseIncludeNode):
             render_context = context
             if self.nofollow:
                 context['_render_nofollow'] = True
-            t = Template(html_to_template_text(html, context, self.render_plugins))
+            t = get_page_template(html, context, self.render_plugins, self.nofollow)
+            resolver = LinkResolver.for_template(t, context)
+            context['_link_resolver'] = resolver
             html = self.render_template(t, context)
+            del context['_link_resolver']
             if self.nofollow:
                 del context['_render_nofollow']
+            record_link_queries_saved(context, resolver)
             return html
         except:
             if settings.TEMPLATE_DEBUG:
                 raise
+            if '_link_resolver' in context:
+                del context['_link_resolver']
             if self.nofollow and '_render_nofollow' in context:
                 del context['_render_nofollow']
 
 
+def _include_memo(context):
+    """
+    Returns:
+        A dictionary of the (html, dependency keys) of the content included
+        so far while handling the current request, or None if there's no
+        request.
+    """
+    request = context.get('request', None)
+    if request is None:
+        return None
+    if not hasattr(request, '_include_memo'):
+        request._include_memo = {}
+    return request._include_memo
+
+
+def fragment_query_string(args, context):
+    """
+    Returns:
+        The query string passing the include arguments to an included
+        content fragment view.
+    """
+    params = {}
+    if args:
+        params['args'] = ','.join(args)
+    if context.get('_render_nofollow', False):
+        params['nofollow'] = 1
+    if not params:
+        return ''
+    return '?' + urlencode(sorted(params.items()))
+
+
+class _IncludeFrame(object):
+    """
+    Content being included, on the include stack.
+    """
+    def __init__(self, key):
+        self.key = key
+        # False if something inside this content couldn't be included
+        # (include loop, too deep), in which case the rendered output
+        # depends on where it was included from and mustn't be reused.
+        self.complete = True
+
+
+class _RenderedContent(object):
+    """
+    Already rendered HTML, standing in for a Template.  Content that isn't
+    template text must never be compiled as a Template.
+    """
+    def __init__(self, html):
+        self.html = html
+
+    def render(self, context):
+        return self.html
+
+
 class IncludeContentNode(BaseIncludeNode):
     """
     Base class for including some named content inside a other content.
@@ -52,6 +125,10 @@ class IncludeContentNode(BaseIncludeNode):
     Subclass and override get_content() and get_title() to return HTML or None.
     The name of the content to include is stored in self.name
     All other parameters are stored in self.args, without quotes (if any).
+
+    Included content is rendered once per request (see get_key()), and
+    content including itself or nested deeper than INCLUDE_MAX_DEPTH
+    isn't included.
     """
     def __init__(self, parser, token, *args, **kwargs):
         super(IncludeContentNode, self).__init__(*args, **kwargs)
@@ -66,47 +143,179 @@ class IncludeContentNode(BaseIncludeNode):
             self.args.append(b)
         self.name = self.args.pop(0)
 
+    @classmethod
+    def for_name(cls, name, args=()):
+        """
+        Returns:
+            A node including `name`, as {% tag "name" args %} would, built
+            without going through the template parser.
+        """
+        node = cls.__new__(cls)
+        BaseIncludeNode.__init__(node)
+        node.name = name
+        node.args = list(args)
+        return node
+
     def get_content(self, context):
         """ Override this to return content to be included. """
         return None
 
+    def get_template(self, context):
+        """ Returns the compiled content to be included. """
+        return _RenderedContent(self.get_content(context) or '')
+
     def get_title(self, context):
         """ Override this to return a title or None to omit it. """
         return self.name
 
+    def get_key(self, context):
+        """
+        Returns:
+            A key identifying the included content.
+        """
+        region = context.get('region', None)
+        return (self.__class__.__name__, region.id if region else None,
+                slugify(self.name))
+
+    def get_shared_cache_key(self, context):
+        """
+        Override this to return a key to keep the rendered content in the
+        shared cache under, or None to not cache it.
+        """
+        return None
+
+    def get_fragment_url(self, context):
+        """
+        Override this to return the URL of a view rendering just this
+        content, to use as an edge-side include.
+        """
+        return None
+
+    def render_include_loop(self, context):
+        """ Override this to return HTML to show in case of an include loop. """
+        return ''
+
+    def render_too_deep(self, context):
+        """ Override this to return HTML to show when nested too deeply. """
+        return ''
+
     def process_context(self, context):
         self.region = context.get('region', None)
 
     def render(self, context):
-        self.process_context(context)
+        # Compiled page templates are cached and shared between threads
+        # (see pages.template_cache), so keep per-render state on a copy
+        # of the node rather than on the node itself.
+        return copy(self)._render(context)
+
+    def _render(self, context):
         try:
-            template_text = ''
-            if 'showtitle' in self.args:
-                title = self.get_title(context)
-                if title:
-                    template_text += '<h2>%s</h2>' % title
-            template_text += self.get_content(context)
-            template = Template(template_text)
-            return self.render_template(template, context)
-        except:
+            # Leave it to the edge cache to include the content, unless
+            # we're rendering an included fragment ourselves.
+            if (include_cache.esi_includes_enabled() and
+                    not context.get('_esi_fragment', False)):
+                url = self.get_fragment_url(context)
+                if url is not None:
+                    return '<esi:include src="%s"/>' % escape(url)
+
+            key = self.get_key(context)
+            memo_key = key + (tuple(self.args),
+                              bool(context.get('_render_nofollow', False)))
+            memo = _include_memo(context)
+            request = context.get('request', None)
+            if memo is not None and memo_key in memo:
+                html, keys = memo[memo_key]
+                record_dependencies(request, keys)
+                return html
+
+            # The dependencies recorded from here on are those of the
+            # included content.
+            num_keys = len(get_dependencies(request))
+            self.process_context(context)
+
+            stack = context.get('_include_stack', None)
+            if stack is None:
+                stack = []
+                # The page being rendered can't be included in itself, either.
+                page = context.get('page', None)
+                if page is not None:
+                    stack.append(_IncludeFrame(('page', page.region_id, page.slug)))
+                context['_include_stack'] = stack
+            if key in [frame.key for frame in stack]:
+                return self._cut_off(stack, self.render_include_loop(context))
+            max_depth = getattr(settings, 'INCLUDE_MAX_DEPTH', 10)
+            if len(stack) >= max_depth:
+                return self._cut_off(stack, self.render_too_deep(context))
+
+            shared_key = self.get_shared_cache_key(context)
+            if shared_key is not None:
+                cached = include_cache.get_fragment(shared_key)
+                if cached is not None:
+                    html, keys = cached
+                    record_dependencies(request, keys)
+                    if memo is not None:
+                        memo[memo_key] = (html, get_dependencies(request)[num_keys:])
+                    return html
+
+            frame = _IncludeFrame(key)
+            stack.append(frame)
+            try:
+                html = self.render_content(context)
+            finally:
+                stack.pop()
+
+            if frame.complete:
+                keys = get_dependencies(request)[num_keys:]
+                if memo is not None:
+                    memo[memo_key] = (html, keys)
+                if shared_key is not None:
+                    include_cache.set_fragment(shared_key, html, keys)
+            return html
+        except Exception:
             if settings.TEMPLATE_DEBUG:
                 raise
+            logger.exception('Unable to include %r', self.name)
             return ''
 
+    def _cut_off(self, stack, html):
+        for frame in stack:
+            frame.complete = False
+        return html
+
+    def render_content(self, context):
+        html = ''
+        if 'showtitle' in self.args:
+            title = self.get_title(context)
+            if title:
+                html += '<h2>%s</h2>' % title
+        return html + self.render_template(self.get_template(context), context)
+
 
 class IncludePageNode(IncludeContentNode):
+    def get_key(self, context):
+        region = context.get('region', None)
+        return ('page', region.id if region else None, slugify(self.name))
+
     def process_context(self, context):
         super(IncludePageNode, self).process_context(context)
+        slug = slugify(self.name)
         try:
-            self.page = Page.objects.get(
-                slug__exact=slugify(self.name), region=self.region)
-            # Keep track of the fact this page was included (for caching purposes)
-            if 'request' in context:
-                _depends_on = getattr(context['request'], '_depends_on_header', [])
-                _depends_on.append(self.page.id)
-                context['request']._depends_on = _depends_on
+            self.page = Page.objects.get(slug__exact=slug, region=self.region)
         except Page.DoesNotExist:
             self.page = None
+        # Keep track of the fact this page was included (for caching purposes)
+        record_dependencies(context.get('request', None),
+            [page_key(self.region.id, slug), file_key(self.region.id, slug)])
+
+    def get_fragment_url(self, context):
+        url = reverse('pages:include-fragment', kwargs={
+            'region': context['region'].slug, 'slug': name_to_url(slugify(self.name))})
+        return url + fragment_query_string(self.args, context)
+
+    def get_shared_cache_key(self, context):
+        if not self.page:
+            return None
+        return include_cache.fragment_cache_key(self.page, context, self.args)
 
     def get_title(self, context):
         if not self.page:
@@ -121,26 +330,29 @@ class IncludePageNode(IncludeContentNode):
             slug = name_to_url(self.name)
         return reverse('pages:show', kwargs={'region': self.region.slug, 'slug': slug})
 
-    def get_content(self, context):
+    def render_include_loop(self, context):
+        return (('<p class="plugin includepage">' + _('Unable to'
+                ' include <a href="%(page_url)s">%(page_name)s</a>: endless include'
+                ' loop.') + '</p>') % {'page_url': self.get_page_url(),
+                                       'page_name': self.page.name if self.page else self.name})
+
+    def render_too_deep(self, context):
+        return (('<p class="plugin includepage">' + _('Unable to'
+                ' include <a href="%(page_url)s">%(page_name)s</a>: too many'
+                ' nested includes.') + '</p>') % {'page_url': self.get_page_url(), 'page_name': self.name})
+
+    def get_template(self, context):
         if not self.page:
-            return (('<p class="plugin includepage">' + _('Unable to include '
+            return _RenderedContent(('<p class="plugin includepage">' + _('Unable to include '
                     '<a href="%(page_url)s" class="missing_link">%(page_name)s</a>') + '</p>')
-                    % {'page_url': self.get_page_url(), 'page_name': self.name})
-        # prevent endless loops
+                    % {'page_url': escape(self.get_page_url()), 'page_name': escape(self.name)})
         context_page = context['page']
-        include_stack = context.get('_include_stack', [])
-        include_stack.append(context_page.name)
-        if self.page.name in include_stack:
-            return (('<p class="plugin includepage">' + _('Unable to'
-                    ' include <a href="%(page_url)s">%(page_name)s</a>: endless include'
-                    ' loop.') + '</p>') % {'page_url': self.get_page_url(), 'page_name': self.page.name})
-        context['_include_stack'] = include_stack
         context['page'] = self.page
-        template_text = html_to_template_text(self.page.content, context)
-        # restore context
-        context['_include_stack'].pop()
-        context['page'] = context_page
-        return template_text
+        try:
+            return get_page_template(self.page.content, context)
+        finally:
+            # restore context
+            context['page'] = context_page
 
 
 @register.tag(name='render_plugins')
@@ -1,9 +1,12 @@
 # coding=utf-8
 
 from urllib import quote
+from StringIO import StringIO
 from lxml.html import fragments_fromstring
+from PIL import Image
 
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.db import models
 from django.test.client import RequestFactory
 from django import forms
@@ -11,19 +14,32 @@ from django.template.base import Template
 from django.template.context import Context
 from django.conf import settings
 from django.core.files.base import ContentFile
+from django.core.urlresolvers import set_urlconf
 from django.contrib.gis.geos import GEOSGeometry
+from sorl.thumbnail import default
+from sorl.thumbnail.templatetags.thumbnail import resolution
 
 from versionutils.merging.forms import MergeMixin
+from localwiki.utils.cache import get_dependencies, page_key, file_key
 from redirects.models import Redirect
 from regions.models import Region
 from maps.models import MapData
 from tags.models import PageTagSet, Tag
+from utils.sorl_backends import AutoFormatBackend, PendingThumbnail
+from pages import thumbnails
 
 from .. forms import PageForm
 from ..models import (Page, PageFile, slugify,
     url_to_name, clean_name, name_to_url)
 from ..plugins import html_to_template_text
-from ..plugins import tag_imports
+from ..plugins import tag_imports, LinkResolver
+from ..analysis import analyze_content
+from ..views import PageIncludeFragmentView
+from ..artifacts import (render_artifact, render_page_content, artifact_content_hash,
+    get_page_artifact, mark_stale_after_file_edit)
+from ..template_cache import get_page_template, template_cache_key
+from ..thumbnails import page_thumbnails
+from ..bans import BanDispatcher, ban_expression, key_ban_expression
 from .. import exceptions
 
 from .xsstests import xss_exploits
@@ -131,6 +147,15 @@ class PageTest(TestCase):
         p = Page.objects.get(pk=p.pk)
         self.failUnless('Edit conflict!' in p.content)
 
+    def test_bulk_save(self):
+        from versionutils.versioning import bulk_save
+
+        p = Page(name='Bulk Page', content='<p>Imported</p>', region=self.region)
+        bulk_save([p])
+        self.assertEqual(p.slug, 'bulk page')
+        self.assertEqual(Page.objects.get(pk=p.pk).slug, 'bulk page')
+        self.assertEqual(p.versions.count(), 1)
+
     def test_page_rename(self):
         p = Page(region=self.region)
         p.content = "<p>The page content.</p>"
@@ -717,6 +742,17 @@ class PluginTest(TestCase):
         self.failUnless(('Unable to include <a href="/test-region/Front_Page">Front Page'
                          '</a>: endless include loop') in html)
 
+    def test_endless_include_unsaved_page(self):
+        """ An unsaved page (e.g. a preview) including itself is a loop, too
+        """
+        a = Page(name='Front Page', slug=slugify('Front Page'), region=self.region)
+        a.content = '<a class="plugin includepage" href="Front_Page">dummy</a>'
+        context = Context({'page': a, 'region': self.region})
+        template = Template(html_to_template_text(a.content, context))
+        html = template.render(context)
+        self.failUnless(('Unable to include <a href="/test-region/Front_Page">Front_Page'
+                         '</a>: endless include loop') in html)
+
     def test_double_include(self):
         """ Multiple includes are ok
         """
@@ -736,6 +772,98 @@ class PluginTest(TestCase):
             ('<div class="included_page_wrapper"><p>Some text</p></div>'
              '<div class="included_page_wrapper"><p>Some text</p></div>'))
 
+    def test_nested_endless_include(self):
+        """ Should detect loops further down the include tree
+        """
+        a = Page(name='Front Page', region=self.region)
+        a.content = '<a class="plugin includepage" href="Explore">dummy</a>'
+        a.save()
+        b = Page(name='Explore', region=self.region)
+        b.content = '<a class="plugin includepage" href="Parks">dummy</a>'
+        b.save()
+        c = Page(name='Parks', region=self.region)
+        c.content = '<p>Parks</p><a class="plugin includepage" href="Explore">dummy</a>'
+        c.save()
+
+        context = Context({'page': a, 'region': self.region})
+        template = Template(html_to_template_text(a.content, context))
+        html = template.render(context)
+        self.failUnless('<p>Parks</p>' in html)
+        self.failUnless(('Unable to include <a href="/test-region/Explore">Explore'
+                         '</a>: endless include loop') in html)
+
+    def test_include_depth_limit(self):
+        a = Page(name='Front Page', region=self.region)
+        a.content = '<a class="plugin includepage" href="Explore">dummy</a>'
+        a.save()
+        b = Page(name='Explore', region=self.region)
+        b.content = '<p>Explore</p><a class="plugin includepage" href="Parks">dummy</a>'
+        b.save()
+        c = Page(name='Parks', region=self.region)
+        c.content = '<p>Parks</p>'
+        c.save()
+
+        with self.settings(INCLUDE_MAX_DEPTH=2):
+            context = Context({'page': a, 'region': self.region})
+            template = Template(html_to_template_text(a.content, context))
+            html = template.render(context)
+        self.failUnless('<p>Explore</p>' in html)
+        self.failIf('<p>Parks</p>' in html)
+        self.failUnless('too many nested includes' in html)
+
+    def test_include_memoized_per_request(self):
+        a = Page(name='Front Page', region=self.region)
+        a.content = ('<a class="plugin includepage" href="Explore">dummy</a>'
+                     '<a class="plugin includepage" href="Explore">dummy</a>')
+        a.save()
+        b = Page(name='Explore', region=self.region)
+        b.content = '<p>Some text</p>'
+        b.save()
+
+        request = RequestFactory().get('/')
+        context = Context({'page': a, 'region': self.region, 'request': request})
+        template = Template(html_to_template_text(a.content, context))
+        html = template.render(context)
+        self.assertEqual(html,
+            ('<div class="included_page_wrapper"><p>Some text</p></div>'
+             '<div class="included_page_wrapper"><p>Some text</p></div>'))
+        self.assertEqual(len(request._include_memo), 1)
+        self.assertEqual(set(get_dependencies(request)),
+            set([page_key(self.region.id, b.slug), file_key(self.region.id, b.slug)]))
+
+    def test_esi_include(self):
+        a = Page(name='Front Page', region=self.region)
+        a.content = ('<a class="plugin includepage includepage_showtitle" '
+                     'href="Explore">dummy</a>')
+        a.save()
+        b = Page(name='Explore', region=self.region)
+        b.content = '<p>Some text</p>'
+        b.save()
+
+        with self.settings(PAGE_ESI_INCLUDES=True):
+            context = Context({'page': a, 'region': self.region})
+            template = Template(html_to_template_text(a.content, context))
+            html = template.render(context)
+            self.assertEqual(html,
+                ('<div class="included_page_wrapper">'
+                 '<esi:include src="/test-region/explore/_include?args=showtitle"/>'
+                 '</div>'))
+
+            request = RequestFactory().get('/test-region/explore/_include?args=showtitle')
+            response = PageIncludeFragmentView.as_view()(request,
+                region='test-region', slug='explore', original_slug='explore')
+        self.assertEqual(response.content,
+            ('<h2><a href="/test-region/Explore">Explore</a></h2>'
+             '<p>Some text</p>'))
+        self.assertTrue(response.has_header('X-KEEPME'))
+
+        # The name from the URL is never compiled as template text.
+        request = RequestFactory().get('/test-region/x/_include')
+        response = PageIncludeFragmentView.as_view()(request, region='test-region',
+            slug='x', original_slug='%}{% debug %}{%')
+        self.assertTrue('%}{% debug %}{%' in response.content)
+        self.assertFalse('sql_queries' in response.content)
+
     def test_embed_tag(self):
         html = ('<span class="plugin embed">&lt;strong&gt;Hello&lt;/strong&gt;'
                 '</span>')
@@ -799,6 +927,270 @@ class PluginTest(TestCase):
         self.assertTrue('nofollow' in rendered)
 
 
+class PageTemplateCacheTest(TestCase):
+    def setUp(self):
+        self.region = Region(full_name='Test region', slug='test-region')
+        self.region.save()
+
+    def test_same_content_reuses_template(self):
+        page = Page(name='Explore', region=self.region)
+        context = Context({'page': page, 'region': self.region})
+        html = '<p>Some <a href="Parks">text</a></p>'
+        t1 = get_page_template(html, context)
+        t2 = get_page_template(html, context)
+        self.assertTrue(t1 is t2)
+        self.assertEqual(t1.render(context), t2.render(context))
+
+    def test_key_depends_on_options(self):
+        page = Page(name='Explore', region=self.region)
+        context = Context({'page': page, 'region': self.region})
+        html = '<p>Some text</p>'
+        key = template_cache_key(html, context)
+        self.assertNotEqual(key, template_cache_key('<p>Other</p>', context))
+        self.assertNotEqual(key, template_cache_key(html, context, render_plugins=False))
+        self.assertNotEqual(key, template_cache_key(html, context, nofollow=True))
+
+        other_page = Page(name='Parks', region=self.region)
+        other_context = Context({'page': other_page, 'region': self.region})
+        self.assertNotEqual(key, template_cache_key(html, other_context))
+
+        # File URLs differ between the region and custom domain urlconfs.
+        set_urlconf('main.urls_no_region')
+        try:
+            self.assertNotEqual(key, template_cache_key(html, context))
+        finally:
+            set_urlconf(None)
+
+    def test_cached_template_renders_like_uncached(self):
+        a = Page(name='Front Page', region=self.region)
+        a.content = ('<a class="plugin includepage" href="Explore">dummy</a>'
+                     '<a href="Explore">link</a>')
+        a.save()
+
+        b = Page(name='Explore', region=self.region)
+        b.content = '<p>Some text</p>'
+        b.save()
+
+        context = Context({'page': a, 'region': self.region})
+        expected = Template(html_to_template_text(a.content, context)).render(context)
+        # Render twice, the second time coming from the cache.
+        for i in range(2):
+            context = Context({'page': a, 'region': self.region})
+            html = get_page_template(a.content, context).render(context)
+            self.assertEqual(html, expected)
+
+
+class LinkResolverTest(TestCase):
+    def setUp(self):
+        self.region = Region(full_name='Test region', slug='test-region')
+        self.region.save()
+
+    def test_resolves_links_in_bulk(self):
+        Page(name='Parks', region=self.region, content='<p>parks</p>').save()
+        Page(name='Old Parks', region=self.region, content='<p>old</p>').save()
+        p = Page.objects.get(slug='old parks', region=self.region)
+        p.rename_to('New Parks')
+
+        page = Page(name='Explore', region=self.region)
+        page.content = ('<p><a href="Parks">a</a> <a href="Parks#top">b</a> '
+                        '<a href="Old Parks">c</a> <a href="Missing">d</a> '
+                        '<a href="#anchor">e</a> <a href="http://example.org/">f</a></p>')
+        context = Context({'page': page, 'region': self.region})
+        t = Template(html_to_template_text(page.content, context))
+        resolver = LinkResolver.for_template(t, context)
+        self.assertEqual(resolver.pages['parks'], 'Parks')
+        self.assertEqual(resolver.pages['missing'], None)
+        self.assertTrue('old parks' in resolver.redirects)
+        self.assertEqual(resolver.queries, 2)
+
+    def test_render_matches_unbatched(self):
+        Page(name='Parks', region=self.region, content='<p>parks</p>').save()
+        page = Page(name='Explore', region=self.region)
+        content = '<p><a href="Parks">a</a> <a href="Missing">b</a> <a href="Parks">c</a></p>'
+
+        context = Context({'page': page, 'region': self.region})
+        expected = Template(html_to_template_text(content, context)).render(context)
+
+        request = RequestFactory().get('/')
+        template = Template("{% load pages_tags %}{% render_plugins content %}")
+        rendered = template.render(Context({'region': self.region, 'request': request,
+                                            'content': content, 'page': page}))
+        self.assertEqual(rendered, expected)
+        self.assertTrue('missing_link' in rendered)
+        # 3 page lookups + 1 redirect lookup, done in 2 queries.
+        self.assertEqual(request.link_queries_saved, 2)
+
+
+class PageArtifactTest(TestCase):
+    def setUp(self):
+        self.region = Region(full_name='Test region', slug='test-region')
+        self.region.save()
+
+    def test_artifact_matches_render(self):
+        Page(name='Parks', region=self.region, content='<p>parks</p>').save()
+        page = Page(name='Explore', region=self.region,
+                    content='<p><a href="Parks">a</a> <a href="Missing">b</a></p>')
+        page.save()
+
+        artifact = render_artifact(page, 'main.urls')
+        html, request = render_page_content(page, 'main.urls')
+        self.assertEqual(artifact.html, html)
+        self.assertTrue('missing_link' in artifact.html)
+        self.assertEqual(artifact.content_hash, artifact_content_hash(page))
+
+        page.content = '<p>Changed</p>'
+        self.assertNotEqual(artifact.content_hash, artifact_content_hash(page))
+
+    def test_artifact_dependencies(self):
+        b = Page(name='Explore', region=self.region, content='<p>Some text</p>')
+        b.save()
+        a = Page(name='Front Page', region=self.region)
+        a.content = ('<a class="plugin includepage" href="Explore">dummy</a>'
+                     '<a class="plugin includetag" href="tags/park">dummy</a>'
+                     '<img src="_files/photo.jpg"/>')
+        a.save()
+
+        artifact = render_artifact(a, 'main.urls')
+        self.assertEqual(list(artifact.depends_on_pages.all()), [b])
+        self.assertEqual(artifact.depends_on_tags, 'park')
+        self.assertEqual(artifact.depends_on_files, 'photo.jpg')
+        self.assertEqual(list(b.dependent_artifacts.all()), [artifact])
+
+    def test_file_edit_marks_artifact_stale(self):
+        page = Page(name='Explore', region=self.region,
+                    content='<img src="_files/photo.jpg"/>')
+        page.save()
+        render_artifact(page, 'main.urls')
+
+        self.assertFalse(mark_stale_after_file_edit(self.region.id, page.slug, 'other.jpg'))
+        self.assertTrue(get_page_artifact(page, 'main.urls') is not None)
+        self.assertTrue(mark_stale_after_file_edit(self.region.id, page.slug, 'photo.jpg'))
+        self.assertEqual(get_page_artifact(page, 'main.urls'), None)
+
+
+class PageAnalysisTest(TestCase):
+    def test_analysis(self):
+        html = ('<p>I love <a href="Parks">parks</a> and <a href="Parks">more parks</a>'
+                ' and <a href="http://example.org/">example</a> <a href="#top">top</a>.</p>'
+                '<a class="plugin includepage" href="Cats%20and%20dogs">include</a>'
+                '<a class="plugin includetag" href="tags%2FPARKS">tag list</a>'
+                '<img src="http://example.org/a.jpg"/>'
+                '<img src="_files/photo.jpg" style="width: 300px; height: 200px;"/>'
+                '<img src="_files/other.jpg"/>'
+                '<a href="_files/doc.pdf">doc</a>')
+        analysis = analyze_content(html)
+        self.assertEqual(analysis.internal_links, {'Parks': 2, '_files/doc.pdf': 1})
+        self.assertEqual(analysis.included_pages, ['Cats and dogs'])
+        self.assertEqual(analysis.included_tags, ['parks'])
+        self.assertEqual(analysis.external_link_count, 1)
+        self.assertEqual(analysis.local_images, ['photo.jpg', 'other.jpg'])
+        self.assertEqual(analysis.first_local_image, 'photo.jpg')
+        self.assertEqual(analysis.linked_files, ['doc.pdf'])
+        self.assertEqual((analysis.images[1].width, analysis.images[1].height), (300, 200))
+        self.assertEqual(analysis.images[0].name, None)
+        self.assertTrue(analysis.text_length > 0)
+        # Memoized by content
+        self.assertTrue(analyze_content(html) is analysis)
+
+    def test_highlight_image(self):
+        region = Region(full_name='Test region', slug='test-region')
+        region.save()
+        page = Page(name='Explore', region=region,
+                    content='<img src="_files/missing.jpg"/><img src="_files/photo.jpg"/>')
+        page.save()
+        self.assertEqual(page.get_highlight_image(), None)
+
+        pfile = PageFile(file=ContentFile("foo"), name='photo.jpg', slug=page.slug, region=region)
+        pfile.save()
+        self.assertEqual(page.get_highlight_image(), pfile)
+
+
+class ThumbnailTest(TestCase):
+    def setUp(self):
+        buf = StringIO()
+        Image.new('RGB', (300, 200), 'red').save(buf, 'PNG')
+        self.name = default.storage.save('test_thumbnails/photo.png',
+                                         ContentFile(buf.getvalue()))
+        self.backend = AutoFormatBackend()
+
+    def tearDown(self):
+        default.storage.delete(self.name)
+
+    def test_page_thumbnails(self):
+        region = Region(full_name='Test region', slug='test-region')
+        region.save()
+        page = Page(name='Explore', region=region,
+                    content=('<img src="_files/photo.jpg" style="width: 300px; height: 200px;"/>'
+                             '<img src="_files/photo.jpg" style="width: 30px; height: 20px;"/>'
+                             '<img src="_files/photo.jpg"/>'
+                             '<img src="_files/missing.jpg" style="width: 30px; height: 20px;"/>'))
+        page.save()
+        pfile = PageFile(file=ContentFile("foo"), name='photo.jpg', slug=page.slug, region=region)
+        pfile.save()
+        self.assertEqual(page_thumbnails(page),
+            [(pfile.file.name, '300x200'), (pfile.file.name, '30x20')])
+
+    @override_settings(THUMBNAIL_GENERATE_ASYNC=True)
+    def test_queued_when_async(self):
+        queued = []
+        queue_thumbnail = thumbnails.queue_thumbnail
+        thumbnails.queue_thumbnail = lambda *args: queued.append(args)
+        try:
+            thumbnail = self.backend.get_thumbnail(self.name, '30x20')
+        finally:
+            thumbnails.queue_thumbnail = queue_thumbnail
+        # The original image, until the thumbnail's generated.
+        self.assertTrue(isinstance(thumbnail, PendingThumbnail))
+        self.assertEqual(thumbnail.name, self.name)
+        self.assertEqual(queued, [(self.name, '30x20')])
+
+    @override_settings(THUMBNAIL_GENERATE_ASYNC=True)
+    def test_cached_thumbnail(self):
+        self.assertEqual(self.backend.get_cached_thumbnail(self.name, '30x20'), None)
+        thumbnail = self.backend.get_thumbnail(self.name, '30x20', generate=True)
+        self.assertEqual((thumbnail.width, thumbnail.height), (30, 20))
+        # Looked up under the name it was generated with.
+        cached = self.backend.get_cached_thumbnail(self.name, '30x20')
+        self.assertEqual(cached.name, thumbnail.name)
+        thumbnail = self.backend.get_thumbnail(self.name, '30x20')
+        self.assertFalse(isinstance(thumbnail, PendingThumbnail))
+        self.assertEqual(thumbnail.name, cached.name)
+
+    def test_alternative_resolutions(self):
+        thumbnail = self.backend.get_thumbnail(self.name, '30x20', generate=True)
+        for res, size in (('1.5x', (45, 30)), ('2x', (60, 40))):
+            name = resolution(thumbnail.name, res)
+            self.assertTrue(default.storage.exists(name))
+            self.assertEqual(Image.open(default.storage.open(name)).size, size)
+
+
+class VarnishBanTest(TestCase):
+    def test_ban_expression(self):
+        expression = ban_expression(['/oakland/Parks', '/oakland/A.B'], 'localwiki.net')
+        self.assertTrue(r'^(?i)((/oakland/A\\.B|/oakland/Parks)(/*)' in expression)
+        self.assertTrue('localwiki.net' in expression)
+
+        expression = key_ban_expression(['page:1:front%20page', 'tag:1:parks'])
+        self.assertEqual(expression,
+            r'obj.http.xkey ~ (^|\\s)(page:1:front%20page|tag:1:parks)(\\s|$)')
+
+    def test_batched_bans(self):
+        sent = []
+        dispatcher = BanDispatcher(max_urls=2)
+        dispatcher._send = sent.append
+        with dispatcher.batched():
+            dispatcher.ban('/oakland/Parks', 'localwiki.net')
+            dispatcher.ban('/oakland/Parks', 'localwiki.net')
+            dispatcher.ban('/oakland/Pools', 'localwiki.net')
+            dispatcher.ban('/oakland/Lakes', 'localwiki.net')
+            dispatcher.ban('/Lakes', 'oaklandwiki.org')
+        self.assertEqual(len(sent), 3)
+        self.assertEqual(dispatcher.stats, {'bans_issued': 3, 'urls_covered': 4})
+
+        dispatcher.ban_keys(['page:1:parks', 'page:1:pools'])
+        self.assertEqual(len(sent), 4)
+
+
 class XSSTest(TestCase):
     """ Test for tricky attempts to inject scripts into a page
     Exploits adapted from http://ha.ckers.org/xss.html
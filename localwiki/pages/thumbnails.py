@@ -0,0 +1,140 @@
+"""
+Thumbnail pre-generation.
+
+Resized images in page content are rendered as thumbnails, at 1x and at
+the alternative resolutions in THUMBNAIL_ALTERNATIVE_RESOLUTIONS (for the
+srcset).  Generating these means decoding and resizing the original
+image, which we don't want to do while rendering a page.  Instead, after a
+page is saved we queue generation of every thumbnail its content uses, and
+the render path only reads the thumbnail key-value store (see
+`utils.sorl_backends.AutoFormatBackend`).
+"""
+import hashlib
+
+from django.core.cache import cache
+
+from celery import shared_task
+from sorl.thumbnail import default
+
+from .models import Page, PageFile
+from .analysis import analyze_page
+
+# How long we wait for a queued thumbnail before queueing it again.
+PENDING_TIMEOUT = 60 * 5
+
+
+def page_thumbnails(page):
+    """
+    Returns:
+        A list of (file name, geometry string) of the thumbnails used in
+        the page content.  The file name is the name of the file in storage.
+    """
+    sizes = {}
+    for image in analyze_page(page).images:
+        if image.name and image.width and image.height:
+            sizes.setdefault(image.name, set()).add(
+                '%dx%d' % (image.width, image.height))
+    if not sizes:
+        return []
+
+    files = PageFile.objects.filter(slug=page.slug, region=page.region,
+        name__in=sizes.keys())
+    thumbnails = []
+    for f in files:
+        for geometry in sorted(sizes[f.name]):
+            thumbnails.append((f.file.name, geometry))
+    return thumbnails
+
+
+def generate_thumbnail(file_name, geometry):
+    """
+    Generates the thumbnail, and its alternative resolutions, if it
+    hasn't been generated yet.
+
+    Returns:
+        True if the thumbnail was generated.
+    """
+    if default.backend.get_cached_thumbnail(file_name, geometry) is not None:
+        return False
+    default.backend.get_thumbnail(file_name, geometry, generate=True)
+    cache.delete(_pending_key(file_name, geometry))
+    return True
+
+
+def generate_page_thumbnails(page):
+    """
+    Returns:
+        True if the page was rendered while one of its thumbnails was
+        still missing.
+    """
+    rendered_early = False
+    for file_name, geometry in page_thumbnails(page):
+        if cache.get(_pending_key(file_name, geometry)):
+            rendered_early = True
+        generate_thumbnail(file_name, geometry)
+    return rendered_early
+
+
+def _pending_key(file_name, geometry):
+    h = hashlib.sha1(('%s:%s' % (file_name, geometry)).encode('utf-8'))
+    return 'thumbnail_pending:%s' % h.hexdigest()
+
+
+def queue_thumbnail(file_name, geometry):
+    """
+    Queues the thumbnail to be generated, unless it's already queued.
+    """
+    if cache.add(_pending_key(file_name, geometry), True, PENDING_TIMEOUT):
+        _async_generate_thumbnail.delay(file_name, geometry)
+
+
+def _pages_using_file(file_name):
+    files = PageFile.objects.filter(file=file_name)
+    pages = set()
+    for f in files:
+        pages.update(Page.objects.filter(slug=f.slug, region=f.region_id))
+    return pages
+
+
+def _thumbnails_generated(pages):
+    # Pages rendered before their thumbnails were ready point at the
+    # original images, so clear them out to have them rendered again.
+    from .cache import django_invalidate_page, _async_cache_post_edit
+
+    for p in pages:
+        django_invalidate_page(p)
+        _async_cache_post_edit.delay(p)
+
+
+@shared_task(ignore_result=True)
+def _async_generate_thumbnail(file_name, geometry):
+    # Only queued when a page was rendered without this thumbnail.
+    generate_thumbnail(file_name, geometry)
+    _thumbnails_generated(_pages_using_file(file_name))
+
+
+@shared_task(ignore_result=True)
+def _async_generate_page_thumbnails(page_id):
+    try:
+        page = Page.objects.get(id=page_id)
+    except Page.DoesNotExist:
+        return
+    if generate_page_thumbnails(page):
+        _thumbnails_generated([page])
+
+
+@shared_task(ignore_result=True)
+def _async_pagefile_thumbnails(region_id, slug):
+    for page in Page.objects.filter(slug=slug, region__id=region_id):
+        if generate_page_thumbnails(page):
+            _thumbnails_generated([page])
+
+
+def _page_thumbnails_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        _async_generate_page_thumbnails.delay(instance.id)
+
+
+def _pagefile_thumbnails_changed(sender, instance, raw=False, **kwargs):
+    if not raw and instance.slug:
+        _async_pagefile_thumbnails.delay(instance.region_id, instance.slug)
@@ -132,6 +132,12 @@ urlpatterns = patterns('',
     url(r'^(?P<slug>.+)/_permissions$', slugify(PagePermissionsView.as_view()),
         name='permissions'),
 
+    ##########################################################
+    # The page as included in other pages, for edge-side includes.
+    ##########################################################
+    url(r'^(?P<slug>.+)/_include$', slugify(PageIncludeFragmentView.as_view()),
+        name='include-fragment'),
+
     ##########################################################
     # Basic page URLs.
     ##########################################################
@@ -7,7 +7,7 @@ from django.conf import settings
 from django.views.generic.base import RedirectView
 from django.contrib.auth.models import User
 from django.template import Template
-from django.template import RequestContext
+from django.template import RequestContext, Context
 from django.views.generic import (View, DetailView, ListView,
     FormView)
 from django.http import (HttpResponseNotFound, HttpResponseRedirect,
@@ -17,9 +17,11 @@ from django.contrib import messages
 from django.db import IntegrityError
 from django.shortcuts import get_object_or_404, render
 from django.utils.html import escape
+from django.utils.safestring import mark_safe
 from django.utils.http import urlquote
 from django.utils.translation import ugettext as _
 from django.utils.translation import ugettext_lazy
+from django.utils.cache import patch_response_headers
 
 from follow.models import Follow
 
@@ -29,8 +31,10 @@ from versionutils.versioning.views import UpdateView
 from versionutils.versioning.views import VersionsList
 from localwiki.utils.views import (Custom404Mixin, CreateObjectMixin,
     PermissionRequiredMixin, DeleteView, RevertView,
-    CacheMixin, NeverCacheMixin)
+    CacheMixin, NeverCacheMixin, DEFAULT_MEMCACHED_TIMEOUT)
 from localwiki.utils.urlresolvers import reverse
+from localwiki.utils.cache import (record_dependencies, get_dependencies,
+    page_key, file_key, get_region_generation, xkey_header, region_key)
 from regions.models import Region
 from regions.views import RegionMixin, region_404_response
 from maps.widgets import InfoMap
@@ -40,6 +44,7 @@ from .models import slugify, clean_name, Page, PageFile, url_to_name
 from .forms import PageForm, PageFileForm, _has_blacklist_title
 from .utils import is_user_page
 from .exceptions import PageExistsError
+from .artifacts import get_page_artifact
 
 
 class BasePageDetailView(Custom404Mixin, AddContributorsMixin, RegionMixin, DetailView):
@@ -74,7 +79,7 @@ class BasePageDetailView(Custom404Mixin, AddContributorsMixin, RegionMixin, Deta
 
         context = super(BasePageDetailView, self).get_context_data(**kwargs)
         context['region'] = self.object.region
-        context['date'] = self.object.versions.most_recent().version_info.date
+        context['date'] = self.object.last_edit_date
         if hasattr(self.object, 'mapdata'):
             # Remove the PanZoom on normal page views.
             olwidget_options = copy.deepcopy(getattr(settings,
@@ -100,6 +105,11 @@ class BasePageDetailView(Custom404Mixin, AddContributorsMixin, RegionMixin, Deta
 
 class PageDetailView(CacheMixin, BasePageDetailView):
     cache_keep_forever = True
+    # Pages are invalidated when pages they include or link to change.
+    # Serve the stale page while it's regenerated.  Edits to the page
+    # itself still clear it right away (see pages.cache).
+    cache_serve_stale = True
+    cache_warm = True
 
     @staticmethod
     def get_cache_key(*args, **kwargs):
@@ -108,8 +118,81 @@ class PageDetailView(CacheMixin, BasePageDetailView):
         urlconf = get_urlconf() or settings.ROOT_URLCONF
         slug = kwargs.get('slug')
         region = CacheMixin.get_region_slug_param(*args, **kwargs)
+        generation = get_region_generation(region, kwargs.get('request'))
         # Control characters and whitespace not allowed in memcached keys
-        return '%s/%s/%s' % (urlconf, name_to_url(region), slugify(slug).replace(' ', '_'))
+        return '%s/%s/%s/%s' % (urlconf, name_to_url(region), generation,
+            slugify(slug).replace(' ', '_'))
+
+    def get_context_data(self, **kwargs):
+        context = super(PageDetailView, self).get_context_data(**kwargs)
+        # Use the pre-rendered page content, if it's up to date.
+        artifact = get_page_artifact(self.object)
+        if artifact is not None:
+            context['rendered_content'] = mark_safe(artifact.html)
+            record_dependencies(self.request, artifact.cache_keys.split())
+        return context
+
+    def get_cache_dependencies(self):
+        region = self.get_region()
+        slug = slugify(self.kwargs.get('slug'))
+        return [page_key(region.id, slug), file_key(region.id, slug)]
+
+
+class IncludeFragmentView(RegionMixin, View):
+    """
+    Renders a single piece of included content, for use as an edge-side
+    include (see PAGE_ESI_INCLUDES).
+
+    Subclasses override get_node_class() to return the template node that
+    includes the content, and get_name().
+    """
+    def get_node_class(self):
+        raise NotImplementedError
+
+    def get_name(self):
+        raise NotImplementedError
+
+    def get_page(self, region):
+        return None
+
+    def get(self, request, *args, **kwargs):
+        region = self.get_region()
+        # Include arguments are plain words, e.g. 'showtitle'
+        args = [a for a in request.GET.get('args', '').split(',') if a.isalnum()]
+        # The name comes from the URL, so build the node directly rather
+        # than putting it into template text.
+        node = self.get_node_class().for_name(self.get_name(), args)
+        context = Context({
+            'region': region,
+            'page': self.get_page(region),
+            'request': request,
+            '_esi_fragment': True,
+            '_include_stack': [],
+            '_render_nofollow': bool(request.GET.get('nofollow')),
+        })
+        response = HttpResponse(node.render(context))
+        # Kept around until the included content changes, see
+        # pages.cache.purge
+        response['X-KEEPME'] = True
+        response['xkey'] = xkey_header(
+            get_dependencies(request) + [region_key(region.slug)])
+        patch_response_headers(response, DEFAULT_MEMCACHED_TIMEOUT)
+        return response
+
+
+class PageIncludeFragmentView(IncludeFragmentView):
+    def get_node_class(self):
+        from .templatetags.pages_tags import IncludePageNode
+        return IncludePageNode
+
+    def get_name(self):
+        return url_to_name(self.kwargs['original_slug'])
+
+    def get_page(self, region):
+        try:
+            return Page.objects.get(slug=self.kwargs['slug'], region=region)
+        except Page.DoesNotExist:
+            return Page(name=self.get_name(), slug=self.kwargs['slug'], region=region)
 
 
 class PageVersionDetailView(BasePageDetailView):
@@ -430,6 +513,9 @@ class PageCompareView(CacheMixin, RegionMixin, diff.views.CompareView):
         context['page_diff'] = diff.diff(context['old'], context['new'])
         return context
 
+    def get_cache_dependencies(self):
+        return [page_key(self.get_region().id, slugify(self.kwargs['slug']))]
+
     @staticmethod
     def get_cache_key(*args, **kwargs):
         from django.core.urlresolvers import get_urlconf
@@ -4,7 +4,7 @@ from rest_framework_gis.filters import GeoFilterSet
 
 from main.api import router
 from main.api.filters import HistoricalFilter
-from main.api.views import AllowFieldLimitingMixin
+from main.api.views import AllowFieldLimitingMixin, ArchivedHistoryMixin
 from pages.models import Page
 from pages.api import PageFilter, PagePermissionsMixin
 from regions.api import RegionFilter
@@ -100,7 +100,7 @@ class RedirectViewSet(RedirectPermissionsMixin, AllowFieldLimitingMixin, viewset
     ordering_fields = ('source',)
 
 
-class HistoricalRedirectViewSet(AllowFieldLimitingMixin, viewsets.ReadOnlyModelViewSet):
+class HistoricalRedirectViewSet(ArchivedHistoryMixin, AllowFieldLimitingMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint that allows redirect history to be viewed.
 
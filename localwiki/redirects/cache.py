@@ -0,0 +1,116 @@
+"""
+In-memory index of redirects.
+
+Redirects only kick in on 404s (see `RedirectFallbackMiddleware`), and
+most 404s, e.g. from crawlers, have no redirect.  We keep each region's
+redirect sources, along with where they point, in memory so looking up a
+redirect doesn't touch the database.
+
+A region's index is loaded the first time it's needed.  Saving or
+deleting a redirect in the region drops it and, once the change has
+committed, bumps the region's shared version number so other processes
+drop theirs, too.  In case a bump is lost, e.g. if memcached restarts,
+indexes are reloaded every INDEX_TIMEOUT seconds regardless.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.urlresolvers import get_urlconf
+
+from utils.transactions import on_commit
+
+VERSION_TIMEOUT = 60 * 60 * 24 * 29
+INDEX_TIMEOUT = 60 * 10
+
+_lock = threading.Lock()
+# region id -> {'version': .., 'loaded_at': ..,
+#               'redirects': {source: (page id, page name)},
+#               'urls': {urlconf: {source: url}}}
+_indexes = {}
+
+
+def _version_key(region_id):
+    return 'redirects_version:%s' % region_id
+
+
+def _load(region_id):
+    from .models import Redirect
+
+    redirects = {}
+    for source, page_id, page_name in Redirect.objects.filter(
+            region__id=region_id).values_list(
+            'source', 'destination__id', 'destination__name'):
+        redirects[source] = (page_id, page_name)
+    return redirects
+
+
+def _get_index(region_id):
+    version = cache.get(_version_key(region_id))
+    index = _indexes.get(region_id)
+    if (index is None or index['version'] != version or
+            time.time() - index['loaded_at'] > INDEX_TIMEOUT):
+        index = {'version': version, 'loaded_at': time.time(),
+                 'redirects': _load(region_id), 'urls': {}}
+        with _lock:
+            _indexes[region_id] = index
+    return index
+
+
+def redirect_url(region, slug):
+    """
+    Returns:
+        The URL of the page the redirect from `slug` in `region` points
+        to, or None if there's no such redirect.
+    """
+    from pages.models import page_url
+
+    index = _get_index(region.id)
+    if slug not in index['redirects']:
+        return None
+    # Page URLs differ between the main site and a region's own domain.
+    urlconf = get_urlconf() or settings.ROOT_URLCONF
+    urls = index['urls'].setdefault(urlconf, {})
+    url = urls.get(slug)
+    if url is None:
+        page_id, page_name = index['redirects'][slug]
+        url = urls[slug] = page_url(page_name, region)
+    return url
+
+
+def invalidate(region_id):
+    """
+    Drops the region's index in this and, once the current transaction
+    has committed, every other process.
+    """
+    with _lock:
+        _indexes.pop(region_id, None)
+    # Bumped before the commit, another process could reload the old
+    # redirects and keep them.
+    on_commit(_bump_version, region_id)
+
+
+def _bump_version(region_id):
+    with _lock:
+        _indexes.pop(region_id, None)
+    key = _version_key(region_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Key doesn't exist yet.  Start from the current time so we never
+        # go back to a version another process has already seen.
+        cache.set(key, int(time.time()), VERSION_TIMEOUT)
+
+
+def _redirect_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        invalidate(instance.region_id)
+
+
+def _page_changed(sender, instance, raw=False, **kwargs):
+    from .models import Redirect
+
+    # Renaming a page changes the URL of the redirects pointing at it.
+    if not raw and Redirect.objects.filter(destination=instance).exists():
+        invalidate(instance.region_id)
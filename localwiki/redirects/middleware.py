@@ -4,9 +4,9 @@ from django.http import HttpResponseRedirect
 from django.conf import settings
 
 from pages.models import slugify
-from regions.models import Region
+from regions.resolver import region_for_slug, region_for_domain
 
-from models import Redirect
+from cache import redirect_url
 
 
 def _is_redirect(response):
@@ -40,8 +40,6 @@ class RedirectFallbackMiddleware(object):
             # force-displayed.
             return response
 
-        r = None
-
         re_match = page_routing_pattern.match(request.get_full_path())
         if not re_match:
             return response
@@ -50,23 +48,16 @@ class RedirectFallbackMiddleware(object):
 
         if request.META['HTTP_HOST'].endswith(settings.MAIN_HOSTNAME):
             region_slug = re_match.group('region')
-            region = Region.objects.filter(slug=region_slug)
+            region = region_for_slug(region_slug, request)
         else:
-            region = Region.objects.filter(regionsettings__domain=request.META['HTTP_HOST'])
+            region = region_for_domain(request.META['HTTP_HOST'], request)
 
-        if not region:
+        if region is None:
             return response
-        region = region[0]
-
-        try:
-            r = Redirect.objects.get(source=slug, region=region)
-        except Redirect.DoesNotExist:
-            pass
-        if r is not None:
-            return HttpResponseRedirect(
-                r.destination.get_absolute_url() +
-                '?&redirected_from=%s' % slug
-            )
+
+        url = redirect_url(region, slug)
+        if url is not None:
+            return HttpResponseRedirect(url + '?&redirected_from=%s' % slug)
 
         # No redirect was found. Return the response.
         return response
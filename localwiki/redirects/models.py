@@ -1,6 +1,6 @@
 from django.utils.translation import ugettext as _
 from django.db import models
-from django.db.models.signals import pre_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.core.urlresolvers import reverse
 
 from pages.models import Page, validate_page_slug
@@ -36,5 +36,12 @@ def _validate_redirect(sender, instance, raw, **kws):
 
 pre_save.connect(_validate_redirect, sender=Redirect)
 
+# Keep the in-memory redirect index up to date.
+from .cache import _redirect_changed, _page_changed
+
+post_save.connect(_redirect_changed, sender=Redirect)
+post_delete.connect(_redirect_changed, sender=Redirect)
+post_save.connect(_page_changed, sender=Page)
+
 # For registration calls
 import feeds
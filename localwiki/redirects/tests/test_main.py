@@ -1,10 +1,18 @@
+from django.core.urlresolvers import set_urlconf
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.http import HttpResponse
 
 from pages.models import Page
 from regions.models import Region
 
+from utils.middleware import OnCommitMiddleware
+from utils.transactions import deferred_until_commit
+
 from .. models import Redirect
 from .. import exceptions
+from .. import cache as redirects_cache
+from ..cache import redirect_url
 
 
 class RedirectTest(TestCase):
@@ -17,3 +25,59 @@ class RedirectTest(TestCase):
         p.save()
         r = Redirect(source='foobar', destination=p, region=self.region)
         self.assertRaises(exceptions.RedirectToSelf, r.save)
+
+    def test_redirect_url(self):
+        p = Page(name="Foo Bar", content="<p>foobar</p>", region=self.region)
+        p.save()
+        self.assertEqual(redirect_url(self.region, 'old foo'), None)
+
+        r = Redirect(source='old foo', destination=p, region=self.region)
+        r.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(redirect_url(self.region, 'old foo'),
+                             p.get_absolute_url())
+            self.assertEqual(redirect_url(self.region, 'nothing here'), None)
+
+        r.delete()
+        self.assertEqual(redirect_url(self.region, 'old foo'), None)
+
+    def test_redirect_url_urlconf(self):
+        p = Page(name="Foo Bar", content="<p>foobar</p>", region=self.region)
+        p.save()
+        Redirect(source='old foo', destination=p, region=self.region).save()
+        self.assertEqual(redirect_url(self.region, 'old foo'), '/test_region/Foo_Bar')
+
+        # E.g. on the region's own domain.
+        set_urlconf('main.urls_no_region')
+        try:
+            self.assertEqual(redirect_url(self.region, 'old foo'), '/Foo_Bar')
+        finally:
+            set_urlconf(None)
+
+    def test_invalidated_before_commit(self):
+        p = Page(name="Foo Bar", content="<p>foobar</p>", region=self.region)
+        p.save()
+        self.assertEqual(redirect_url(self.region, 'old foo'), None)
+        with deferred_until_commit():
+            Redirect(source='old foo', destination=p, region=self.region).save()
+            # Only other processes wait for the commit.
+            self.assertEqual(redirect_url(self.region, 'old foo'),
+                             p.get_absolute_url())
+
+    def test_bumped_after_request(self):
+        p = Page(name="Foo Bar", content="<p>foobar</p>", region=self.region)
+        p.save()
+        bumped = []
+        bump_version = redirects_cache._bump_version
+        redirects_cache._bump_version = bumped.append
+        middleware = OnCommitMiddleware()
+        request = RequestFactory().get('/')
+        try:
+            middleware.process_request(request)
+            Redirect(source='old foo', destination=p, region=self.region).save()
+            # Other processes keep their index until the request commits.
+            self.assertEqual(bumped, [])
+            middleware.process_response(request, HttpResponse())
+            self.assertEqual(bumped, [self.region.id])
+        finally:
+            redirects_cache._bump_version = bump_version
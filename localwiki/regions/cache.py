@@ -0,0 +1,36 @@
+from localwiki.utils.cache import bump_region_generation, region_key
+from utils.transactions import on_commit
+
+from . import resolver
+
+
+def invalidate_region(region):
+    """
+    Invalidates every cached page, tag list, map and front page of the
+    region, in memcached and in Varnish, once the current transaction has
+    committed.
+    """
+    on_commit(_invalidate_region, region.slug)
+
+
+def _invalidate_region(region_slug):
+    from pages.cache import ban_dispatcher
+
+    bump_region_generation(region_slug)
+    ban_dispatcher.ban_keys([region_key(region_slug)])
+
+
+def _region_cache_post_save(sender, instance, created, raw, **kwargs):
+    resolver.clear()
+    if raw or created:
+        return
+    invalidate_region(instance)
+
+def _region_settings_cache_post_save(sender, instance, created, raw, **kwargs):
+    resolver.clear()
+    if raw:
+        return
+    invalidate_region(instance.region)
+
+def _region_cache_post_delete(sender, instance, **kwargs):
+    resolver.clear()
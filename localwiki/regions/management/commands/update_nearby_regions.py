@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from regions.models import Region
+from regions.nearby import compute_nearby_regions
+
+
+class Command(BaseCommand):
+    help = ('Recomputes the nearby regions of every region.\n'+
+           'Usage: localwiki-manage update_nearby_regions')
+
+    def handle(self, *args, **options):
+        n = 0
+        for region in Region.objects.select_related('regionsettings').iterator():
+            compute_nearby_regions(region)
+            n += 1
+
+        self.stdout.write('Updated the nearby regions of %d regions.\n' % n)
@@ -4,7 +4,8 @@ from django.http import HttpResponsePermanentRedirect
 from django.conf import settings
 from django.utils.http import urlquote
 
-from models import Region
+from resolver import region_for_slug
+from routing import route
 
 region_routing_pattern = re.compile(
     '^/(?P<region>[^/]+?)(/(?P<rest>.*))?$'
@@ -13,6 +14,19 @@ region_routing_pattern = re.compile(
 LANGUAGES = [i[0] for i in settings.LANGUAGES]
 
 
+class HostRoutingMiddleware(object):
+    """
+    Routes requests on the custom domain of a region to the region's
+    urlconf, and keeps the route (see `regions.routing.route`) on the
+    request as `host_route`.  Should come right after django_hosts'
+    middleware.
+    """
+    def process_request(self, request):
+        request.host_route = route(request.META.get('HTTP_HOST', ''), request)
+        if request.host_route is not None:
+            request.urlconf = request.host_route['urlconf']
+
+
 class RedirectToLanguageSubdomainMiddleware(object):
     """
     Redirect to the language-specific subdomain associated with this
@@ -25,10 +39,9 @@ class RedirectToLanguageSubdomainMiddleware(object):
             return
 
         region_slug = re_match.group('region')
-        rs = Region.objects.filter(slug=region_slug)
-        if not rs:
+        region = region_for_slug(region_slug, request)
+        if region is None:
             return
-        region = rs[0]
 
         if not hasattr(region, 'regionsettings'):
             region_lang = settings.LANGUAGE_CODE
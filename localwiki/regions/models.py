@@ -3,7 +3,6 @@ import unicodedata
 from urllib import unquote_plus
 
 from django.db import IntegrityError
-from django.db.models import Count
 from django.conf import settings
 from django.utils.translation import ugettext as _
 from django.utils.translation import ugettext_lazy
@@ -43,26 +42,25 @@ class Region(models.Model):
         populate_region(self)
 
     def get_nearby_regions(self, limit=6, show_emptyish_regions=False):
-        # XXX CACHE
+        """
+        Returns the nearest active regions, nearest first, from the
+        precomputed NearbyRegion table (see `regions.nearby`).
+        """
+        from .nearby import MIN_PAGES
+
         if not self.geom:
             return
-        center = self.geom.centroid
-        rgs = Region.objects.exclude(geom__isnull=True).exclude(id=self.id).exclude(regionsettings__is_meta_region=True).exclude(is_active=False).distance(center).order_by('distance')
-        # Return 6 nearest now. TODO: Rank by page count?
+        # All in one filter() call, so we only join NearbyRegion once.
+        if limit is not None and not show_emptyish_regions:
+            rgs = Region.objects.filter(nearby_of__region=self,
+                nearby_of__rank__isnull=False,
+                nearby_of__num_pages__gte=MIN_PAGES)
+        else:
+            rgs = Region.objects.filter(nearby_of__region=self,
+                nearby_of__rank__isnull=False)
+        rgs = rgs.order_by('nearby_of__rank')
         if limit is not None:
-            # Buffer by 10 to allow the num_pages filter to drop some, if needed
-            rgs_ids = [r.id for r in rgs[:limit+10]]
-            rgs = Region.objects.filter(id__in=rgs_ids).annotate(num_pages=Count('page'))
-            # Region must have at least 5 pages to show up here
-            rgs = rgs.filter(num_pages__gte=5)
-    
-            # Preserve original distance order
-            good_regions_ids = [r.id for r in rgs]
-            ids = [i for i in rgs_ids if i in good_regions_ids]
-    
-            rgs = [Region.objects.get(id=i) for i in ids]
             rgs = rgs[:limit]
-    
         return rgs
 
     def is_admin(self, user):
@@ -118,6 +116,29 @@ class BannedFromRegion(models.Model):
         return 'banned users on %s' % str(self.region)
 
 
+class NearbyRegion(models.Model):
+    """
+    A region near `region`.  Precomputed, see `regions.nearby`.
+    """
+    region = models.ForeignKey(Region, related_name='nearby_regions')
+    nearby = models.ForeignKey(Region, related_name='nearby_of')
+    # Position among the nearest active regions of `region`, or None if
+    # `nearby` is only within NEARBY_TAG_RADIUS.
+    rank = models.IntegerField(null=True, blank=True)
+    # In meters, between `nearby` and the center of `region`.
+    distance = models.FloatField(null=True, blank=True)
+    num_pages = models.IntegerField(default=0)
+    # Whether the centers of the two regions are within NEARBY_TAG_RADIUS
+    # of each other, so tags in `nearby` are listed in `region`.
+    within_tag_radius = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ('region', 'nearby')
+
+    def __unicode__(self):
+        return '%s near %s' % (self.nearby, self.region)
+
+
 SLUGIFY_KEEP = r"\.-"
 SLUGIFY_MISC_CHARS = re.compile(('[^\w\s%s]' % SLUGIFY_KEEP), re.UNICODE)
 def slugify(value):
@@ -0,0 +1,135 @@
+"""
+Nearby regions.
+
+For each region we keep, in the NearbyRegion table, its nearest active
+regions along with their page counts, and the regions whose centers are
+within NEARBY_TAG_RADIUS of its own (their tags are listed on the
+region's tag pages).  Finding these takes distance queries over every
+region, so we do it when a region's geometry or settings change rather
+than when rendering pages.
+"""
+from django.conf import settings
+from django.db.models import Count
+
+from celery import shared_task
+
+from .models import Region, RegionSettings, NearbyRegion
+
+# Regions with fewer pages aren't listed as nearby regions.
+MIN_PAGES = 5
+
+# __dwithin=(center, 0.5) means: all objects within
+# 1 degree of center. This is roughly 60 miles. This will vary slightly as we move around the earth,
+# but the complexity of fixing this here is too great. Not a huge deal
+# for this particular case. The real fix here is to:
+#
+#   1.) Use a geometry column instead of the default geography column type or
+#   2.) Figure out how to case to a geometry column for this query, or
+#   3.) Write a method that, given a point, finds the correct UTM_N projection,
+#       then projects the center point into that UTM_N, then buffers by meters
+#       around the point, and then finally does a __within= on the queryset. Whew.
+NEARBY_TAG_RADIUS = 0.5
+
+
+def _nearest_count():
+    # Enough to fill the nearby regions bar after dropping regions with
+    # few pages.
+    return getattr(settings, 'NEARBY_REGIONS_COUNT', 16)
+
+
+def compute_nearby_regions(region):
+    """
+    Recomputes the nearby regions of `region`.
+
+    Returns:
+        The ids of the nearby regions.
+    """
+    rows = {}
+    if region.geom:
+        center = region.geom.centroid
+        nearest = Region.objects.exclude(geom__isnull=True).exclude(id=region.id).\
+            exclude(regionsettings__is_meta_region=True).exclude(is_active=False).\
+            distance(center).order_by('distance')
+        for rank, r in enumerate(nearest[:_nearest_count()]):
+            rows[r.id] = {'rank': rank, 'distance': r.distance.m}
+
+    try:
+        center = region.regionsettings.region_center
+    except RegionSettings.DoesNotExist:
+        center = None
+    if center is not None:
+        within = Region.objects.exclude(id=region.id).filter(
+            regionsettings__region_center__dwithin=(center, NEARBY_TAG_RADIUS))
+        for region_id in within.values_list('id', flat=True):
+            rows.setdefault(region_id, {})['within_tag_radius'] = True
+
+    num_pages = dict(Region.objects.filter(id__in=rows.keys()).annotate(
+        num_pages=Count('page')).values_list('id', 'num_pages'))
+
+    NearbyRegion.objects.filter(region=region).delete()
+    NearbyRegion.objects.bulk_create([
+        NearbyRegion(region=region, nearby_id=region_id,
+                     num_pages=num_pages.get(region_id, 0), **row)
+        for region_id, row in rows.iteritems()
+    ])
+    return set(rows)
+
+
+def update_nearby_regions(region):
+    """
+    Recomputes the nearby regions of `region` and of the regions it's, or
+    is now, near.
+    """
+    affected = set(NearbyRegion.objects.filter(nearby=region).values_list(
+        'region', flat=True))
+    affected.update(compute_nearby_regions(region))
+    for r in Region.objects.filter(id__in=affected).select_related('regionsettings'):
+        compute_nearby_regions(r)
+
+
+def update_page_count(region_id):
+    from pages.models import Page
+
+    NearbyRegion.objects.filter(nearby__id=region_id).update(
+        num_pages=Page.objects.filter(region__id=region_id).count())
+
+
+@shared_task(ignore_result=True)
+def _async_update_nearby_regions(region_id, affected=None):
+    try:
+        region = Region.objects.get(id=region_id)
+    except Region.DoesNotExist:
+        # Deleted, recompute the regions it was near.
+        for r in Region.objects.filter(id__in=affected or []):
+            compute_nearby_regions(r)
+        return
+    update_nearby_regions(region)
+
+
+@shared_task(ignore_result=True)
+def _async_update_page_count(region_id):
+    update_page_count(region_id)
+
+
+def _region_settings_nearby_post_save(sender, instance, created, raw, **kwargs):
+    # Region saves also save their RegionSettings (see
+    # regions.signals.setup_region_settings), so this covers changes to
+    # the region's geometry and activity, too.
+    if not raw:
+        _async_update_nearby_regions.delay(instance.region_id)
+
+def _region_nearby_pre_delete(sender, instance, **kwargs):
+    # The rows go away with the region, so find the regions it's near now.
+    instance._nearby_affected = list(NearbyRegion.objects.filter(
+        nearby=instance).values_list('region', flat=True))
+
+def _region_nearby_post_delete(sender, instance, **kwargs):
+    _async_update_nearby_regions.delay(instance.id,
+        getattr(instance, '_nearby_affected', None))
+
+def _page_nearby_post_save(sender, instance, created, raw, **kwargs):
+    if created and not raw:
+        _async_update_page_count.delay(instance.region_id)
+
+def _page_nearby_post_delete(sender, instance, **kwargs):
+    _async_update_page_count.delay(instance.region_id)
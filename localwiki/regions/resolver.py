@@ -0,0 +1,169 @@
+"""
+Region resolver.
+
+Looking up the region for a request, by its slug or by the custom domain
+it's served on, happens in several middlewares and view mixins.  We do
+the lookup once per process, keeping the regions (along with their
+RegionSettings) in a small LRU cache, and once per request, keeping what
+we found on the request.  Slugs without a region, e.g. from crawlers
+trying random paths, are remembered separately, in a smaller cache and
+only for MISS_TIMEOUT seconds, so they can't push out the real regions.
+
+Saving or deleting a Region or RegionSettings clears the process cache
+and, once the change has committed, bumps a shared version number, so
+other processes clear theirs the next time they handle a request.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+from utils.transactions import on_commit
+
+VERSION_KEY = 'region_resolver:version'
+VERSION_TIMEOUT = 60 * 60 * 24 * 29
+
+# Most slugs without a region we remember, and for how long.
+MISS_CACHE_SIZE = 100
+MISS_TIMEOUT = 60
+
+_lock = threading.Lock()
+_regions = OrderedDict()
+# slug -> when we stop trusting that it has no region
+_misses = OrderedDict()
+_version = None
+
+
+def _max_size():
+    return getattr(settings, 'REGION_RESOLVER_CACHE_SIZE', 1000)
+
+
+def _clear():
+    # Call with the lock held.
+    _regions.clear()
+    _misses.clear()
+
+
+def current_version(request=None):
+    """
+    Returns:
+        The shared version number of the regions.  Looked up once per
+        `request`.
+    """
+    if request is not None and hasattr(request, '_region_version'):
+        return request._region_version
+    version = cache.get(VERSION_KEY)
+    if request is not None:
+        request._region_version = version
+    return version
+
+
+def _check_version(request):
+    """
+    Clears the process cache if regions changed in another process.
+    """
+    global _version
+
+    version = current_version(request)
+    with _lock:
+        if version != _version:
+            _clear()
+            _version = version
+    if request is not None and not hasattr(request, '_regions'):
+        request._regions = {}
+
+
+def _lookup(slug):
+    from .models import Region
+
+    regions = Region.objects.filter(slug=slug).select_related('regionsettings')
+    regions = list(regions[:1])
+    return regions[0] if regions else None
+
+
+def _resolve(slug, request):
+    _check_version(request)
+    memo = getattr(request, '_regions', None)
+    if memo is not None and slug in memo:
+        return memo[slug]
+
+    with _lock:
+        found = slug in _regions
+        if found:
+            region = _regions.pop(slug)
+            # Most recently used last.
+            _regions[slug] = region
+        elif _misses.get(slug, 0) > time.time():
+            found, region = True, None
+    if not found:
+        region = _lookup(slug)
+        with _lock:
+            if region is None:
+                _misses.pop(slug, None)
+                _misses[slug] = time.time() + MISS_TIMEOUT
+                while len(_misses) > MISS_CACHE_SIZE:
+                    _misses.popitem(last=False)
+            else:
+                _regions[slug] = region
+                while len(_regions) > _max_size():
+                    _regions.popitem(last=False)
+
+    if region is not None:
+        # Don't share the instances between threads, or let views that
+        # modify them change what we have cached.
+        region = copy.copy(region)
+        region_settings = getattr(region, '_regionsettings_cache', None)
+        if region_settings is not None:
+            region._regionsettings_cache = copy.copy(region_settings)
+    if memo is not None:
+        memo[slug] = region
+    return region
+
+
+def region_for_slug(slug, request=None):
+    """
+    Returns:
+        The Region with the given slug, or None.
+    """
+    return _resolve(slug, request)
+
+
+def region_for_domain(domain, request=None):
+    """
+    Returns:
+        The Region served on the given custom domain (see
+        `regions.routing`), or None.
+    """
+    from .routing import route
+
+    host_route = route(domain, request)
+    if host_route is None:
+        return None
+    return region_for_slug(host_route['region_slug'], request)
+
+
+def clear():
+    """
+    Clears the resolved regions in this and, once the current transaction
+    has committed, every other process.
+    """
+    with _lock:
+        _clear()
+    # Bumped before the commit, another process could reload the old
+    # regions and keep them.
+    on_commit(_bump_version)
+
+
+def _bump_version():
+    with _lock:
+        # Other threads may have resolved the old regions in the meantime.
+        _clear()
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        # Key doesn't exist yet.  Start from the current time so we never
+        # go back to a version another process has already seen.
+        cache.set(VERSION_KEY, int(time.time()), VERSION_TIMEOUT)
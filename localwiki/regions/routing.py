@@ -0,0 +1,83 @@
+"""
+Host routing for regions served on their own domain.
+
+The domains in RegionSettings are loaded into an in-memory table mapping
+each domain to its region, so routing a request on a custom domain is a
+dictionary lookup.  Like `SubdomainLanguageMiddleware`, a language code
+in front of the domain (e.g. fr.example.org) picks the language.
+
+The table is reloaded when regions change, following the shared version
+number bumped by `regions.resolver.clear()` once the change has committed.
+"""
+import threading
+
+from django.conf import settings
+
+from . import resolver
+
+NO_REGION_URLCONF = 'main.urls_no_region'
+
+LANGUAGES = [i[0] for i in settings.LANGUAGES]
+
+_lock = threading.Lock()
+_table = None
+_version = None
+
+
+def load():
+    """
+    Returns:
+        A dictionary mapping each custom domain to a tuple (region id,
+        region slug).
+    """
+    from .models import RegionSettings
+
+    table = {}
+    domains = RegionSettings.objects.exclude(domain=None).exclude(domain='')
+    for domain, region_id, region_slug in domains.values_list(
+            'domain', 'region__id', 'region__slug'):
+        table[domain.lower()] = (region_id, region_slug)
+    return table
+
+
+def get_table(request=None):
+    global _table, _version
+
+    # Read before loading: if regions change while we load, the next
+    # request sees the new version and loads again.
+    version = resolver.current_version(request)
+    if _table is None or version != _version:
+        table = load()
+        with _lock:
+            _table, _version = table, version
+    return _table
+
+
+def route(host, request=None):
+    """
+    Returns:
+        A dictionary with the `region_id`, `region_slug`, `language` and
+        `urlconf` for requests on `host`, or None if `host` isn't a custom
+        domain.
+    """
+    table = get_table(request)
+    host = host.lower()
+    hostname = host.split(':')[0]
+    language = settings.LANGUAGE_CODE
+
+    domain = host if host in table else hostname
+    if domain not in table:
+        parts = hostname.split('.', 1)
+        if len(parts) < 2 or parts[0] not in LANGUAGES:
+            return None
+        language, domain = parts
+        if domain not in table:
+            return None
+
+    region_id, region_slug = table[domain]
+    return {
+        'region_id': region_id,
+        'region_slug': region_slug,
+        'language': language,
+        'urlconf': NO_REGION_URLCONF,
+    }
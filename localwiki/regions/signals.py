@@ -1,9 +1,13 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, pre_delete, post_delete
 
 from frontpage.models import FrontPage
 
 from .models import Region, RegionSettings
 from .map_utils import get_zoom_for_extent
+from .cache import (_region_cache_post_save, _region_settings_cache_post_save,
+    _region_cache_post_delete)
+from .nearby import (_region_settings_nearby_post_save,
+    _region_nearby_pre_delete, _region_nearby_post_delete)
 
 
 def setup_region_settings(sender, instance, created, raw, **kwargs):
@@ -37,3 +41,10 @@ def create_front_page(sender, instance, created, raw, **kwargs):
 
 post_save.connect(setup_region_settings, sender=Region)
 post_save.connect(create_front_page, sender=Region)
+post_save.connect(_region_cache_post_save, sender=Region)
+post_save.connect(_region_settings_cache_post_save, sender=RegionSettings)
+post_delete.connect(_region_cache_post_delete, sender=Region)
+post_delete.connect(_region_cache_post_delete, sender=RegionSettings)
+post_save.connect(_region_settings_nearby_post_save, sender=RegionSettings)
+pre_delete.connect(_region_nearby_pre_delete, sender=Region)
+post_delete.connect(_region_nearby_post_delete, sender=Region)
@@ -1,15 +1,26 @@
+from django.conf import settings
 from django.test import TestCase
 from django.core.files.base import ContentFile
 from django.contrib.gis.geos import GEOSGeometry
 from django.contrib.auth.models import User
+from django.test.client import RequestFactory
+from django.http import HttpResponse
 
-from regions.models import Region, RegionSettings, BannedFromRegion
+from regions.models import Region, RegionSettings, BannedFromRegion, NearbyRegion
 from pages.models import Page, PageFile
 from maps.models import MapData
 from redirects.models import Redirect
 from tags.models import Tag, PageTagSet
 
+from utils.middleware import SubdomainLanguageMiddleware, OnCommitMiddleware
+from utils.transactions import deferred_until_commit
+
+from .. import resolver
 from .. utils import move_to_region
+from ..resolver import region_for_slug, region_for_domain
+from ..routing import route
+from ..middleware import HostRoutingMiddleware
+from ..nearby import MIN_PAGES, compute_nearby_regions, update_page_count
 
 
 class MoveRegionTests(TestCase):
@@ -172,6 +183,34 @@ class MoveRegionTests(TestCase):
             self.assertEqual(link.destination, None)
             self.assertEqual(link.region, self.oak)
 
+    def test_move_coalesces_signals(self):
+        from django.db.models.signals import post_save
+
+        pages = []
+        for name in ("Page One", "Page Two"):
+            p = Page(region=self.sf, name=name, content="<p>A page.</p>")
+            p.save()
+            pages.append(p)
+
+        saved = []
+        def _page_saved(sender, instance, **kwargs):
+            saved.append(instance.id)
+        post_save.connect(_page_saved, sender=Page)
+        progress = []
+        try:
+            stats = move_to_region(self.oak, pages=pages,
+                progress=lambda done, total: progress.append((done, total)))
+        finally:
+            post_save.disconnect(_page_saved, sender=Page)
+
+        # One post_save per moved page, delivered after the move.
+        self.assertEqual(sorted(saved), sorted([p.id for p in pages]))
+        self.assertEqual(stats['pages'], 2)
+        # Both pages and both of their versions.
+        self.assertEqual(stats['rows'], 4)
+        self.assertEqual(progress[-1], (4, 4))
+        self.assertEqual(Page.versions.filter(region=self.oak).count(), 2)
+
 
 class RegionPermissionTests(TestCase):
     def setUp(self):
@@ -207,3 +246,125 @@ class RegionPermissionTests(TestCase):
 
         redirect = Redirect(source="testsource", destination=p, region=self.sf)
         self.assertFalse(self.marina.has_perm('redirects.change_redirect', redirect))
+
+
+class RegionResolverTests(TestCase):
+    def setUp(self):
+        self.sf = Region(full_name="San Francisco", slug="sf")
+        self.sf.save()
+        self.sf.regionsettings.domain = 'sf.example.org'
+        self.sf.regionsettings.save()
+
+    def test_resolve(self):
+        request = RequestFactory().get('/sf/')
+        self.assertEqual(region_for_slug('sf', request), self.sf)
+        self.assertEqual(region_for_domain('sf.example.org', request), self.sf)
+        self.assertEqual(region_for_slug('oak', request), None)
+
+        # Resolved regions are kept around, along with their settings.
+        request = RequestFactory().get('/sf/')
+        with self.assertNumQueries(0):
+            region = region_for_slug('sf', request)
+            self.assertEqual(region.regionsettings.domain, 'sf.example.org')
+            self.assertEqual(region_for_slug('oak', request), None)
+
+    def test_misses_kept_apart(self):
+        region_for_slug('sf')
+        for i in range(resolver.MISS_CACHE_SIZE + 10):
+            self.assertEqual(region_for_slug('nothing-%d' % i), None)
+        # Misses don't push out real regions.
+        with self.assertNumQueries(0):
+            self.assertEqual(region_for_slug('sf'), self.sf)
+        self.assertEqual(len(resolver._misses), resolver.MISS_CACHE_SIZE)
+
+    def test_cleared_on_save(self):
+        self.assertEqual(region_for_slug('oak'), None)
+        oak = Region(full_name="Oakland", slug="oak")
+        oak.save()
+        self.assertEqual(region_for_slug('oak'), oak)
+
+        self.sf.full_name = "SF"
+        self.sf.save()
+        self.assertEqual(region_for_slug('sf').full_name, "SF")
+
+    def test_cleared_before_commit(self):
+        with deferred_until_commit():
+            self.sf.full_name = "SF"
+            self.sf.save()
+            # Only other processes wait for the commit.
+            self.assertEqual(region_for_slug('sf').full_name, "SF")
+
+    def test_bumped_after_request(self):
+        bumped = []
+        bump_version = resolver._bump_version
+        resolver._bump_version = lambda: bumped.append(True)
+        middleware = OnCommitMiddleware()
+        request = RequestFactory().get('/')
+        try:
+            middleware.process_request(request)
+            self.sf.full_name = "SF"
+            self.sf.save()
+            # Other processes keep their regions until the request commits.
+            self.assertEqual(bumped, [])
+            middleware.process_response(request, HttpResponse())
+            self.assertEqual(bumped, [True])
+        finally:
+            resolver._bump_version = bump_version
+
+    def test_host_routing(self):
+        host_route = route('sf.example.org')
+        self.assertEqual(host_route['region_slug'], 'sf')
+        self.assertEqual(host_route['urlconf'], 'main.urls_no_region')
+        self.assertEqual(route('SF.example.org:8000')['region_id'], self.sf.id)
+        self.assertEqual(route('fr.sf.example.org')['language'], 'fr')
+        self.assertEqual(route('xx.sf.example.org'), None)
+        self.assertEqual(route(settings.MAIN_HOSTNAME), None)
+
+        self.sf.regionsettings.domain = 'sanfrancisco.example.org'
+        self.sf.regionsettings.save()
+        self.assertEqual(route('sf.example.org'), None)
+        self.assertEqual(route('sanfrancisco.example.org')['region_slug'], 'sf')
+
+    def test_host_routing_language(self):
+        request = RequestFactory().get('/', HTTP_HOST='fr.sf.example.org')
+        HostRoutingMiddleware().process_request(request)
+        SubdomainLanguageMiddleware().process_request(request)
+        self.assertEqual(request.LANGUAGE_CODE, 'fr')
+
+        request = RequestFactory().get('/', HTTP_HOST='sf.example.org')
+        HostRoutingMiddleware().process_request(request)
+        SubdomainLanguageMiddleware().process_request(request)
+        self.assertEqual(request.LANGUAGE_CODE, settings.LANGUAGE_CODE)
+
+
+class NearbyRegionTests(TestCase):
+    def _region(self, slug, x, y):
+        region = Region(full_name=slug, slug=slug, geom=GEOSGeometry(
+            'MULTIPOLYGON (((%(x0)s %(y0)s, %(x1)s %(y0)s, %(x1)s %(y1)s, '
+            '%(x0)s %(y1)s, %(x0)s %(y0)s)))' % {
+                'x0': x - 0.1, 'x1': x + 0.1, 'y0': y - 0.1, 'y1': y + 0.1}))
+        region.save()
+        for i in range(MIN_PAGES):
+            Page(name='Page %d' % i, content='<p>hi</p>', region=region).save()
+        return region
+
+    def test_nearby_regions(self):
+        sf = self._region('sf', -122.4, 37.8)
+        oak = self._region('oak', -122.2, 37.8)
+        la = self._region('la', -118.2, 34.0)
+        inactive = self._region('inactive', -122.3, 37.8)
+        inactive.is_active = False
+        inactive.save()
+        for region in (sf, oak, la, inactive):
+            compute_nearby_regions(Region.objects.get(id=region.id))
+
+        with self.assertNumQueries(1):
+            self.assertEqual(list(sf.get_nearby_regions()), [oak, la])
+        self.assertEqual(
+            set(NearbyRegion.objects.filter(region=sf, within_tag_radius=True).
+                values_list('nearby', flat=True)),
+            set([oak.id, inactive.id]))
+
+        Page.objects.filter(region=oak)[0].delete()
+        update_page_count(oak.id)
+        self.assertEqual(list(sf.get_nearby_regions()), [la])
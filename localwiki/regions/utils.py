@@ -1,111 +1,255 @@
-from versionutils.versioning.utils import is_versioned
+import operator
+import time
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_save
+
+from versionutils.versioning.utils import is_versioned, unique_lookup_values_for
+from versionutils.versioning.archive import archived_values_list, update_archived
 
 from regions.models import Region
-from pages.models import Page, PageFile
+from pages.models import Page, PageFile, PageArtifact
 from redirects.models import Redirect
 from tags.models import PageTagSet
 from maps.models import MapData
 
+# Objects per query when collecting or moving objects.
+MOVE_BATCH_SIZE = 500
+
+
+def _chunks(items, size=MOVE_BATCH_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _has_region(model):
+    return 'region' in [f.name for f in model._meta.fields]
+
+
+def _any_of(lookups):
+    return reduce(operator.or_, [Q(**lookup) for lookup in lookups])
+
 
-def update_region_for_instance(m, region):
-    if not hasattr(m, 'region'):
-        # Doesn't have an explicit region attribute, so skip.
-        return
-    if is_versioned(m):
-        for m_h in m.versions.all():
-            m_h.region = region
-            m_h.save()
-        m.region = region
-        m.save(track_changes=False)
-    else:
-        m.save()
-
-def clear_regenerable_dependencies(page):
+def _history_lookup(obj):
+    # The same lookup `obj.versions` uses.
+    return unique_lookup_values_for(obj) or {obj._meta.pk.name: obj.pk}
+
+
+def _collect(objs, collected):
+    """
+    Adds the objects, and their version history, to `collected`: a
+    dictionary mapping each model to a tuple (pks, historical pks,
+    archived historical pks).  Objects without an explicit region
+    attribute are skipped.
+    """
+    by_model = defaultdict(list)
+    for obj in objs:
+        if _has_region(obj.__class__):
+            by_model[obj.__class__].append(obj)
+
+    for model, objs in by_model.iteritems():
+        pks, hist_pks, archived_pks = collected.setdefault(
+            model, (set(), set(), set()))
+        pks.update([obj.pk for obj in objs])
+        if not is_versioned(model):
+            continue
+        # Found now, before we move anything, because the lookups can go
+        # through the region of a related object.
+        hist_pk_name = model.versions.model._meta.pk.name
+        for chunk in _chunks(objs):
+            versions = model.versions.filter(
+                _any_of([_history_lookup(obj) for obj in chunk]))
+            hist_pks.update(versions.values_list(hist_pk_name, flat=True))
+            archived_pks.update([row[0] for row in
+                archived_values_list(versions, hist_pk_name)])
+
+
+def _without_existing(model, objs, unique_together, region):
+    """
+    Returns:
+        The objects that don't already exist, by `unique_together`, in
+        `region`.
+    """
+    fields = [f for f in unique_together if f != 'region']
+    existing = set()
+    for chunk in _chunks(objs):
+        lookups = [dict([(f, getattr(obj, f)) for f in fields])
+                   for obj in chunk]
+        existing.update(model.objects.filter(region=region).filter(
+            _any_of(lookups)).values_list(*fields))
+    return [obj for obj in objs
+            if tuple([getattr(obj, f) for f in fields]) not in existing]
+
+
+def _related_objs(page_ids):
+    """
+    Returns:
+        The objects with a region pointing at the pages, e.g. their map
+        and tags.
+    """
+    objs = []
+    for r in Page._meta.get_all_related_objects():
+        if not _has_region(r.model):
+            continue
+        objs.extend(r.model.objects.filter(
+            **{'%s__in' % r.field.name: page_ids}))
+    return objs
+
+
+def clear_regenerable_dependencies(pages):
     from links.models import Link, IncludedPage, IncludedTagList
     from pages.cache import _page_cache_pre_delete
 
-    links_from_here = Link.objects.filter(source=page)
+    page_ids = [p.id for p in pages]
+
+    links_from_here = Link.objects.filter(source__in=page_ids)
     links_from_here.delete()
 
-    links_to_here = Link.objects.filter(destination=page)
+    links_to_here = Link.objects.filter(destination__in=page_ids)
     links_to_here.delete()
 
-    pages_included_here = IncludedPage.objects.filter(source=page)
+    pages_included_here = IncludedPage.objects.filter(source__in=page_ids)
     pages_included_here.delete()
 
-    pages_that_include_this = IncludedPage.objects.filter(included_page=page)
+    pages_that_include_this = IncludedPage.objects.filter(included_page__in=page_ids)
     pages_that_include_this.delete()
 
-    included_tags = IncludedTagList.objects.filter(source=page)
+    included_tags = IncludedTagList.objects.filter(source__in=page_ids)
     included_tags.delete()
 
+    artifacts = PageArtifact.objects.filter(page__in=page_ids)
+    artifacts.delete()
+
     # Clear the caches
-    _page_cache_pre_delete(Page, page)
+    for page in pages:
+        _page_cache_pre_delete(Page, page)
+
+
+def _move_collected(collected, region, progress=None):
+    """
+    Moves the collected objects and their version history to `region`,
+    with an UPDATE per model and batch.
 
-def move_to_region(region, pages=None, redirects=None):
+    Returns:
+        The number of rows updated.
+    """
+    total = sum([len(pks) + len(hist_pks) + len(archived_pks)
+                 for pks, hist_pks, archived_pks in collected.itervalues()])
+    rows = 0
+    for model, (pks, hist_pks, archived_pks) in collected.iteritems():
+        tables = [(model.objects, model._meta.pk.name, pks)]
+        if hist_pks:
+            tables.append((model.versions, model.versions.model._meta.pk.name,
+                           hist_pks))
+        for manager, pk_name, ids in tables:
+            for chunk in _chunks(ids):
+                manager.filter(**{'%s__in' % pk_name: chunk}).update(
+                    region=region)
+                rows += len(chunk)
+                if progress:
+                    progress(rows, total)
+        # The archived history, see versionutils.versioning.archive.
+        for chunk in _chunks(archived_pks):
+            update_archived(model.versions.model, chunk, region=region)
+            rows += len(chunk)
+            if progress:
+                progress(rows, total)
+    return rows
+
+
+def move_to_region(region, pages=None, redirects=None, progress=None):
     """
     Move the provided `pages` and `redirects` to `region`, updating
     all related objects accordingly.
+
+    Region ids are rewritten with set-based UPDATEs, per model and
+    historical model, inside a single transaction.  Model signals are
+    suspended during the move (except for the ones recording history)
+    and delivered afterwards, once per object, along with a post_save for
+    each moved object, which rebuilds the links and caches.
+
+    Args:
+        progress: Optional callable, called as progress(rows_moved,
+            total_rows) as rows are moved.
+
+    Returns:
+        A dictionary with the number of `pages`, `redirects` and `rows`
+        moved, the number of `signals` delivered afterwards, the
+        `seconds` taken and the `rows_per_second`.
     """
-    from tags.models import PageTagSet
     from tags.tag_utils import fix_tags
+    from pages.bans import batched_bans
+    from utils.signals import suspended_signals, replay
+    from .cache import invalidate_region
 
     # XXX and TODO: right now this just rewrites the version history.  When we're
     # versioning Regions we should make this do something like
     # p.save(comment="Moved region"), etc.
+    start = time.time()
     pages = pages or []
     redirects = redirects or []
-
-    for p in pages:
-        if Page(slug=p.slug, region=region).exists():
-            # Page already exists in the new region, so let's
-            # skip moving it.
-            continue
-
-        p._in_move = True
-        clear_regenerable_dependencies(p)
-
-
-        # Need to get these before moving the page itself.
-        rel_objs = p._get_related_objs()
-        slug_rel_objs = p._get_slug_related_objs()
-
-        old_region = p.region
-        update_region_for_instance(p, region)
-
-        for _, rel_obj in rel_objs:
-            if isinstance(rel_obj, list):
-                for obj in rel_obj:
-                    update_region_for_instance(obj, region)
-            else:
-                update_region_for_instance(rel_obj, region)
-
-        for info in slug_rel_objs:
-            unique_together = info["unique_together"]
-            # We need to check to see if these objects exist already. Unlike
-            # normal related objects, by-slug related objs can persist
-            # when a page is deleted.
-            def _get_lookup(unique_together, obj, region):
-                d = {}
-                for field in unique_together:
-                    d[field] = getattr(obj, field)
-                d['region'] = region
-                return d
-
-            for obj in info['objs']:
-                obj_lookup = _get_lookup(unique_together, obj, region)
-                if obj.__class__.objects.filter(**obj_lookup):
-                    # Already exists, so let's skip it.
-                    continue
-                update_region_for_instance(obj, region)
-
-            p._in_move = False
-
-            fix_tags(region, pts_qs=PageTagSet.objects.filter(page=p))
-
-            # Save page to fire signals
-            p.save(track_changes=False)
-
-    for r in redirects:
-        update_region_for_instance(r.destination, region)
-        update_region_for_instance(r, region)
+    old_regions = set([p.region for p in pages] +
+                      [r.region for r in redirects])
+
+    with suspended_signals() as recorded:
+        with transaction.commit_on_success():
+            # Pages that already exist in the new region are skipped.
+            existing = set()
+            for chunk in _chunks([p.slug for p in pages]):
+                existing.update(Page.objects.filter(
+                    region=region, slug__in=chunk).values_list('slug', flat=True))
+            pages = [p for p in pages if p.slug not in existing]
+            page_ids = [p.id for p in pages]
+
+            clear_regenerable_dependencies(pages)
+
+            collected = {}
+            _collect(pages, collected)
+            _collect(_related_objs(page_ids), collected)
+            for p in pages:
+                for info in p._get_slug_related_objs():
+                    # Unlike normal related objects, by-slug related objs
+                    # can persist when a page is deleted, so they may
+                    # already exist in the new region.
+                    objs = list(info['objs'])
+                    if objs:
+                        _collect(_without_existing(objs[0].__class__, objs,
+                            info['unique_together'], region), collected)
+            # A redirect's destination is moved, but not its related
+            # objects.
+            _collect([r.destination for r in redirects], collected)
+            _collect(redirects, collected)
+
+            rows = _move_collected(collected, region, progress)
+
+            if page_ids:
+                fix_tags(region, pts_qs=PageTagSet.objects.filter(page__in=page_ids))
+
+        # Deliver a post_save for each moved object, as saving it would.
+        for model, (pks, _, _) in collected.iteritems():
+            for chunk in _chunks(pks):
+                for obj in model.objects.filter(pk__in=chunk):
+                    recorded.append((post_save, model, {
+                        'instance': obj, 'created': False,
+                        'update_fields': None, 'raw': False,
+                        'using': obj._state.db}))
+
+    with batched_bans():
+        signals = replay(recorded)
+
+    # Pages in both regions can link to, include or list the moved pages.
+    for r in old_regions | set([region]):
+        invalidate_region(r)
+
+    seconds = time.time() - start
+    return {
+        'pages': len(pages),
+        'redirects': len(redirects),
+        'rows': rows,
+        'signals': signals,
+        'seconds': seconds,
+        'rows_per_second': rows / seconds if seconds else rows,
+    }
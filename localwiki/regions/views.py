@@ -30,6 +30,7 @@ from localwiki.utils.urlresolvers import reverse
 
 from .models import Region, RegionSettings, BannedFromRegion, slugify
 from .forms import RegionForm, RegionSettingsForm, AdminSetForm, BannedSetForm
+from .resolver import region_for_slug, region_for_domain
 
 
 def region_404_response(request, slug):
@@ -110,17 +111,13 @@ class RegionMixin(object):
 
         if kwargs.get('region'):
             region_slug = kwargs.get('region')
-            r = get_object_or_404(Region, slug=slugify(region_slug))
+            r = region_for_slug(slugify(region_slug), request)
+            if r is None:
+                raise Http404
         else:
-            if self.region_required:
-                rs = get_object_or_404(RegionSettings, domain=request.META['HTTP_HOST'])
-                r = rs.region
-            else:
-                if RegionSettings.objects.filter(domain=request.META['HTTP_HOST']).exists():
-                    rs = get_object_or_404(RegionSettings, domain=request.META['HTTP_HOST'])
-                    r = rs.region
-                else:
-                    r = None
+            r = region_for_domain(request.META['HTTP_HOST'], request)
+            if r is None and self.region_required:
+                raise Http404
 
         if self.region_required and not r.is_active:
             raise Http404(_("Region '%s' was deleted." % r.slug))
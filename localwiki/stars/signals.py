@@ -12,6 +12,7 @@ from templated_email import send_templated_mail
 
 from utils import get_base_uri
 from utils.urlresolvers import reverse
+from versionutils.versioning.writebehind import most_recent_pending
 from versionutils.versioning.constants import TYPE_REVERTED, TYPE_DELETED_CASCADE, TYPE_REVERTED_DELETED_CASCADE
 from pages.models import Page
 from regions.models import Region
@@ -48,7 +49,9 @@ def notify_page_edited(user, page, notification_type=None):
     else:
         template_name = 'stars/page_edited'
 
-    page_hist = page.versions.most_recent()
+    # Sent as the page is saved: its historical record may still be
+    # queued, and reading its history would write it right away.
+    page_hist = most_recent_pending(page) or page.versions.most_recent()
 
     diff_url = reverse('pages:compare-dates', kwargs={
         'slug': page.pretty_slug,
@@ -221,7 +224,7 @@ def notify_followers_page_edited(sender, instance, created, raw, **kwargs):
         
     for fobj in followers:
         # Skip the notification if the editor is the follower
-        if fobj.user == instance.versions.most_recent().version_info.user:
+        if fobj.user_id == instance.last_editor_id:
             continue
         notify_page_edited(fobj.user, instance)
 
@@ -235,16 +238,17 @@ def notify_followers_page_deleted(sender, instance, **kwargs):
     # pre_delete signal here because then we don't have access to who the
     # most recent page editor, edit type, etc are.
 
-    if not instance.versions.all().count():
+    try:
+        most_recent = instance.versions.most_recent()
+    except Page.DoesNotExist:
         # Page was deleted by a global admin, so let's not notify
         return
 
-    most_recent_page_id = instance.versions.most_recent().id 
-    old_follows = Follow.versions.filter(target_page__id=most_recent_page_id)
+    old_follows = Follow.versions.filter(target_page__id=most_recent.id)
 
     for follow in follows_before_cascade(old_follows):
         # Skip the notification if the editor is the follower
-        if follow.user == instance.versions.most_recent().version_info.user:
+        if follow.user == most_recent.version_info.user:
             continue
         notify_page_deleted(follow.user, instance)
 
@@ -257,8 +261,8 @@ def notify_follow_action(user, target, instance, **kwargs):
     Notify this user's followers of certain follow actions taken by
     this user.
     """
-    if (instance.versions.all().exists() and
-        instance.versions.most_recent().version_info.type in
+    most_recent = instance.versions.all()[:1]
+    if (most_recent and most_recent[0].version_info.type in
             (TYPE_DELETED_CASCADE, TYPE_REVERTED_DELETED_CASCADE)):
         # Don't notify when this is a re-created follow via a
         # revert.
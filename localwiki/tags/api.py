@@ -4,7 +4,7 @@ from rest_framework_gis.filters import GeoFilterSet
 
 from main.api import router
 from main.api.filters import HistoricalFilter
-from main.api.views import AllowFieldLimitingMixin
+from main.api.views import AllowFieldLimitingMixin, ArchivedHistoryMixin
 
 from .models import Tag, PageTagSet, slugify
 
@@ -28,7 +28,7 @@ class HistoricalTagFilter(GeoFilterSet, HistoricalFilter):
         model = PageTagSet.versions.model
 
 
-class HistoricalTagViewSet(AllowFieldLimitingMixin, viewsets.ReadOnlyModelViewSet):
+class HistoricalTagViewSet(ArchivedHistoryMixin, AllowFieldLimitingMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint for viewing tag history, grouped by tags on a particular page at a particular point in time.
 
@@ -20,11 +20,18 @@ class Tag(models.Model):
         return self.name
 
     def save(self, *args, **kwargs):
+        self.prepare_save()
+        super(Tag, self).save(*args, **kwargs)
+
+    def prepare_save(self):
+        """
+        Cleans the name and sets the slug from it.  Called by save(), and
+        by versioning.bulk_save() in its place.
+        """
         self.name = strip_tags(self.name)
         self.slug = slugify(self.name)
         if not self.slug:
             raise IntegrityError('Invalid tag name: %s' % self.name)
-        super(Tag, self).save(*args, **kwargs)
 
     def get_absolute_url(self):
         return reverse('tags:tagged', kwargs={'region': self.region.slug, 'slug':self.slug})
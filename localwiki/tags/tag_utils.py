@@ -1,5 +1,7 @@
 from copy import copy
 
+from regions.cache import invalidate_region
+
 from .models import *
 
 
@@ -59,3 +61,5 @@ def fix_tags(region, pts_qs=None):
         pts.tags.remove(*remove)
         pts.tags.add(*add)
         pts.save(track_changes = False)
+
+    invalidate_region(region)
@@ -3,9 +3,12 @@ from copy import copy
 from django import template
 from django.utils.translation import ugettext as _
 from django.template.loader import render_to_string
+from django.utils.html import escape
 from django.http import Http404
 
-from pages.templatetags.pages_tags import IncludeContentNode
+from localwiki.utils.urlresolvers import reverse
+from localwiki.utils.cache import record_dependencies, tag_key
+from pages.templatetags.pages_tags import IncludeContentNode, fragment_query_string
 from regions.models import Region
 
 from tags.models import PageTagSet, slugify, Tag
@@ -49,10 +52,18 @@ class IncludeTagNode(IncludeContentNode):
         super(IncludeTagNode, self).__init__(*args, **kwargs)
 
     def get_title(self, context):
-        return _('Pages tagged &ldquo;%s&rdquo;') % self.name
+        return _('Pages tagged &ldquo;%s&rdquo;') % escape(self.name)
+
+    def get_fragment_url(self, context):
+        url = reverse('tags:include-fragment', kwargs={
+            'region': context['region'].slug, 'slug': slugify(self.name)})
+        return url + fragment_query_string(self.args, context)
 
     def get_content(self, context):
         region = context['region']
+        # Keep track of the fact this tag list was included (for caching purposes)
+        record_dependencies(context.get('request', None),
+            [tag_key(region.id, slugify(self.name))])
         try:
             self.tag = Tag.objects.get(slug=slugify(self.name), region=region)
         except Tag.DoesNotExist:
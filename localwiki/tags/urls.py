@@ -1,8 +1,11 @@
 from django.conf.urls import *
-from tags.views import TagListView, TaggedList, GlobalTaggedList, AddSingleTagView
+from tags.views import TagListView, TaggedList, GlobalTaggedList, AddSingleTagView,\
+    TagIncludeFragmentView
 
 urlpatterns = patterns('',
     url(r'^(?P<region>[^/]+?)/(?i)tags/$', TagListView.as_view(), name='list'),
+    url(r'^(?P<region>[^/]+?)/(?i)tags/(?P<slug>.+)/_include$', TagIncludeFragmentView.as_view(),
+        name='include-fragment'),
     url(r'^(?P<region>[^/]+?)/(?i)tags/(?P<slug>.+)/*$', TaggedList.as_view(), name='tagged'),
     url(r'^(?P<region>[^/]+?)/_add_tag/$', AddSingleTagView.as_view(), name='add-single'),
 
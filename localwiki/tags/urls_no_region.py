@@ -1,7 +1,8 @@
 from django.conf.urls import *
-from tags.views import TagListView, TaggedList
+from tags.views import TagListView, TaggedList, TagIncludeFragmentView
 
 urlpatterns = patterns('',
     url(r'^tags/$', TagListView.as_view(), name='list'),
+    url(r'^tags/(?P<slug>.+)/_include$', TagIncludeFragmentView.as_view(), name='include-fragment'),
     url(r'^tags/(?P<slug>.+)/*$', TaggedList.as_view(), name='tagged'),
 )
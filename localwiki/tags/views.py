@@ -2,6 +2,7 @@ import copy
 from dateutil.parser import parse as dateparser
 
 from localwiki.utils.urlresolvers import reverse
+from localwiki.utils.cache import tag_key, global_tag_key, get_region_generation
 from django.http import HttpResponse, HttpResponseRedirect, Http404, HttpResponseNotFound
 from django.utils.translation import ugettext as _
 from django.template.context import RequestContext
@@ -16,11 +17,12 @@ from django.views.generic.edit import FormView
 
 from versionutils.versioning.views import VersionsList, UpdateView
 from versionutils.diff.views import CompareView
-from regions.models import Region
+from regions.models import NearbyRegion
 from regions.views import RegionMixin
 from models import PageTagSet, Tag, slugify
 from forms import PageTagSetForm, SingleTagForm
 from pages.models import Page
+from pages.views import IncludeFragmentView
 
 from utils.views import CreateObjectMixin, PermissionRequiredMixin,\
     Custom404Mixin, RevertView, CacheMixin
@@ -44,6 +46,7 @@ class TagListView(RegionMixin, ListView):
 class TaggedList(CacheMixin, Custom404Mixin, RegionMixin, ListView):
     model = PageTagSet
     cache_keep_forever = True
+    cache_warm = True
 
     def get_queryset(self):
         self.tag_name = slugify(self.kwargs['slug'])
@@ -82,20 +85,10 @@ class TaggedList(CacheMixin, Custom404Mixin, RegionMixin, ListView):
             self.nearby_pagetagset_list = []
             return []
 
-        # __dwithin=(center, 0.5) means: all objects within
-        # 1 degree of center. This is roughly 60 miles. This will vary slightly as we move around the earth,
-        # but the complexity of fixing this here is too great. Not a huge deal
-        # for this particular case. The real fix here is to:
-        #
-        #   1.) Use a geometry column instead of the default geography column type or
-        #   2.) Figure out how to case to a geometry column for this query, or
-        #   3.) Write a method that, given a point, finds the correct UTM_N projection,
-        #       then projects the center point into that UTM_N, then buffers by meters
-        #       around the point, and then finally does a __within= on the queryset. Whew.
-        #
-        nearby_pts = PageTagSet.objects.exclude(region=region).\
-            exclude(region__regionsettings=None).exclude(region__regionsettings__region_center=None).\
-            filter(region__regionsettings__region_center__dwithin=(center, 0.5))
+        # The regions within NEARBY_TAG_RADIUS are precomputed, see
+        # regions.nearby.
+        nearby_pts = PageTagSet.objects.filter(region__nearby_of__region=region,
+            region__nearby_of__within_tag_radius=True)
         nearby_pts = nearby_pts.filter(tags__slug=self.tag.slug)
         nearby_pts = nearby_pts.select_related('page__mapdata')
 
@@ -181,14 +174,37 @@ class TaggedList(CacheMixin, Custom404Mixin, RegionMixin, ListView):
         urlconf = get_urlconf() or settings.ROOT_URLCONF
         slug = kwargs.get('slug')
         region = CacheMixin.get_region_slug_param(*args, **kwargs)
+        generation = get_region_generation(region, kwargs.get('request'))
         # Control characters and whitespace not allowed in memcached keys
-        return 'tags:%s/%s/%s' % (urlconf, name_to_url(region), slugify(slug).replace(' ', '_'))
+        return 'tags:%s/%s/%s/%s' % (urlconf, name_to_url(region), generation,
+            slugify(slug).replace(' ', '_'))
+
+    def get_cache_dependencies(self):
+        region = self.get_region()
+        slug = slugify(self.kwargs['slug'])
+        region_ids = [region.id]
+        # We also list the tagged pages in nearby regions
+        region_ids += NearbyRegion.objects.filter(region=region,
+            within_tag_radius=True).values_list('nearby', flat=True)
+        return [tag_key(region_id, slug) for region_id in set(region_ids)]
+
+
+class TagIncludeFragmentView(IncludeFragmentView):
+    def get_node_class(self):
+        from tags.templatetags.tags_tags import IncludeTagNode
+        return IncludeTagNode
+
+    def get_name(self):
+        return self.kwargs['slug']
 
 
 class GlobalTaggedList(CacheMixin, ListView):
     model = PageTagSet
     template_name = 'tags/global_pagetagset_list.html'
 
+    def get_cache_dependencies(self):
+        return [global_tag_key(slugify(self.kwargs['slug']))]
+
     def get_queryset(self):
         self.tag_name = slugify(self.kwargs['slug'])
         return PageTagSet.objects.filter(tags__slug=self.tag_name).select_related('page', 'region').defer('page__content')
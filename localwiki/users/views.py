@@ -32,6 +32,7 @@ from guardian.shortcuts import get_users_with_perms, assign_perm, remove_perm
 from registration.backends import get_backend
 from follow.models import Follow
 
+from versionutils.versioning import archive, writebehind
 from versionutils.versioning.utils import is_versioned
 from regions.models import Region
 from regions import get_main_region
@@ -81,6 +82,7 @@ def get_user_page(user, request):
         return user_pages[0]
     else:
         # Check to see if they've edited a region recently
+        writebehind.flush_user(user)
         edited_pages = Page.versions.filter(version_info__user=user)
         referer = request.META.get('HTTP_REFERER')
         if edited_pages.exists():
@@ -101,6 +103,19 @@ def get_user_page(user, request):
         return Page(name=pagename, region=get_main_region())
 
 
+def num_distinct(versions, field):
+    """
+    The number of distinct values of `field` among the historical records
+    `versions`, archived ones included.
+    """
+    if archive.newest_archived(versions.model) is None:
+        return versions.values(field).distinct().count()
+    versions = versions.order_by().distinct()
+    values = set(versions.values_list(field, flat=True))
+    values.update([v for (v,) in archive.archived_values_list(versions, field)])
+    return len(values)
+
+
 class UserPageView(TemplateView):
     template_name = 'users/user_page.html'
 
@@ -118,19 +133,22 @@ class UserPageView(TemplateView):
         #########################
         # Calculate user stats
         #########################
-        page_edits = Page.versions.filter(version_info__user=user).count()
-        map_edits = MapData.versions.filter(version_info__user=user).count()
-        tag_edits = PageTagSet.versions.filter(version_info__user=user).count()
-        file_edits = PageFile.versions.filter(version_info__user=user).count()
+        # Including their queued edits, see versionutils.versioning.writebehind
+        writebehind.flush_user(user)
+        # and their archived ones, see versionutils.versioning.archive
+        page_edits = Page.versions.filter(version_info__user=user).with_archive().count()
+        map_edits = MapData.versions.filter(version_info__user=user).with_archive().count()
+        tag_edits = PageTagSet.versions.filter(version_info__user=user).with_archive().count()
+        file_edits = PageFile.versions.filter(version_info__user=user).with_archive().count()
 
         # Total contributions across data types
         num_contributions = page_edits + map_edits + tag_edits + file_edits
 
         # Total 'pages touched'
-        num_pages_edited = Page.versions.filter(version_info__user=user).values('slug').distinct().count()
+        num_pages_edited = num_distinct(Page.versions.filter(version_info__user=user), 'slug')
 
         # Total 'maps touched'
-        num_maps_edited = MapData.versions.filter(version_info__user=user).values('page__slug').distinct().count()
+        num_maps_edited = num_distinct(MapData.versions.filter(version_info__user=user), 'page__slug')
 
         # Regions followed
         regions_followed = Follow.objects.filter(user=user).exclude(target_region=None)
@@ -1,6 +1,6 @@
 import itertools
 import threading
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, OrderedDict
 
 from django.utils.functional import lazy
 from django.core.urlresolvers import reverse, reverse_lazy
@@ -79,6 +79,52 @@ def take_n_from(lists_with_indexes, n, merge_key=None):
     return (items, indexes, has_more_left)
 
 
+class LRUCache(object):
+    """
+    A small, thread-safe, in-process least-recently-used cache.
+
+    Used for process-level caches of things that are expensive to build
+    but cheap to keep around, like compiled templates.
+    """
+    def __init__(self, max_size=500):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            # Re-insert to mark as most recently used.
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
 def get_base_uri():
     from .middleware import _threadlocal
     return getattr(_threadlocal, 'base_uri', '')
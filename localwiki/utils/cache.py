@@ -1,5 +1,13 @@
+import hashlib
+import time
+import urllib
+import uuid
+import zlib
 from functools import wraps
 
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
 from django.views.decorators.cache import cache_page as dj_cache_page
 from django.utils.decorators import decorator_from_middleware_with_args, available_attrs
 
@@ -21,3 +29,415 @@ def cache_page(*o_args, **o_kwargs):
             return f(request, *args, **kw)
         return _cache_paged
     return _cache_page
+
+
+# Cache dependency keys.
+#
+# A cached response is built from some set of objects: pages, tag lists, a
+# region's map, a page's files and so on.  While handling a request, the
+# code using one of these records its dependency key with
+# `record_dependencies()`.  CacheMixin then sends the keys along with the
+# cached response (for Varnish) and indexes the memcached entry under each
+# key, so that `pages.cache.purge()` can invalidate exactly the responses
+# built from an object.
+
+def _quote(s):
+    # Keys are sent in a space-separated header, so no whitespace.
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    return urllib.quote(s, safe='')
+
+
+def page_key(region_id, slug):
+    """ The content of the page (or its absence). """
+    return 'page:%s:%s' % (region_id, _quote(slug))
+
+
+def page_exists_key(region_id, slug):
+    """ Whether the page exists, e.g. for links to it. """
+    return 'exists:%s:%s' % (region_id, _quote(slug))
+
+
+def tag_key(region_id, slug):
+    """ The pages tagged with the tag in the region. """
+    return 'tag:%s:%s' % (region_id, _quote(slug))
+
+
+def global_tag_key(slug):
+    """ The pages tagged with the tag in any region. """
+    return 'globaltag:%s' % _quote(slug)
+
+
+def map_key(region_id):
+    """ The map data of the region. """
+    return 'map:%s' % region_id
+
+
+def file_key(region_id, slug):
+    """ The files attached to the page. """
+    return 'file:%s:%s' % (region_id, _quote(slug))
+
+
+def frontpage_key(region_id):
+    """ The region's front page settings. """
+    return 'frontpage:%s' % region_id
+
+
+def region_key(region_slug):
+    """
+    Anything in the region.  Only sent to Varnish, see `region_keys`.
+    """
+    return 'region:%s' % _quote(region_slug)
+
+
+def split_key(key):
+    """
+    Returns:
+        A tuple (kind, [args]) for the dependency key, e.g.
+        ('page', ['1', u'front page']).
+    """
+    parts = key.split(':')
+    return (parts[0], [urllib.unquote(p).decode('utf-8') for p in parts[1:]])
+
+
+def record_dependencies(request, keys):
+    """
+    Records that the response to `request` depends on the given keys.
+    """
+    if request is None:
+        return
+    request._cache_dependencies = get_dependencies(request) + list(keys)
+
+
+def get_dependencies(request):
+    """
+    Returns:
+        The list of dependency keys recorded so far while handling
+        `request`.  May contain duplicates.
+    """
+    return getattr(request, '_cache_dependencies', [])
+
+
+# Indexes outlive the entries they point to (see DEFAULT_MEMCACHED_TIMEOUT).
+INDEX_TIMEOUT = 60 * 60 * 24 * 29
+
+# Most recently cached keys kept in the index of a dependency key.
+INDEX_MAX_KEYS = 500
+
+
+def _index_key(key):
+    h = hashlib.sha1(key)
+    return 'depindex:%s' % h.hexdigest()
+
+
+def _invalidated_key(key):
+    h = hashlib.sha1(key)
+    return 'depinvalidated:%s' % h.hexdigest()
+
+
+def dependency_markers(keys, rendered_at):
+    """
+    Returns:
+        The keys of the invalidation times of the dependency keys, to
+        store with a cached entry rendered at `rendered_at` (see
+        `cache_entry`).  Dependency keys without an invalidation time (new,
+        or evicted) are taken to have been invalidated at `rendered_at`,
+        so entries rendered before then are never served.
+    """
+    markers = [_invalidated_key(k) for k in set(keys)]
+    existing = cache.get_many(markers)
+    for marker in markers:
+        if marker not in existing:
+            cache.add(marker, rendered_at, INDEX_TIMEOUT)
+    return markers
+
+
+def index_cache_key(cache_key, keys):
+    """
+    Adds the memcached `cache_key` to the index of each dependency key, so
+    `purge_cached` can tell which entries it invalidated.
+
+    The indexes are only used to find the entries to mark stale or delete
+    early and to re-warm, never to decide whether an entry is valid (see
+    `dependency_markers`), so losing an update to a concurrent write is
+    harmless.
+    """
+    index_keys = dict([(_index_key(k), k) for k in set(keys)])
+    if not index_keys:
+        return
+    indexes = cache.get_many(index_keys.keys())
+    for index_key in index_keys:
+        indexed = [k for k in indexes.get(index_key, []) if k != cache_key]
+        indexed.append(cache_key)
+        indexes[index_key] = indexed[-INDEX_MAX_KEYS:]
+    cache.set_many(indexes, INDEX_TIMEOUT)
+
+
+def purge_cached(keys):
+    """
+    Invalidates the memcached entries built from any of the dependency
+    keys.  Indexed entries that allow it (see `cache_entry`) are marked
+    stale, other indexed ones are deleted.
+
+    Returns:
+        The memcached keys of the indexed entries invalidated.
+    """
+    keys = set(keys)
+    if not keys:
+        return set()
+    now = time.time()
+    cache.set_many(dict([(_invalidated_key(k), now) for k in keys]),
+                   INDEX_TIMEOUT)
+
+    index_keys = [_index_key(k) for k in keys]
+    cache_keys = set()
+    for indexed in cache.get_many(index_keys).itervalues():
+        cache_keys.update(indexed)
+    to_delete = set(cache_keys)
+    for cache_key, entry in cache.get_many(list(cache_keys)).iteritems():
+        if _is_entry(entry) and entry['serve_stale']:
+            mark_stale(cache_key, entry)
+            to_delete.discard(cache_key)
+    if to_delete:
+        cache.delete_many(list(to_delete))
+    cache.delete_many(index_keys)
+    return cache_keys
+
+
+# Most bytes of dependency keys we send in the xkey header.  Varnish's
+# limit on a response header line (http_resp_hdr_len) is 8KB by default.
+XKEY_HEADER_MAX = 4096
+
+
+def collapsed_key(key):
+    """
+    Returns:
+        The region-wide key standing in for `key` in a too-long xkey
+        header, e.g. 'exists:1' for 'exists:1:parks'.  Keys that aren't
+        specific to a page or tag are their own collapsed key.
+    """
+    parts = key.split(':')
+    return ':'.join(parts[:2])
+
+
+def xkey_header(keys):
+    """
+    Returns:
+        The xkey header value for the dependency keys.  If it'd be too
+        long, the keys of the most common kind, and then all keys, are
+        replaced with their region-wide `collapsed_key`.  Bans by key
+        also ban the collapsed keys (see `pages.cache.purge`).
+    """
+    max_length = getattr(settings, 'VARNISH_XKEY_HEADER_MAX', XKEY_HEADER_MAX)
+    keys = set(keys)
+    header = ' '.join(sorted(keys))
+    if len(header) <= max_length:
+        return header
+    kinds = {}
+    for key in keys:
+        kind = key.split(':')[0]
+        kinds[kind] = kinds.get(kind, 0) + 1
+    # Usually the 'exists' keys of the links in a page.
+    most_common = max(kinds, key=lambda kind: kinds[kind])
+    keys = set([collapsed_key(k) if k.split(':')[0] == most_common else k
+                for k in keys])
+    header = ' '.join(sorted(keys))
+    if len(header) <= max_length:
+        return header
+    return ' '.join(sorted(set([collapsed_key(k) for k in keys])))
+
+
+# Region generations.
+#
+# The cache keys of a region's pages, tag lists, map and front page embed
+# the region's generation number.  Bumping it invalidates all of them at
+# once, without having to find them.
+
+def _region_generation_key(region_slug):
+    # Control characters and whitespace not allowed in memcached keys
+    h = hashlib.sha1(region_slug.encode('utf-8'))
+    return 'region_gen:%s' % h.hexdigest()
+
+
+def get_region_generation(region_slug, request=None):
+    """
+    Returns:
+        The region's current generation number.  Looked up once per
+        `request`.
+    """
+    memo = getattr(request, '_region_generations', None)
+    if memo is not None and region_slug in memo:
+        return memo[region_slug]
+
+    key = _region_generation_key(region_slug)
+    generation = cache.get(key)
+    if generation is None:
+        # Start from the current time rather than zero, so that if the
+        # counter is evicted we never go back to an earlier generation.
+        cache.add(key, int(time.time()), INDEX_TIMEOUT)
+        generation = cache.get(key)
+
+    if request is not None:
+        if memo is None:
+            memo = request._region_generations = {}
+        memo[region_slug] = generation
+    return generation
+
+
+def region_keys(request):
+    """
+    Returns:
+        The `region_key` of each region whose generation was looked up
+        while handling `request`, to send to Varnish along with the other
+        dependency keys.  Memcached entries embed the generation instead.
+    """
+    memo = getattr(request, '_region_generations', None) or {}
+    return [region_key(slug) for slug in memo]
+
+
+def bump_region_generation(region_slug):
+    """
+    Invalidates every cached view of the region.
+    """
+    key = _region_generation_key(region_slug)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Key doesn't exist yet.
+        cache.set(key, int(time.time()), INDEX_TIMEOUT)
+
+
+# Cached responses.
+#
+# Responses are cached along with the time they go stale (their soft
+# expiry) and the time they expire from the cache (their hard expiry).
+# Between the two, one request regenerates the response while the others
+# are served the stale one.
+#
+# Rather than pickling the response object, we keep its status code, the
+# headers that aren't rebuilt on every request, and its zlib-compressed
+# content.  Content too big for one memcached item is split into chunks
+# stored under their own keys.
+
+# Bump this when changing what's stored for an entry.
+ENTRY_VERSION = 3
+
+# Under memcached's default 1MB item size limit, leaving room for the key
+# and pickling overhead.
+CHUNK_SIZE = 1000 * 1000
+
+# Headers set on every response we serve from the cache (see
+# utils.views.CacheMixin), so there's no need to store them.
+REBUILT_HEADERS = ('cache-control', 'expires', 'last-modified', 'etag',
+                   'x-keepme')
+
+
+def cache_entry(response, timeout, soft_timeout=None, serve_stale=False,
+                dependencies=None, rendered_at=None):
+    """
+    Args:
+        response: The (rendered) response to cache.
+        timeout: Seconds until the entry expires from the cache.
+        soft_timeout: Seconds until the entry goes stale.  Defaults to
+            `timeout`.
+        serve_stale: Whether invalidating the entry just marks it stale.
+        dependencies: The invalidation markers of the entry's dependency
+            keys, see `dependency_markers`.
+        rendered_at: The time the response started rendering.
+
+    Returns:
+        The entry to store in the cache, see `set_entry`.
+    """
+    now = time.time()
+    headers = [h for k, h in response._headers.iteritems()
+               if k not in REBUILT_HEADERS]
+    return {
+        'version': ENTRY_VERSION,
+        'status': response.status_code,
+        'headers': headers,
+        'content': zlib.compress(response.content),
+        'chunks': None,
+        'stale_at': now + (soft_timeout or timeout),
+        'expires_at': now + timeout,
+        'serve_stale': serve_stale,
+        'dependencies': dependencies or [],
+        'rendered_at': rendered_at or now,
+    }
+
+
+def set_entry(cache_key, entry, timeout):
+    """
+    Stores the entry under `cache_key`, splitting its content into chunks
+    if it's too big.
+    """
+    content = entry['content']
+    if content is not None and len(content) > CHUNK_SIZE:
+        # Chunk keys are unique to this write, so a reader never puts
+        # together chunks of different versions of the content.
+        prefix = 'chunk:%s:%s' % (hashlib.sha1(cache_key).hexdigest(),
+                                  uuid.uuid4().hex)
+        chunk_keys = []
+        chunks = {}
+        for n, i in enumerate(range(0, len(content), CHUNK_SIZE)):
+            chunk_keys.append('%s:%d' % (prefix, n))
+            chunks[chunk_keys[-1]] = content[i:i + CHUNK_SIZE]
+        cache.set_many(chunks, timeout)
+        entry = dict(entry, content=None, chunks=chunk_keys)
+    cache.set(cache_key, entry, timeout)
+
+
+def _is_entry(entry):
+    return isinstance(entry, dict) and entry.get('version') == ENTRY_VERSION
+
+
+def _build_response(entry):
+    content = entry['content']
+    if entry['chunks']:
+        chunks = cache.get_many(entry['chunks'])
+        if len(chunks) != len(entry['chunks']):
+            # Some of the chunks were evicted.
+            return None
+        content = ''.join([chunks[k] for k in entry['chunks']])
+    response = HttpResponse(zlib.decompress(content), status=entry['status'])
+    for header, value in entry['headers']:
+        response[header] = value
+    return response
+
+
+def _is_invalidated(entry):
+    if not entry['dependencies']:
+        return False
+    invalidated = cache.get_many(entry['dependencies'])
+    if len(invalidated) != len(entry['dependencies']):
+        # Evicted, so we can't tell when they were last invalidated.
+        return True
+    return max(invalidated.values()) > entry['rendered_at']
+
+
+def unpack_entry(entry):
+    """
+    Returns:
+        A tuple (response, is_stale) for the cached entry, or (None, False)
+        if there's no usable entry.  Entries one of whose dependency keys
+        has been invalidated since they were rendered are stale, if they
+        allow it, or unusable.
+    """
+    if not _is_entry(entry):
+        # Missing, or stored in an older format.
+        return (None, False)
+    invalidated = _is_invalidated(entry)
+    if invalidated and not entry['serve_stale']:
+        return (None, False)
+    response = _build_response(entry)
+    if response is None:
+        return (None, False)
+    return (response, invalidated or time.time() >= entry['stale_at'])
+
+
+def mark_stale(cache_key, entry):
+    entry['stale_at'] = 0
+    timeout = int(entry['expires_at'] - time.time())
+    if timeout > 0:
+        # The chunks, if any, are left alone: they expire along with the
+        # entry.
+        cache.set(cache_key, entry, timeout)
@@ -0,0 +1,88 @@
+import cPickle as pickle
+import time
+from optparse import make_option
+from urlparse import urlparse
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.http import HttpResponse
+
+from regions.models import Region
+from pages.models import Page
+from utils.cache import cache_entry, set_entry, unpack_entry
+from utils.warming import fetch
+
+
+class Command(BaseCommand):
+    help = ('Compares the size and read time of cached page responses, '
+            'pickled whole versus stored as compact entries.\n'+
+            'Usage: localwiki-manage benchmark_cache_entries <region slug>')
+    option_list = BaseCommand.option_list + (
+        make_option('--pages', dest='pages', type='int', default=50,
+            help='Number of pages to render.'),
+        make_option('--reads', dest='reads', type='int', default=100,
+            help='Number of times to read each cached response.'),
+    )
+
+    def handle(self, region_slug=None, **options):
+        if region_slug is None:
+            raise CommandError("You must provide a region slug.")
+
+        try:
+            region = Region.objects.get(slug=region_slug)
+        except Region.DoesNotExist:
+            raise CommandError('Region "%s" does not exist.' % region_slug)
+
+        totals = {'pages': 0, 'pickled_bytes': 0, 'compact_bytes': 0,
+                  'pickled_read': 0.0, 'compact_read': 0.0}
+        pages = Page.objects.filter(region=region).order_by('id')
+        for page in pages[:options['pages']]:
+            url = urlparse(page.get_absolute_url())
+            status, headers, content = fetch(
+                url.netloc or settings.MAIN_HOSTNAME, url.path, warming=False)
+            if status != 200:
+                continue
+            response = HttpResponse(content, status=status)
+            for header, value in headers:
+                response[header] = value
+            self._benchmark(page, response, options['reads'], totals)
+
+        if not totals['pages']:
+            raise CommandError('No pages rendered in "%s".' % region_slug)
+        n = totals['pages']
+        reads = n * options['reads']
+        self.stdout.write('Pages: %d\n' % n)
+        self.stdout.write('Pickled responses: %d bytes per page, %.3f ms per read\n' % (
+            totals['pickled_bytes'] / n, totals['pickled_read'] * 1000 / reads))
+        self.stdout.write('Compact entries:   %d bytes per page, %.3f ms per read\n' % (
+            totals['compact_bytes'] / n, totals['compact_read'] * 1000 / reads))
+
+    def _benchmark(self, page, response, reads, totals):
+        pickled_key = 'benchmark:pickled:%d' % page.id
+        compact_key = 'benchmark:compact:%d' % page.id
+        # How responses were cached before compact entries.
+        pickled = {'response': response, 'stale_at': 0, 'expires_at': 0,
+                   'serve_stale': False}
+        entry = cache_entry(response, 60)
+        cache.set(pickled_key, pickled, 60)
+        set_entry(compact_key, entry, 60)
+
+        totals['pages'] += 1
+        totals['pickled_bytes'] += len(pickle.dumps(pickled,
+            pickle.HIGHEST_PROTOCOL))
+        totals['compact_bytes'] += len(pickle.dumps(entry,
+            pickle.HIGHEST_PROTOCOL))
+
+        start = time.time()
+        for i in range(reads):
+            cache.get(pickled_key)['response'].content
+        totals['pickled_read'] += time.time() - start
+
+        start = time.time()
+        for i in range(reads):
+            unpack_entry(cache.get(compact_key))[0].content
+        totals['compact_read'] += time.time() - start
+
+        cache.delete_many([pickled_key, compact_key])
@@ -9,6 +9,8 @@ from django.contrib.sessions.middleware import SessionMiddleware
 from django.conf import settings
 from django.utils import translation
 
+from . import transactions
+
 
 class AutoTrackUserInfoMiddleware(object):
     """
@@ -46,13 +48,17 @@ class SubdomainLanguageMiddleware(object):
     """
     Set the language for the site based on the subdomain the request
     is being served on. For example, serving on 'fr.domain.com' would
-    make the language French (fr).
+    make the language French (fr).  On a region's custom domain, the
+    language is the one picked by `regions.middleware.HostRoutingMiddleware`.
     """
     LANGUAGES = [i[0] for i in settings.LANGUAGES]
 
     def process_request(self, request):
+        host_route = getattr(request, 'host_route', None)
         host = request.get_host().split('.')
-        if host and host[0] in self.LANGUAGES:
+        if host_route is not None:
+            lang = host_route['language']
+        elif host and host[0] in self.LANGUAGES:
             lang = host[0]
         else:
             # Set to default language
@@ -123,6 +129,24 @@ class RequestURIMiddleware(object):
         _threadlocal.base_uri = request.build_absolute_uri('/')[:-1]
 
 
+class OnCommitMiddleware(object):
+    """
+    Makes the calls deferred with `utils.transactions.on_commit()` while
+    handling a request once TransactionMiddleware has committed.  Must
+    come right before TransactionMiddleware.
+    """
+    def process_request(self, request):
+        transactions.begin()
+
+    def process_exception(self, request, exception):
+        # TransactionMiddleware has rolled back.
+        transactions.discard()
+
+    def process_response(self, request, response):
+        transactions.run_pending()
+        return response
+
+
 class TransactionMiddleware(object):
     """
     Just like django.middleware.transaction.TransactionMiddleware, except this
@@ -0,0 +1,127 @@
+"""
+Suspending model signals.
+
+Bulk operations, like moving pages between regions, save a lot of objects
+whose signal receivers (cache invalidation, search indexing, link
+recording, ...) would otherwise run over and over on the same objects.
+Inside `suspended_signals()` the model signals sent by the current thread
+are recorded instead of delivered, except to the receivers that keep
+version history, and `replay()` then delivers them once per object.
+
+Other threads are unaffected.
+"""
+import threading
+from contextlib import contextmanager
+
+from django.db.models import signals
+from django.dispatch.dispatcher import _make_id
+
+MODEL_SIGNALS = (signals.pre_save, signals.post_save, signals.pre_delete,
+                 signals.post_delete, signals.m2m_changed)
+
+# Receivers from these modules always run, so that history is recorded.
+ALWAYS_RUN = ('versionutils.',)
+
+_local = threading.local()
+_install_lock = threading.Lock()
+
+
+def _receiver_module(receiver):
+    # Unwrap functools.partial, as used by versionutils for m2m_changed.
+    receiver = getattr(receiver, 'func', receiver)
+    return getattr(receiver, '__module__', None) or ''
+
+
+def _always_runs(receiver):
+    return _receiver_module(receiver).startswith(ALWAYS_RUN)
+
+
+def _install(signal):
+    """
+    Wraps `signal.send` so that it checks whether the current thread has
+    suspended signals.
+    """
+    if getattr(signal, '_suspendable', False):
+        return
+    send = signal.send
+
+    def suspendable_send(sender, **named):
+        recorded = getattr(_local, 'recorded', None)
+        if recorded is None:
+            return send(sender, **named)
+        recorded.append((signal, sender, named))
+        responses = []
+        for receiver in signal._live_receivers(_make_id(sender)):
+            if _always_runs(receiver):
+                response = receiver(signal=signal, sender=sender, **named)
+                responses.append((receiver, response))
+        return responses
+
+    signal._original_send = send
+    signal.send = suspendable_send
+    signal._suspendable = True
+
+
+@contextmanager
+def suspended_signals():
+    """
+    Records the model signals sent by this thread, rather than delivering
+    them, for the duration of the block.  Nested blocks record into the
+    outermost one.
+
+    Yields:
+        The list of recorded signals, to hand to `replay()`.
+    """
+    with _install_lock:
+        for signal in MODEL_SIGNALS:
+            _install(signal)
+    outer = getattr(_local, 'recorded', None)
+    if outer is not None:
+        yield outer
+        return
+    _local.recorded = []
+    try:
+        yield _local.recorded
+    finally:
+        _local.recorded = None
+
+
+def _coalesce_key(signal, sender, named):
+    instance = named.get('instance')
+    pk = getattr(instance, 'pk', None)
+    if pk is None:
+        # Can't tell which object it's about, so keep it.
+        return (signal, sender, id(instance), id(named))
+    if signal is signals.m2m_changed:
+        return (signal, sender, pk, named.get('action'),
+                frozenset(named.get('pk_set') or ()))
+    # Only the latest pre/post_save of an object matters, and a save
+    # followed by a delete leaves both.
+    return (signal, sender, pk)
+
+
+def replay(recorded):
+    """
+    Delivers the recorded signals, once per signal and object, in the order
+    they were first sent.  The latest arguments sent win.
+
+    Returns:
+        The number of signals delivered.
+    """
+    order = []
+    latest = {}
+    for signal, sender, named in recorded:
+        key = _coalesce_key(signal, sender, named)
+        if key not in latest:
+            order.append(key)
+        elif latest[key][2].get('created'):
+            # Receivers still need to know the object is new.
+            named = dict(named, created=True)
+        latest[key] = (signal, sender, named)
+
+    for key in order:
+        signal, sender, named = latest[key]
+        for receiver in signal._live_receivers(_make_id(sender)):
+            if not _always_runs(receiver):
+                receiver(signal=signal, sender=sender, **named)
+    return len(order)
@@ -1,5 +1,7 @@
-from sorl.thumbnail.conf import settings
+from sorl.thumbnail.conf import settings, defaults as default_settings
 from sorl.thumbnail.base import ThumbnailBackend
+from sorl.thumbnail.images import ImageFile
+from sorl.thumbnail import default
 
 
 FORMAT_DICT = {
@@ -9,15 +11,60 @@ FORMAT_DICT = {
 }
 
 
+class PendingThumbnail(ImageFile):
+    """
+    Stands in for a thumbnail that hasn't been generated yet.  Points at
+    the original image.
+    """
+    pending = True
+
+
+def _set_format(file_, options):
+    if not options.get('format'):
+        ext = str(file_).split('.')[-1].lower()
+        options['format'] = FORMAT_DICT.get(ext, settings.THUMBNAIL_FORMAT)
+
+
 class AutoFormatBackend(ThumbnailBackend):
     def get_thumbnail(self, file_, geometry_string, **options):
         """
         Sets the format option (if not explicitly set) to the same format as
         the original file.
+
+        If THUMBNAIL_GENERATE_ASYNC is set, thumbnails are only read from
+        the key-value store here.  Missing thumbnails are queued to be
+        generated and the original image is returned in the meantime.  Pass
+        generate=True to generate the thumbnail right away.
         """
-        if not options.get('format'):
-            ext = str(file_).split('.')[-1].lower()
-            options['format'] = FORMAT_DICT.get(ext, settings.THUMBNAIL_FORMAT)
+        generate = options.pop('generate', False)
+        _set_format(file_, options)
 
-        return super(AutoFormatBackend, self).get_thumbnail(
-            file_, geometry_string, **options)
+        if generate or not getattr(settings, 'THUMBNAIL_GENERATE_ASYNC', False):
+            return super(AutoFormatBackend, self).get_thumbnail(
+                file_, geometry_string, **options)
+
+        thumbnail = self.get_cached_thumbnail(file_, geometry_string, **options)
+        if thumbnail is None:
+            from pages.thumbnails import queue_thumbnail
+            queue_thumbnail(str(file_), geometry_string)
+            return PendingThumbnail(file_)
+        return thumbnail
+
+    def get_cached_thumbnail(self, file_, geometry_string, **options):
+        """
+        Returns:
+            The thumbnail from the key-value store, or None if it hasn't been
+            generated.  Never touches the image itself.
+        """
+        source = ImageFile(file_)
+        # Fill in the options the same way get_thumbnail() does, so we end
+        # up with the same thumbnail name.
+        _set_format(file_, options)
+        for key, value in self.default_options.iteritems():
+            options.setdefault(key, value)
+        for key, attr in getattr(self, 'extra_options', ()):
+            value = getattr(settings, attr)
+            if value != getattr(default_settings, attr):
+                options.setdefault(key, value)
+        name = self._get_thumbnail_filename(source, geometry_string, options)
+        return default.kvstore.get(ImageFile(name, default.storage))
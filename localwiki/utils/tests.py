@@ -1,3 +1,5 @@
+import os
+import time
 from contextlib import contextmanager
 
 from lxml.html import document_fromstring
@@ -6,12 +8,22 @@ from django.conf import settings
 from django.core.urlresolvers import set_urlconf, get_urlconf
 from django.test import TestCase
 from django.test.client import RequestFactory
+from django.http import HttpResponse
 from django.test.utils import override_settings
 from django.contrib.auth.models import User
 
 from users.models import UserProfile
 
+from django.core.cache import cache
+
 from . import take_n_from
+from .cache import (page_key, tag_key, split_key, index_cache_key,
+    purge_cached, cache_entry, set_entry, unpack_entry, get_region_generation,
+    bump_region_generation, dependency_markers, xkey_header, page_exists_key,
+    region_key, region_keys, collapsed_key)
+from . import cache as utils_cache
+from .transactions import on_commit, deferred_until_commit
+from .warming import count_hit, rank_by_traffic, is_warming_request, _warming_token
 
 
 class TakeNFromTests(TestCase):
@@ -50,6 +62,175 @@ class TakeNFromTests(TestCase):
         self.assertEqual(len(items), len(all_sorted))
 
 
+@contextmanager
+def patch_chunk_size(size):
+    old_size = utils_cache.CHUNK_SIZE
+    utils_cache.CHUNK_SIZE = size
+    try:
+        yield
+    finally:
+        utils_cache.CHUNK_SIZE = old_size
+
+
+class CacheDependencyTests(TestCase):
+    def test_split_key(self):
+        self.assertEqual(split_key(page_key(1, u'caf\xe9 park')),
+                         ('page', [u'1', u'caf\xe9 park']))
+
+    def test_purge_cached(self):
+        cache.set('test:front', 1)
+        cache.set('test:parks', 2)
+        index_cache_key('test:front', [page_key(1, u'front page'), tag_key(1, u'parks')])
+        index_cache_key('test:parks', [tag_key(1, u'parks')])
+
+        purge_cached([page_key(1, u'front page')])
+        self.assertEqual(cache.get('test:front'), None)
+        self.assertEqual(cache.get('test:parks'), 2)
+
+        purge_cached([tag_key(1, u'parks')])
+        self.assertEqual(cache.get('test:parks'), None)
+
+    def test_purge_marks_stale(self):
+        cache.set('test:front', cache_entry(HttpResponse('front'), 60, serve_stale=True))
+        cache.set('test:parks', cache_entry(HttpResponse('parks'), 60))
+        response, is_stale = unpack_entry(cache.get('test:front'))
+        self.assertEqual((response.content, is_stale), ('front', False))
+        index_cache_key('test:front', [page_key(1, u'front page')])
+        index_cache_key('test:parks', [page_key(1, u'front page')])
+
+        purge_cached([page_key(1, u'front page')])
+        response, is_stale = unpack_entry(cache.get('test:front'))
+        self.assertEqual((response.content, is_stale), ('front', True))
+        self.assertEqual(cache.get('test:parks'), None)
+
+    def test_purge_without_index(self):
+        rendered_at = time.time() - 1
+        markers = dependency_markers([page_key(1, u'front page')], rendered_at)
+        cache.set('test:front', cache_entry(HttpResponse('front'), 60,
+            dependencies=markers, rendered_at=rendered_at))
+        cache.set('test:parks', cache_entry(HttpResponse('parks'), 60, serve_stale=True,
+            dependencies=markers, rendered_at=rendered_at))
+        self.assertEqual(unpack_entry(cache.get('test:front'))[0].content, 'front')
+
+        # Invalidated even though they were never indexed, e.g. because a
+        # concurrent index update was lost.
+        purge_cached([page_key(1, u'front page')])
+        self.assertEqual(unpack_entry(cache.get('test:front')), (None, False))
+        response, is_stale = unpack_entry(cache.get('test:parks'))
+        self.assertEqual((response.content, is_stale), ('parks', True))
+
+    def test_xkey_header(self):
+        keys = [page_key(1, u'front page')] + [
+            page_exists_key(1, u'page %d' % i) for i in range(1000)]
+        header = xkey_header(keys)
+        self.assertTrue(len(header) <= utils_cache.XKEY_HEADER_MAX)
+        self.assertEqual(header.split(), ['exists:1', page_key(1, u'front page')])
+        self.assertEqual(xkey_header(keys[:2]), ' '.join(sorted(keys[:2])))
+
+    def test_soft_timeout(self):
+        entry = cache_entry(HttpResponse('front'), 60, soft_timeout=-1)
+        self.assertEqual(unpack_entry(entry)[1], True)
+        self.assertEqual(unpack_entry(None), (None, False))
+
+    def test_compact_entry(self):
+        response = HttpResponse('front', status=203, content_type='text/plain')
+        response['Vary'] = 'Cookie'
+        response['Expires'] = 'Thu, 01 Jan 2015 00:00:00 GMT'
+        response.set_cookie('sessionid', 'abc')
+        set_entry('test:front', cache_entry(response, 60), 60)
+
+        cached, is_stale = unpack_entry(cache.get('test:front'))
+        self.assertEqual(cached.content, 'front')
+        self.assertEqual(cached.status_code, 203)
+        self.assertEqual(cached['Content-Type'], 'text/plain')
+        self.assertEqual(cached['Vary'], 'Cookie')
+        # Rebuilt when served.
+        self.assertFalse(cached.has_header('Expires'))
+        self.assertFalse(cached.cookies)
+
+        # Entries in an older format are misses.
+        cache.set('test:parks', {'response': response})
+        self.assertEqual(unpack_entry(cache.get('test:parks')), (None, False))
+
+    def test_chunked_entry(self):
+        content = os.urandom(150 * 1000)
+        with patch_chunk_size(50 * 1000):
+            set_entry('test:big', cache_entry(HttpResponse(content), 60), 60)
+            entry = cache.get('test:big')
+            self.assertEqual(len(entry['chunks']), 4)
+            self.assertEqual(unpack_entry(entry)[0].content, content)
+
+            # Missing chunks make for a miss.
+            cache.delete(entry['chunks'][1])
+            self.assertEqual(unpack_entry(entry), (None, False))
+
+    def test_rank_by_traffic(self):
+        cache.set('test:front', 1)
+        cache.set('test:parks', 2)
+        index_cache_key('test:front', [page_key(1, u'front page')])
+        index_cache_key('test:parks', [page_key(1, u'front page')])
+        count_hit('test:parks')
+        count_hit('test:parks')
+        count_hit('test:front')
+
+        invalidated = purge_cached([page_key(1, u'front page')])
+        self.assertEqual(rank_by_traffic(list(invalidated)),
+                         ['test:parks', 'test:front'])
+
+    def test_is_warming_request(self):
+        factory = RequestFactory()
+        self.assertFalse(is_warming_request(factory.get('/')))
+        self.assertFalse(is_warming_request(factory.get('/', HTTP_X_CACHE_WARM='1')))
+        self.assertTrue(is_warming_request(
+            factory.get('/', HTTP_X_CACHE_WARM=_warming_token())))
+
+    def test_region_generation(self):
+        request = RequestFactory().get('/sf/')
+        generation = get_region_generation('sf', request)
+        self.assertEqual(get_region_generation('sf'), generation)
+
+        bump_region_generation('sf')
+        self.assertEqual(get_region_generation('sf'), generation + 1)
+        # Read once per request.
+        self.assertEqual(get_region_generation('sf', request), generation)
+        self.assertEqual(get_region_generation('oakland', request),
+                         get_region_generation('oakland'))
+
+    def test_region_keys(self):
+        request = RequestFactory().get('/sf/')
+        self.assertEqual(region_keys(request), [])
+        get_region_generation('san francisco', request)
+        self.assertEqual(region_keys(request), ['region:san%20francisco'])
+        # Never collapsed away.
+        self.assertEqual(collapsed_key(region_key('sf')), 'region:sf')
+
+
+class OnCommitTests(TestCase):
+    def test_on_commit(self):
+        calls = []
+        on_commit(calls.append, 1)
+        self.assertEqual(calls, [1])
+
+        with deferred_until_commit():
+            on_commit(calls.append, 2)
+            with deferred_until_commit():
+                on_commit(calls.append, 3)
+            self.assertEqual(calls, [1])
+        self.assertEqual(calls, [1, 2, 3])
+
+    def test_rolled_back(self):
+        calls = []
+        try:
+            with deferred_until_commit():
+                on_commit(calls.append, 1)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(calls, [])
+        on_commit(calls.append, 2)
+        self.assertEqual(calls, [2])
+
+
 class CanonicalURLTests(TestCase):
     def has_canonical_url(self, url, request, response):
         from phased.middleware import PhasedRenderMiddleware
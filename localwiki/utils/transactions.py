@@ -0,0 +1,75 @@
+"""
+Running code once the current transaction has committed.
+
+Under TransactionMiddleware, a request's writes only become visible to
+other processes when the response goes out.  Cache invalidation done
+before then, e.g. from a post_save handler, races with other processes:
+one of them can reload the old rows after the invalidation and keep them
+cached, possibly for good.  `on_commit()` instead runs the invalidation
+after the request's transaction has committed (see OnCommitMiddleware),
+or, inside `deferred_until_commit()`, at the end of the block.
+
+Anywhere else, e.g. in tasks and management commands outside of such a
+block, the function runs right away.
+"""
+import threading
+from contextlib import contextmanager
+
+_local = threading.local()
+
+
+def on_commit(func, *args, **kwargs):
+    """
+    Calls func(*args, **kwargs) once the current transaction has
+    committed, or right away if we're not deferring.  Nothing's called if
+    the transaction is rolled back.
+    """
+    pending = getattr(_local, 'pending', None)
+    if pending is None:
+        func(*args, **kwargs)
+    else:
+        pending.append((func, args, kwargs))
+
+
+def begin():
+    """
+    Starts deferring on_commit() calls.
+    """
+    _local.pending = []
+
+
+def discard():
+    """
+    Drops the deferred calls, e.g. after a rollback.
+    """
+    _local.pending = None
+
+
+def run_pending():
+    """
+    Makes the deferred calls, after the transaction has committed.
+    """
+    pending = getattr(_local, 'pending', None)
+    _local.pending = None
+    for func, args, kwargs in pending or []:
+        func(*args, **kwargs)
+
+
+@contextmanager
+def deferred_until_commit():
+    """
+    Defers the on_commit() calls made inside the `with` block to the end
+    of it, if it completes.  Wrap a `transaction.commit_on_success()`
+    block in it.  Nested inside a request, or another such block, calls
+    are deferred to the outermost one.
+    """
+    if getattr(_local, 'pending', None) is not None:
+        yield
+        return
+    begin()
+    try:
+        yield
+    except:
+        discard()
+        raise
+    run_pending()
@@ -1,3 +1,4 @@
+import hashlib
 import time
 
 from django.utils.decorators import classonlymethod
@@ -23,6 +24,10 @@ from django.template.context import RequestContext
 from versionutils.versioning.views import RevertView, DeleteView
 
 from . import take_n_from
+from .cache import (get_dependencies, index_cache_key, cache_entry,
+    set_entry, unpack_entry, dependency_markers, xkey_header,
+    region_keys)
+from .warming import record_warm_info, count_hit, is_warming_request
 
 # 29 days, effectively infinite in cache years
 # XXX NOTE: For some reason, the memcached client we're using
@@ -45,6 +50,19 @@ class NeverCacheMixin(object):
 class CacheMixin(object):
     cache_timeout = DEFAULT_MEMCACHED_TIMEOUT
     cache_keep_forever = False
+    # After this many seconds the cached response goes stale: one request
+    # regenerates it while the others are served the stale response.
+    # Defaults to cache_timeout.
+    cache_soft_timeout = None
+    # Whether invalidating the cached response (see utils.cache.purge_cached)
+    # marks it stale rather than deleting it.
+    cache_serve_stale = False
+    # How long one request gets to regenerate a stale response before
+    # another one tries.
+    cache_lock_timeout = 30
+    # Whether to re-render the response right after it's invalidated (see
+    # utils.warming).
+    cache_warm = False
 
     @staticmethod
     def get_cache_key(request=None, **kwargs):
@@ -64,19 +82,61 @@ class CacheMixin(object):
 
         return True
 
+    def get_cache_dependencies(self):
+        """
+        Override this to return the dependency keys (see utils.cache) of the
+        response, besides those recorded while rendering it.
+        """
+        return []
+
     def _get_from_cache(self, method, request, *args, **kwargs):
         key = self.get_cache_key(request=request, **kwargs)
-
-        response = cache.get(key)
-        if response is None:
+        # Control characters and whitespace not allowed in memcached keys
+        lock_key = 'lock:%s' % hashlib.sha1(key).hexdigest()
+
+        def _set_cache(response):
+            keys = set(self.get_cache_dependencies())
+            keys.update(get_dependencies(request))
+            markers = []
+            # For purging from Varnish, see pages.cache.purge and
+            # regions.cache.invalidate_region
+            xkeys = keys.union(region_keys(request))
+            if xkeys:
+                response['xkey'] = xkey_header(xkeys)
+            if keys:
+                markers = dependency_markers(keys, rendered_at[0])
+                index_cache_key(key, keys)
+            set_entry(key, cache_entry(response, self.cache_timeout,
+                self.cache_soft_timeout, self.cache_serve_stale,
+                dependencies=markers, rendered_at=rendered_at[0]),
+                self.cache_timeout)
+            cache.delete(lock_key)
+            if self.cache_warm:
+                record_warm_info(key, request, self.cache_timeout)
+
+        # When the response started rendering.  Invalidations after that
+        # make it stale (see utils.cache.dependency_markers).
+        rendered_at = []
+
+        if self.cache_warm and not is_warming_request(request):
+            count_hit(key)
+
+        response, is_stale = unpack_entry(cache.get(key))
+        # Only the request that gets the lock regenerates a stale response,
+        # the others are served the stale one in the meantime.
+        if response is None or (is_stale and
+                cache.add(lock_key, True, self.cache_lock_timeout)):
+            rendered_at.append(time.time())
             response = getattr(super(CacheMixin, self), method)(request, *args, **kwargs)
 
             if hasattr(response, 'render') and callable(response.render):
-                response.add_post_render_callback(
-                    lambda r: cache.set(key, r, self.cache_timeout)
-                )
+                response.add_post_render_callback(_set_cache)
             else:
-                cache.set(key, response, self.cache_timeout)
+                _set_cache(response)
+        elif is_stale:
+            # Don't let other cache layers hold on to the stale response.
+            patch_response_headers(response, 0)
+            return response
 
         if self._should_cache(request, response):
             # Mark to keep around in Varnish and other cache layers
@@ -95,6 +155,7 @@ class CacheMixin(object):
     @classmethod
     def get_region_slug_param(*args, **kwargs):
         from regions.models import RegionSettings
+        from regions.resolver import region_for_domain
 
         if kwargs.get('region'):
             return kwargs.get('region')
@@ -103,7 +164,13 @@ class CacheMixin(object):
             raise KeyError("Need either `request` or a `region` parameter.")
 
         request = kwargs.get('request')
-        return RegionSettings.objects.get(domain=request.META['HTTP_HOST']).region.slug
+        host_route = getattr(request, 'host_route', None)
+        if host_route is not None:
+            return host_route['region_slug']
+        region = region_for_domain(request.META['HTTP_HOST'], request)
+        if region is None:
+            raise RegionSettings.DoesNotExist
+        return region.slug
 
 
 class Custom404Mixin(object):
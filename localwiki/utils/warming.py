@@ -0,0 +1,226 @@
+"""
+Cache re-warming.
+
+When cached views are invalidated (see `utils.cache.purge_cached`), the
+next visitor to each of them pays the full cost of rendering it.  Views
+that set `cache_warm` instead have their invalidated entries re-rendered
+right away, in the background, most visited first.
+
+Re-rendering goes through the full request handler, as if the page had
+been requested by an anonymous visitor.  Renders are spread out at
+CACHE_WARM_RATE per second by scheduling them, so no worker sits waiting.
+"""
+import hashlib
+import sys
+import time
+from StringIO import StringIO
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+from celery import shared_task
+
+# Visits are counted per hour.  We rank by the visits in the current and
+# previous hour.
+HIT_WINDOW = 60 * 60
+
+# Warming stats are counters, kept for as long as memcached allows.
+STATS_TIMEOUT = 60 * 60 * 24 * 29
+STATS_WARMED_KEY = 'cache_warm:stats:warmed'
+STATS_MILLISECONDS_KEY = 'cache_warm:stats:milliseconds'
+STATS_SLOW_KEY = 'cache_warm:stats:slow'
+
+# Renders taking longer than this many seconds are counted as slow.
+SLOW_SECONDS = 2
+
+_handler = None
+
+
+def _hash(cache_key):
+    return hashlib.sha1(cache_key).hexdigest()
+
+
+def _warm_info_key(cache_key):
+    return 'cache_warm:info:%s' % _hash(cache_key)
+
+
+def _hits_key(cache_key, window):
+    return 'cache_warm:hits:%d:%s' % (window, _hash(cache_key))
+
+
+def warming_enabled():
+    return getattr(settings, 'CACHE_WARM_ENABLED', True)
+
+
+def _warming_token():
+    return salted_hmac('localwiki.utils.warming', 'cache warm').hexdigest()
+
+
+def is_warming_request(request):
+    """
+    Returns:
+        True if the request was made by `fetch`.  The header carries a
+        token derived from SECRET_KEY, so visitors can't set it.
+    """
+    token = request.META.get('HTTP_X_CACHE_WARM')
+    return bool(token) and constant_time_compare(token, _warming_token())
+
+
+def record_warm_info(cache_key, request, timeout):
+    """
+    Records how to re-render the response cached under `cache_key`.
+    """
+    cache.set(_warm_info_key(cache_key), {
+        'host': request.META.get('HTTP_HOST', settings.MAIN_HOSTNAME),
+        'path': request.path,
+    }, timeout)
+
+
+def count_hit(cache_key):
+    key = _hits_key(cache_key, int(time.time() / HIT_WINDOW))
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Key doesn't exist yet.
+        cache.add(key, 1, HIT_WINDOW * 2)
+
+
+def rank_by_traffic(cache_keys):
+    """
+    Returns:
+        The cache keys, most visited first.
+    """
+    window = int(time.time() / HIT_WINDOW)
+    hits_keys = {}
+    for cache_key in cache_keys:
+        hits_keys[_hits_key(cache_key, window)] = cache_key
+        hits_keys[_hits_key(cache_key, window - 1)] = cache_key
+    hits = dict([(k, 0) for k in cache_keys])
+    for hits_key, count in cache.get_many(hits_keys.keys()).iteritems():
+        hits[hits_keys[hits_key]] += count
+    return sorted(cache_keys, key=lambda k: hits[k], reverse=True)
+
+
+def _get_handler():
+    global _handler
+    if _handler is None:
+        from django.core.handlers.wsgi import WSGIHandler
+        _handler = WSGIHandler()
+    return _handler
+
+
+def fetch(host, path, warming=True):
+    """
+    Requests `path` on `host` through the request handler.
+
+    Returns:
+        A tuple (status code, list of (header, value), content).
+    """
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path.encode('utf-8'),
+        'QUERY_STRING': '',
+        'SERVER_NAME': host.split(':')[0],
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'HTTP_HOST': host,
+        'REMOTE_ADDR': '127.0.0.1',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': StringIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if warming:
+        # So the render isn't counted as a visit.
+        environ['HTTP_X_CACHE_WARM'] = _warming_token()
+    started = []
+
+    def start_response(status, headers):
+        started.append((int(status.split()[0]), headers))
+
+    response = _get_handler()(environ, start_response)
+    try:
+        content = ''.join(response)
+    finally:
+        if hasattr(response, 'close'):
+            response.close()
+    status, headers = started[0]
+    return (status, headers, content)
+
+
+def render(info):
+    """
+    Renders the response described by `info` (see `record_warm_info`).
+    """
+    fetch(info['host'], info['path'])
+
+
+def _incr(key, delta=1):
+    if not cache.add(key, delta, STATS_TIMEOUT):
+        try:
+            cache.incr(key, delta)
+        except ValueError:
+            # Expired in between.
+            cache.add(key, delta, STATS_TIMEOUT)
+
+
+def _record_latency(seconds):
+    _incr(STATS_WARMED_KEY)
+    _incr(STATS_MILLISECONDS_KEY, int(seconds * 1000))
+    if seconds > SLOW_SECONDS:
+        _incr(STATS_SLOW_KEY)
+
+
+def warming_stats():
+    """
+    Returns:
+        A dictionary with the number of responses warmed, the average
+        time, in seconds, they took to render and the number of them that
+        took longer than SLOW_SECONDS.
+    """
+    stats = cache.get_many([STATS_WARMED_KEY, STATS_MILLISECONDS_KEY,
+                            STATS_SLOW_KEY])
+    warmed = stats.get(STATS_WARMED_KEY, 0)
+    milliseconds = stats.get(STATS_MILLISECONDS_KEY, 0)
+    return {
+        'warmed': warmed,
+        'average_seconds': milliseconds / 1000.0 / warmed if warmed else 0.0,
+        'slow': stats.get(STATS_SLOW_KEY, 0),
+    }
+
+
+def queue_warming(cache_keys):
+    """
+    Queues the re-rendering of the invalidated responses cached under the
+    given keys.  Responses of views that don't set `cache_warm` are
+    skipped.
+    """
+    if not warming_enabled() or not cache_keys:
+        return
+    infos = cache.get_many([_warm_info_key(k) for k in cache_keys])
+    cache_keys = [k for k in cache_keys if _warm_info_key(k) in infos]
+    if not cache_keys:
+        return
+
+    cache_keys = rank_by_traffic(cache_keys)
+    cache_keys = cache_keys[:getattr(settings, 'CACHE_WARM_MAX', 100)]
+    rate = getattr(settings, 'CACHE_WARM_RATE', 4)
+    # Most visited first, CACHE_WARM_RATE per second.
+    for i, cache_key in enumerate(cache_keys):
+        _async_warm.apply_async(args=[cache_key],
+                                countdown=float(i) / rate if rate else 0)
+
+
+@shared_task(ignore_result=True)
+def _async_warm(cache_key):
+    info = cache.get(_warm_info_key(cache_key))
+    if info is None:
+        return
+    start = time.time()
+    render(info)
+    _record_latency(time.time() - start)
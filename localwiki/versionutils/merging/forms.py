@@ -80,6 +80,8 @@ class MergeMixin(object):
             return getattr(instance, self.version_date_field)
 
         # if using versioning, return most recent version date
+        if getattr(instance, 'last_edit_date', None):
+            return instance.last_edit_date
         if is_versioned(instance):
             try:
                 return get_versions(instance).most_recent().version_info.date
@@ -1,2 +1,3 @@
 from registry import register
 from utils import get_versions
+from bulk import bulk_save, bulk_saved
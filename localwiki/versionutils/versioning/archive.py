@@ -0,0 +1,506 @@
+"""
+Archiving old historical records.
+
+Historical tables only grow, while nearly everything that reads them
+(recent changes, diffs of recent edits, most_recent()) wants the newest
+records.  `archive_history()` moves the records older than a given date
+out of a historical model's table, e.g. pages_page_hist, into its archive
+table, pages_page_hist_archive, which is split into a table per year
+(pages_page_hist_archive_y2012, ..) using PostgreSQL table inheritance.
+
+The most recent record of each object, and records that other historical
+records point to, stay in the historical table, so querying it alone
+gives the right answer for anything recent.  Requests that reach further
+back fall through to the archive:
+
+  * m.versions.as_of(..) looks in the archive when the historical table
+    has no matching record.
+  * queryset.with_archive() gives the records of a historical queryset,
+    followed through into the archive.  Full history listings use this.
+
+Deleting, renumbering or moving historical records (see
+archived_values_list(), update_archived() and delete_archived()) covers
+the archived ones, too, as does expanding the deltas that depend on a
+deleted record.
+
+Archive tables copy the historical table's columns when they're created
+and when archive_history() runs.  Run it (e.g. `localwiki-manage
+archive_history`) after migrating a historical table.
+"""
+import datetime
+import re
+from functools import cmp_to_key
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, router, transaction
+from django.db.models import get_models
+from django.db.models.constants import LOOKUP_SEP
+
+from utils import get_versions
+
+ARCHIVE_SUFFIX = '_archive'
+
+# How long we remember where a model's archive ends.  archive_history()
+# clears this.
+CACHE_TIMEOUT = 60 * 60
+
+
+def archive_after_days():
+    """
+    Returns:
+        The age, in days, of the records archive_history moves by default.
+    """
+    return getattr(settings, 'VERSIONUTILS_ARCHIVE_AFTER_DAYS', 365)
+
+
+def archive_before():
+    """
+    Returns:
+        The date before which archive_history archives records by default.
+    """
+    return datetime.datetime.now() - datetime.timedelta(
+        days=archive_after_days())
+
+
+def archive_table(hist_model):
+    return '%s%s' % (hist_model._meta.db_table, ARCHIVE_SUFFIX)
+
+
+def _partition_table(hist_model, year):
+    return '%s_y%d' % (archive_table(hist_model), year)
+
+
+def _cache_key(hist_model):
+    return 'versioning:newest_archived:%s' % hist_model._meta.db_table
+
+
+def _table_exists(cursor, table):
+    return table in cursor.db.introspection.table_names(cursor)
+
+
+def newest_archived(hist_model):
+    """
+    Returns:
+        The history_date of the newest archived record of `hist_model`, or
+        None if nothing's been archived.
+    """
+    key = _cache_key(hist_model)
+    newest = cache.get(key)
+    if newest is None:
+        cursor = connections[router.db_for_read(hist_model)].cursor()
+        table = archive_table(hist_model)
+        if _table_exists(cursor, table):
+            cursor.execute('SELECT max(history_date) FROM %s' %
+                           cursor.db.ops.quote_name(table))
+            newest = cursor.fetchone()[0]
+        # False means there's no archive, so we don't look again.
+        cache.set(key, newest or False, CACHE_TIMEOUT)
+    return newest or None
+
+
+def _historical_models():
+    return dict([(m._meta.db_table, m) for m in get_models()
+                 if hasattr(m, '_original_model')])
+
+
+def _archive_sql(queryset):
+    """
+    Returns:
+        (sql, params) for the query of `queryset` run against the archive
+        of its historical model.  Other historical tables in the query
+        are read along with their archives.
+    """
+    qn = connections[queryset.db].ops.quote_name
+    query = queryset.query.clone()
+    # Raw queries can't populate related objects.
+    query.select_related = False
+    sql, params = query.get_compiler(queryset.db).as_sql()
+    # Compiling sets up the query's tables.
+    tables = set([query.alias_map[alias].table_name for alias in query.tables])
+
+    def _from(table, source):
+        # Keep the table's name as its alias, so the rest of the query
+        # still refers to it.
+        pattern = re.compile(r'(FROM|JOIN) %s( T\d+\b)?' % re.escape(qn(table)))
+        return lambda sql: pattern.sub(
+            lambda m: '%s %s%s' % (m.group(1), source,
+                                   m.group(2) or ' %s' % qn(table)),
+            sql)
+
+    historical = _historical_models()
+    for table in tables:
+        hist_model = historical.get(table)
+        if hist_model is None:
+            continue
+        if hist_model is queryset.model:
+            sql = _from(table, qn(archive_table(hist_model)))(sql)
+        elif newest_archived(hist_model) is not None:
+            columns = ', '.join([qn(f.column)
+                                 for f in hist_model._meta.local_fields])
+            sql = _from(table, '(SELECT %s FROM %s UNION ALL SELECT %s FROM %s)' % (
+                columns, qn(table), columns,
+                qn(archive_table(hist_model))))(sql)
+    return sql, params
+
+
+def archived(queryset, limit=None):
+    """
+    Returns:
+        A list of the archived records matching `queryset`, a historical
+        queryset, up to `limit` of them.
+    """
+    if newest_archived(queryset.model) is None:
+        return []
+    sql, params = _archive_sql(queryset)
+    if limit is not None:
+        sql = '%s LIMIT %d' % (sql, limit)
+    manager = queryset.model._base_manager.db_manager(queryset.db)
+    return list(manager.raw(sql, params))
+
+
+def archived_count(queryset):
+    if newest_archived(queryset.model) is None:
+        return 0
+    sql, params = _archive_sql(queryset.order_by())
+    cursor = connections[queryset.db].cursor()
+    cursor.execute('SELECT count(*) FROM (%s) archived' % sql, params)
+    return cursor.fetchone()[0]
+
+
+def archived_count_by_day(queryset):
+    """
+    Returns:
+        A dict mapping each day to the number of archived records matching
+        `queryset`, a historical queryset, made on that day.
+    """
+    if newest_archived(queryset.model) is None:
+        return {}
+    sql, params = _archive_sql(queryset.order_by().values_list('history_date'))
+    cursor = connections[queryset.db].cursor()
+    cursor.execute('SELECT date(history_date), count(*) FROM (%s) archived '
+                   'GROUP BY 1' % sql, params)
+    return dict(cursor.fetchall())
+
+
+def archived_values_list(queryset, *fields):
+    """
+    Returns:
+        A list of tuples of the given fields of the archived records
+        matching `queryset`, a historical queryset.
+    """
+    if newest_archived(queryset.model) is None:
+        return []
+    sql, params = _archive_sql(queryset.values_list(*fields))
+    cursor = connections[queryset.db].cursor()
+    cursor.execute(sql, params)
+    return cursor.fetchall()
+
+
+def update_archived(hist_model, pks, **values):
+    """
+    Sets the fields of the archived records of `hist_model` with the
+    primary keys `pks`, like queryset.update(**values).
+    """
+    pks = list(pks)
+    if not pks or newest_archived(hist_model) is None:
+        return
+    connection = connections[router.db_for_write(hist_model)]
+    qn = connection.ops.quote_name
+    columns, params = [], []
+    for name, value in values.iteritems():
+        field = hist_model._meta.get_field(name)
+        if hasattr(value, 'prepare_database_save'):
+            # A related object, as in SQLUpdateCompiler.
+            value = value.prepare_database_save(field)
+        else:
+            value = field.get_db_prep_save(value, connection=connection)
+        columns.append('%s = %%s' % qn(field.column))
+        params.append(value)
+    cursor = connection.cursor()
+    # Updates the partitions, too.
+    cursor.execute('UPDATE %s SET %s WHERE %s = ANY(%%s)' % (
+        qn(archive_table(hist_model)), ', '.join(columns),
+        qn(hist_model._meta.pk.column)), params + [pks])
+
+
+def delete_archived(queryset):
+    """
+    Deletes the archived records matching `queryset`, a historical
+    queryset.  Unlike deleting historical records, this sends no signals,
+    so the deltas that depend on them (older records of the same object)
+    must be deleted along with them.
+
+    Returns:
+        The number of records deleted.
+    """
+    hist_model = queryset.model
+    if newest_archived(hist_model) is None:
+        return 0
+    pk_name = hist_model._meta.pk.name
+    sql, params = _archive_sql(queryset.order_by().values_list(pk_name))
+    cursor = connections[router.db_for_write(hist_model)].cursor()
+    qn = cursor.db.ops.quote_name
+    cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+        qn(archive_table(hist_model)), qn(hist_model._meta.pk.column), sql),
+        params)
+    cache.delete(_cache_key(hist_model))
+    return cursor.rowcount
+
+
+def archived_value(hist_model, pk, name):
+    """
+    Returns:
+        The stored value of field `name` of the archived record with
+        primary key `pk`.
+    """
+    if newest_archived(hist_model) is None:
+        raise hist_model.DoesNotExist
+    cursor = connections[router.db_for_read(hist_model)].cursor()
+    qn = cursor.db.ops.quote_name
+    cursor.execute('SELECT %s FROM %s WHERE %s = %%s' % (
+        qn(hist_model._meta.get_field(name).column),
+        qn(archive_table(hist_model)), qn(hist_model._meta.pk.column)),
+        [pk])
+    row = cursor.fetchone()
+    if row is None:
+        raise hist_model.DoesNotExist
+    return row[0]
+
+
+def _cmp(a, b):
+    # As PostgreSQL sorts NULLs: after everything else.
+    if a is None or b is None:
+        return cmp(a is None, b is None)
+    return cmp(a, b)
+
+
+class HistoryWithArchive(object):
+    """
+    The records of a historical queryset, followed through into the
+    archive.  Supports what listings and paginators need: iteration,
+    indexing, slicing and count().
+
+    The archive is only read when the records asked for might be in it.
+    Records from the two tables are merged in the queryset's ordering.
+    """
+    def __init__(self, queryset):
+        self.queryset = queryset
+        self.model = queryset.model
+        self._result_cache = None
+        self._count = None
+
+    def _ordering(self):
+        """
+        Returns:
+            A list of (attname, descending) for the queryset's ordering,
+            or None if we can't order the records in Python.
+        """
+        query = self.queryset.query
+        names = list(query.extra_order_by or query.order_by or
+                     (query.default_ordering and self.model._meta.ordering or []))
+        ordering = []
+        for name in names:
+            descending = name.startswith('-')
+            name = name.lstrip('-')
+            if name == 'pk':
+                name = self.model._meta.pk.name
+            if name == '?' or LOOKUP_SEP in name:
+                return None
+            try:
+                field = self.model._meta.get_field(name)
+            except Exception:
+                return None
+            ordering.append((field.attname, descending))
+        return ordering
+
+    def _reaches_archive(self, newest, hot, stop):
+        if newest is None:
+            return False
+        if stop is None or len(hot) < stop:
+            # Went through all the records in the historical table.
+            return True
+        ordering = self._ordering()
+        if ordering and ordering[0] == ('history_date', True):
+            # Newest first, and the last one's newer than the archive.
+            return hot[-1].history_date <= newest
+        return True
+
+    def _merge(self, hot, old):
+        ordering = self._ordering()
+        if not ordering:
+            return hot + old
+
+        def _compare(a, b):
+            for attname, descending in ordering:
+                result = _cmp(getattr(a, attname), getattr(b, attname))
+                if result:
+                    return -result if descending else result
+            return 0
+        return sorted(hot + old, key=cmp_to_key(_compare))
+
+    def _fetch(self, stop=None):
+        if self._result_cache is not None:
+            return self._result_cache[:stop]
+        hot = list(self.queryset if stop is None else self.queryset[:stop])
+        newest = newest_archived(self.model)
+        if self._reaches_archive(newest, hot, stop):
+            records = self._merge(hot, archived(self.queryset, stop))
+        else:
+            records = hot
+        if stop is None:
+            self._result_cache = records
+        return records[:stop]
+
+    def __iter__(self):
+        return iter(self._fetch())
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            if k.step is not None or (k.start or 0) < 0 or (
+                    k.stop is not None and k.stop < 0):
+                raise ValueError("Negative indexing or steps aren't supported.")
+            return self._fetch(k.stop)[k.start or 0:]
+        if k < 0:
+            raise ValueError("Negative indexing isn't supported.")
+        records = self._fetch(k + 1)
+        if len(records) <= k:
+            raise IndexError
+        return records[k]
+
+    def __nonzero__(self):
+        return bool(self._fetch(1))
+
+    def count(self):
+        if self._count is None:
+            if self._result_cache is not None:
+                self._count = len(self._result_cache)
+            else:
+                self._count = (self.queryset.count() +
+                               archived_count(self.queryset))
+        return self._count
+
+    __len__ = count
+
+
+def _sync_archive_table(cursor, hist_model):
+    """
+    Creates the archive table of `hist_model`, or adds the historical
+    table's new columns to it.
+    """
+    qn = cursor.db.ops.quote_name
+    table = hist_model._meta.db_table
+    archive = archive_table(hist_model)
+    if not _table_exists(cursor, archive):
+        cursor.execute('CREATE TABLE %s (LIKE %s)' % (qn(archive), qn(table)))
+        return
+    cursor.execute("""
+        SELECT a.attname, format_type(a.atttypid, a.atttypmod)
+        FROM pg_attribute a
+        WHERE a.attrelid = %s::regclass AND a.attnum > 0
+        AND NOT a.attisdropped AND a.attname NOT IN (
+            SELECT attname FROM pg_attribute
+            WHERE attrelid = %s::regclass AND NOT attisdropped)
+        ORDER BY a.attnum""", [qn(table), qn(archive)])
+    for column, column_type in cursor.fetchall():
+        # Partitions inherit the new column.
+        cursor.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+            qn(archive), qn(column), column_type))
+
+
+def _create_partition(cursor, hist_model, year):
+    qn = cursor.db.ops.quote_name
+    partition = _partition_table(hist_model, year)
+    if _table_exists(cursor, partition):
+        return partition
+    # With the historical table's indexes, so lookups by object and date
+    # stay fast.
+    cursor.execute("""
+        CREATE TABLE %s (
+            LIKE %s INCLUDING INDEXES,
+            CHECK (history_date >= '%d-01-01' AND history_date < '%d-01-01')
+        ) INHERITS (%s)""" % (
+        qn(partition), qn(hist_model._meta.db_table), year, year + 1,
+        qn(archive_table(hist_model))))
+    return partition
+
+
+def _kept_hot(qn, hist_model):
+    """
+    Returns:
+        SQL conditions for the records of `hist_model`, aliased h, that
+        can be archived: ones with a newer record of the same object, that
+        no remaining historical record points to.
+    """
+    pk_column = qn(hist_model._original_model._meta.pk.column)
+    conditions = ["""EXISTS (
+        SELECT 1 FROM %s n WHERE n.%s = h.%s
+        AND (n.history_date, n.history_id) > (h.history_date, h.history_id))""" % (
+        qn(hist_model._meta.db_table), pk_column, pk_column)]
+    opts = hist_model._meta
+    references = [(r.model._meta.db_table, r.field.column)
+                  for r in opts.get_all_related_objects(include_hidden=True)]
+    references += [(r.field.m2m_db_table(), r.field.m2m_reverse_name())
+                   for r in opts.get_all_related_many_to_many_objects()]
+    for table, column in references:
+        conditions.append(
+            'NOT EXISTS (SELECT 1 FROM %s r WHERE r.%s = h.history_id)' % (
+                qn(table), qn(column)))
+    return ' AND '.join(conditions)
+
+
+def archive_history(model, before, batch_size=1000):
+    """
+    Moves the historical records of `model` older than `before` to its
+    archive, a batch at a time.  The most recent record of each object,
+    and records other historical records point to, are kept.
+
+    PostgreSQL only.  Models whose historical records have many-to-many
+    fields, or versioned parents, can't be archived.
+
+    Args:
+        model: A versioned model.
+        before: A datetime.
+
+    Returns:
+        The number of records archived.
+    """
+    hist_model = get_versions(model).model
+    if hist_model._meta.many_to_many or hist_model._meta.parents:
+        raise ValueError("%s's history can't be archived." %
+                         model._meta.object_name)
+    db = router.db_for_write(hist_model)
+    cursor = connections[db].cursor()
+    qn = cursor.db.ops.quote_name
+    table = qn(hist_model._meta.db_table)
+    columns = ', '.join([qn(f.column) for f in hist_model._meta.local_fields])
+
+    with transaction.commit_on_success(using=db):
+        _sync_archive_table(cursor, hist_model)
+
+    archived_total = 0
+    while True:
+        with transaction.commit_on_success(using=db):
+            cursor.execute("""
+                SELECT h.history_id, extract(year FROM h.history_date)::int
+                FROM %s h WHERE h.history_date < %%s AND %s
+                ORDER BY h.history_id LIMIT %d""" % (
+                table, _kept_hot(qn, hist_model), batch_size), [before])
+            rows = cursor.fetchall()
+            by_year = {}
+            for history_id, year in rows:
+                by_year.setdefault(year, []).append(history_id)
+            for year, ids in by_year.iteritems():
+                partition = _create_partition(cursor, hist_model, year)
+                cursor.execute("""
+                    WITH moved AS (
+                        DELETE FROM %s WHERE history_id = ANY(%%s)
+                        RETURNING %s)
+                    INSERT INTO %s (%s) SELECT %s FROM moved""" % (
+                    table, columns, qn(partition), columns, columns), [ids])
+        archived_total += len(rows)
+        if len(rows) < batch_size:
+            break
+
+    cache.delete(_cache_key(hist_model))
+    return archived_total
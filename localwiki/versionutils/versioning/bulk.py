@@ -0,0 +1,301 @@
+"""
+Saving versioned objects in bulk.
+
+Saving a versioned object writes its row and then, from a post_save
+handler, its historical record: two INSERTs and a round of signals per
+object.  `bulk_save()` inserts the rows of new objects, and the historical
+records of all the objects, with an INSERT per model, and sends one
+`bulk_saved` signal per model in place of the pre_save and post_save
+signals.  Receivers that care about bulk saves (links, caches, search)
+handle the objects in batch.
+
+Models' save() methods aren't called either.  Models that derive some
+fields from others in save() (e.g. a page's slug from its name) should do
+it in a `prepare_save()` method, which bulk_save() calls before saving.
+"""
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import AutoField
+from django.dispatch import Signal
+
+from constants import *
+from utils import is_versioned, get_versions, next_version_numbers
+from middleware import _threadlocal, AutoTrackUserInfoMiddleware
+
+# Sent once per model after a bulk_save().  `instances` is the list of
+# saved objects and `created` the set of primary keys of the new ones.
+bulk_saved = Signal(providing_args=['instances', 'created'])
+
+
+def _reserve_pks(model, count, using):
+    """
+    Returns:
+        `count` values from the sequence of the model's AutoField primary
+        key.
+    """
+    cursor = connections[using].cursor()
+    cursor.execute(
+        "SELECT nextval(pg_get_serial_sequence(%s, %s)) "
+        "FROM generate_series(1, %s)",
+        [model._meta.db_table, model._meta.pk.column, count])
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _insert(model, objs, using, need_pks=True):
+    """
+    Inserts the objects, setting their primary keys if `need_pks`.
+    """
+    manager = model._base_manager.db_manager(using)
+    pk = model._meta.pk
+    if not need_pks or not isinstance(pk, AutoField):
+        manager.bulk_create(objs)
+    elif connections[using].vendor == 'postgresql':
+        # Django doesn't give us the primary keys of bulk-created objects,
+        # so take them from the sequence first.
+        no_pk = [obj for obj in objs if obj.pk is None]
+        for obj, value in zip(no_pk, _reserve_pks(model, len(no_pk), using)):
+            obj.pk = value
+        manager.bulk_create(objs)
+    else:
+        # One at a time, as Model.save_base() does, minus the signals.
+        fields = [f for f in model._meta.local_fields
+                  if not isinstance(f, AutoField)]
+        for obj in objs:
+            obj.pk = manager._insert([obj], fields=fields, return_id=True,
+                                     using=using)
+
+
+def _update(model, obj, using):
+    # Like Model.save_base() does for existing rows, minus the signals.
+    values = {}
+    for field in model._meta.local_fields:
+        if field.primary_key:
+            continue
+        values[field.name] = field.pre_save(obj, False)
+    model._base_manager.using(using).filter(pk=obj.pk).update(**values)
+
+
+def _update_rows(model, names, rows, using):
+    """
+    Sets the fields `names` of each row, like an UPDATE per row, but with
+    one UPDATE on PostgreSQL.
+
+    Args:
+        rows: A list of (pk, values), `values` being the values of the
+            fields in order.  Each primary key is listed once.
+    """
+    if not rows:
+        return
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        for pk, values in rows:
+            model._base_manager.using(using).filter(pk=pk).update(
+                **dict(zip(names, values)))
+        return
+    qn = connection.ops.quote_name
+    pk = model._meta.pk
+    fields = [model._meta.get_field(name) for name in names]
+    params = []
+    for pk_value, values in rows:
+        params.append(pk.get_db_prep_save(pk_value, connection=connection))
+        for field, value in zip(fields, values):
+            params.append(field.get_db_prep_save(value, connection=connection))
+    row_sql = '(%s)' % ', '.join(['%s'] * (len(fields) + 1))
+    # Cast, as a column of NULLs has no type.
+    cursor = connection.cursor()
+    cursor.execute(
+        'UPDATE %(table)s SET %(set)s FROM (VALUES %(rows)s) '
+        'AS v (%(columns)s) WHERE %(table)s.%(pk)s = v.%(pk)s' % {
+            'table': qn(model._meta.db_table),
+            'set': ', '.join(['%s = CAST(v.%s AS %s)' % (
+                qn(f.column), qn(f.column), f.db_type(connection))
+                for f in fields]),
+            'rows': ', '.join([row_sql] * len(rows)),
+            'columns': ', '.join([qn(pk.column)] +
+                                 [qn(f.column) for f in fields]),
+            'pk': qn(pk.column),
+        }, params)
+
+
+def _history_type(obj, created):
+    # As in ChangesTracker.post_save.
+    history_type = getattr(obj, '_history_type', None)
+    if history_type == TYPE_REVERTED_CASCADE:
+        return history_type
+    if created:
+        if history_type == TYPE_REVERTED:
+            return TYPE_REVERTED_ADDED
+        return TYPE_ADDED
+    return history_type or TYPE_UPDATED
+
+
+def _store_deltas(tracker, hists, using):
+    """
+    ChangesTracker.store_deltas() for each of the new records `hists`,
+    with the records before them looked up in one query on PostgreSQL.
+    """
+    if not tracker.delta_fields or not hists:
+        return
+    if connections[using].vendor != 'postgresql':
+        for hist in hists:
+            tracker.store_deltas(hist)
+        return
+    hist_model = hists[0].__class__
+    pk_name = hist_model._original_model._meta.pk.name
+    fields = ['history_id', 'history_version_number'] + list(
+        tracker.delta_fields)
+    # The newest older record of each object.
+    previous = hist_model._base_manager.using(using).filter(
+        **{'%s__in' % pk_name: set([h.__dict__[pk_name] for h in hists])}
+    ).exclude(pk__in=[h.pk for h in hists])
+    previous = previous.order_by(pk_name, '-history_date', '-history_id')
+    previous = previous.distinct(pk_name).values(pk_name, *fields)
+    previous = dict([(row[pk_name], row) for row in previous])
+
+    rows = []
+    for hist in hists:
+        raw = hist.__dict__
+        before = previous.get(raw[pk_name])
+        if before is not None:
+            stored = tracker.deltas_from(hist, before)
+            if stored:
+                rows.append((before['history_id'],
+                             [stored.get(name, before[name])
+                              for name in tracker.delta_fields]))
+        # An object's later records come after this one.
+        previous[raw[pk_name]] = dict([(name, raw[name]) for name in fields])
+    _update_rows(hist_model, tracker.delta_fields, rows, using)
+
+
+def _update_last_edits(model, records, using):
+    """
+    ChangesTracker.update_last_edit() for each of the (obj, hist) records,
+    with one UPDATE on PostgreSQL.
+    """
+    if not records or not hasattr(records[0][0], 'last_edit_date'):
+        return
+    names = ['last_edit_date', 'last_editor', 'version_count']
+    latest = {}
+    for obj, hist in records:
+        if hist.history_type in DELETED_TYPES:
+            continue
+        values = [hist.history_date, hist.history_user_id,
+                  hist.history_version_number]
+        obj.last_edit_date, obj.last_editor_id, obj.version_count = values
+        # The object's newest record, if it's listed more than once.
+        latest[obj.pk] = values
+    _update_rows(model, names, latest.items(), using)
+
+
+def _historical_records(model, objs, created, using):
+    # writebehind imports this module.
+    import writebehind
+
+    tracker = model._changes_tracker
+    hist_model = get_versions(model).model
+    track_user_info = hasattr(_threadlocal, 'request')
+
+    objs = [obj for obj in objs if obj._track_changes]
+    if not objs:
+        return
+    pks = set([obj.pk for obj in objs])
+    # Their queued records come first.
+    writebehind.flush_instances(model, pks)
+    # Lock the objects' rows until the transaction ends, so concurrent
+    # saves of them can't take the same version numbers.
+    list(model._base_manager.using(using).select_for_update().filter(
+        pk__in=pks).values_list('pk', flat=True))
+
+    records = []
+    for obj, number in zip(objs, next_version_numbers(objs)):
+        hist = hist_model(
+            history_type=_history_type(obj, obj.pk in created),
+            **tracker.historical_record_attrs(obj, version_number=number))
+        if track_user_info:
+            # What AutoTrackUserInfoMiddleware does on pre_save.
+            AutoTrackUserInfoMiddleware().update_fields(hist_model, hist)
+        records.append((obj, hist))
+
+    many_to_many = model._meta.many_to_many
+    _insert(hist_model, [hist for obj, hist in records], using,
+            need_pks=bool(many_to_many or tracker.delta_fields))
+    if many_to_many:
+        for obj, hist in records:
+            tracker.m2m_init(obj, hist)
+    _store_deltas(tracker, [hist for obj, hist in records], using)
+    _update_last_edits(model, records, using)
+
+
+def bulk_save(objs, comment=None, user=None, user_ip=None,
+              track_changes=True, using=None):
+    """
+    Saves the versioned objects, along with their historical records, in
+    bulk.
+
+    New objects are inserted with one INSERT per model (on PostgreSQL; we
+    can't get the primary keys of bulk-inserted rows elsewhere).  Django
+    has no bulk UPDATE of different values, so existing objects are
+    updated one at a time.  Either way, instead of pre_save and post_save,
+    `bulk_saved` is sent once per model when everything's been saved, and
+    instead of save(), each object's `prepare_save()`, if it has one, is
+    called first.
+
+    Args:
+        objs: Instances of versioned models.  They're saved, and
+            `bulk_saved` sent, a run of objects of the same model at a
+            time, in order, so list objects before the objects that point
+            at them.
+        comment: The comment stored on the historical records, as in
+            save(comment=..).
+        user: The user stored on the historical records.  Defaults to the
+            current request's user, as set by AutoTrackUserInfoMiddleware.
+        user_ip: The IP address stored on the historical records.
+            Defaults to the current request's.
+        track_changes: If False, no historical records are written.
+
+    Returns:
+        The saved objects.
+    """
+    save_with = {}
+    for k, v in (('comment', comment), ('user', user), ('user_ip', user_ip)):
+        if v is not None:
+            save_with[k] = v
+
+    by_model = []
+    for obj in objs:
+        model = obj.__class__
+        if not is_versioned(model):
+            raise TypeError("%s isn't versioned." % model._meta.object_name)
+        if not by_model or by_model[-1][0] != model:
+            by_model.append((model, []))
+        by_model[-1][1].append(obj)
+
+    versioning = getattr(settings, 'VERSIONUTILS_VERSIONING_ENABLED', True)
+    saved = []
+    with transaction.commit_on_success(using=using):
+        for model, objs in by_model:
+            db = using or router.db_for_write(model)
+            for obj in objs:
+                obj._track_changes = track_changes and versioning
+                obj._save_with = dict(save_with)
+                if hasattr(obj, 'prepare_save'):
+                    obj.prepare_save()
+
+            pks = [obj.pk for obj in objs if obj.pk is not None]
+            existing = set(model._base_manager.using(db).filter(
+                pk__in=pks).values_list('pk', flat=True))
+            new = [obj for obj in objs if obj.pk not in existing]
+            _insert(model, new, db)
+            for obj in objs:
+                if obj.pk in existing:
+                    _update(model, obj, db)
+                obj._state.adding = False
+                obj._state.db = db
+
+            created = set([obj.pk for obj in new])
+            _historical_records(model, objs, created, db)
+            saved.append((model, objs, created))
+
+    for model, objs, created in saved:
+        bulk_saved.send(sender=model, instances=objs, created=created)
+    return [obj for model, objs in by_model for obj in objs]
@@ -28,3 +28,8 @@ REVERTED_TYPES = [
     TYPE_REVERTED, TYPE_REVERTED_ADDED, TYPE_REVERTED_DELETED,
     TYPE_REVERTED_DELETED_CASCADE, TYPE_REVERTED_CASCADE
 ]
+
+# The denormalized fields of models with versioning.models.LastEditFields.
+# They're kept up to date from the most recent historical record, rather
+# than copied into the historical records.
+LAST_EDIT_FIELDS = ('last_edit_date', 'last_editor', 'version_count')
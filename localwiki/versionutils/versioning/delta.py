@@ -0,0 +1,145 @@
+"""
+Delta-compressed storage of large text fields in historical records.
+
+Registering a model with `delta_fields`, e.g.
+
+    versioning.register(Page, delta_fields=['content'])
+
+stores those fields of its historical records as reverse deltas: when a
+new version is saved, the field in the version before it is replaced by a
+compressed delta that rebuilds it from the new version.  The most recent
+version, and every KEYFRAME_INTERVAL'th version, keep the full value, so
+rebuilding a version reads at most KEYFRAME_INTERVAL records.
+
+Deltas are rebuilt when the field is accessed on a historical instance,
+so code reading historical records doesn't need to know about them.
+Deleting a historical record first expands the delta that depends on it.
+"""
+import base64
+import json
+import re
+import zlib
+
+from django.conf import settings
+
+from archive import archived_value
+
+# Stored values starting with this are deltas.  It can't appear in
+# (sanitized) HTML, and PostgreSQL text can't hold a NUL.
+PREFIX = u'\x01delta:'
+
+# HTML often has no newlines, so we diff runs of text ending at a tag or
+# a line.
+_token_re = re.compile(r'[^>\n]*[>\n]|[^>\n]+$')
+
+
+def keyframe_interval():
+    return getattr(settings, 'VERSIONUTILS_DELTA_KEYFRAME_INTERVAL', 10)
+
+
+def is_keyframe(version_number):
+    return version_number is None or version_number % keyframe_interval() == 0
+
+
+def is_delta(value):
+    return isinstance(value, basestring) and value.startswith(PREFIX)
+
+
+def _tokens(text):
+    return _token_re.findall(text)
+
+
+def make_delta(base, text):
+    """
+    Returns:
+        A list of operations that rebuild `text` from `base`: [i, j]
+        copies tokens i to j of `base`, a string is inserted as is.
+    """
+    from difflib import SequenceMatcher
+
+    base_tokens, tokens = _tokens(base), _tokens(text)
+    ops = []
+    matcher = SequenceMatcher(None, base_tokens, tokens, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(u''.join(tokens[j1:j2]))
+    return ops
+
+
+def apply_delta(base, ops):
+    base_tokens = _tokens(base)
+    parts = []
+    for op in ops:
+        if isinstance(op, list):
+            parts.extend(base_tokens[op[0]:op[1]])
+        else:
+            parts.append(op)
+    return u''.join(parts)
+
+
+def encode(base_pk, ops):
+    """
+    Returns:
+        The value stored for a delta from the historical record with
+        primary key `base_pk`.
+    """
+    data = zlib.compress(json.dumps(ops, separators=(',', ':')), 9)
+    return u'%s%d:%s' % (PREFIX, base_pk, base64.b64encode(data))
+
+
+def decode(value):
+    """
+    Returns:
+        A tuple (base_pk, ops) for the stored delta.
+    """
+    base_pk, data = value[len(PREFIX):].split(u':', 1)
+    return (int(base_pk), json.loads(zlib.decompress(base64.b64decode(data))))
+
+
+def delta_prefix(base_pk):
+    """
+    Returns:
+        The prefix of the stored deltas from the historical record with
+        primary key `base_pk`.
+    """
+    return u'%s%d:' % (PREFIX, base_pk)
+
+
+def compress(base_pk, base, value):
+    """
+    Returns:
+        The value to store for `value`, given the value `base` of the next
+        version: a delta, or `value` itself if the delta isn't smaller.
+    """
+    if value is None or base is None or is_delta(value) or is_delta(base):
+        return value
+    stored = encode(base_pk, make_delta(base, value))
+    if len(stored) >= len(value):
+        return value
+    return stored
+
+
+def _stored_value(hist_model, pk, name):
+    values = hist_model._base_manager.filter(pk=pk).values_list(name, flat=True)
+    if values:
+        return values[0]
+    # The base of an archived delta may be archived, too.
+    return archived_value(hist_model, pk, name)
+
+
+def expand(hist_model, value, name):
+    """
+    Returns:
+        The value of field `name` stored as `value` in a historical record
+        of `hist_model`.
+    """
+    chain = []
+    while is_delta(value):
+        base_pk, ops = decode(value)
+        chain.append(ops)
+        value = _stored_value(hist_model, base_pk, name)
+    for ops in reversed(chain):
+        value = apply_delta(value, ops)
+    return value
@@ -16,6 +16,7 @@ from django.core.exceptions import ObjectDoesNotExist
 
 from constants import *
 from utils import *
+import delta
 
 
 def get_history_methods(self, model):
@@ -23,6 +24,7 @@ def get_history_methods(self, model):
     Returns a dictionary of the essential methods that will be added to
     the histoical record model.
     """
+    delta_fields = frozenset(getattr(self, 'delta_fields', ()))
     fields = {
         # lookup function for cleaniness. Instead of doing
         # h.history_ip_address we can write h.version_info.ip_address
@@ -31,7 +33,8 @@ def get_history_methods(self, model):
         '__init__': historical_record_init,
         '__getattribute__':
             # not sure why functools.partial doesn't work here
-            lambda m, name: historical_record_getattribute(model, m, name),
+            lambda m, name: historical_record_getattribute(model, m, name,
+                                                           delta_fields),
     }
 
     return fields
@@ -52,7 +55,10 @@ def get_history_fields(self, model):
         'history__object_rel_populated': HistoricalObjectDescriptor(
             model, populate_related=True),
         'history_date': models.DateTimeField(default=datetime.datetime.now, db_index=True),
-        'history_version_number': version_number_of,
+        # Assigned when the record is created, see
+        # ChangesTracker.create_historical_record.
+        'history_version_number': models.PositiveIntegerField(null=True,
+            db_index=True),
         'history_type': models.SmallIntegerField(choices=TYPE_CHOICES),
         'history_type_verbose': type_to_verbose,
         # If you want to display "Reverted to version N" in every change
@@ -228,7 +234,7 @@ def _wrap_reverse_lookups(m):
         m._wrapped_lookup_fields[accessor] = SimpleLazyObject(_reverse_lookup)
 
 
-def historical_record_getattribute(model, m, name):
+def historical_record_getattribute(model, m, name, delta_fields=()):
     """
     We have to define our own __getattribute__ because otherwise there's
     no way to set our wrapped foreign key attributes.  We also use this
@@ -245,6 +251,8 @@ def historical_record_getattribute(model, m, name):
         model: A model class.
         m: The model instance.
         name: The string representing the attribute name.
+        delta_fields: Names of the fields that may be stored as deltas
+            (see delta.py), which we expand here.
     """
     basedict = model.__getattribute__(m, '__dict__')
     direct_val = basedict.get('_wrapped_lookup_fields', {}).get(name)
@@ -265,7 +273,11 @@ def historical_record_getattribute(model, m, name):
             # model instance.
             return m.version_info._object_rel_populated.__getattribute__(name)
 
-    return model.__getattribute__(m, name)
+    value = model.__getattribute__(m, name)
+    if name in delta_fields and delta.is_delta(value):
+        # Expand it once, keeping it on the instance.
+        value = basedict[name] = delta.expand(type(m), value, name)
+    return value
 
 
 def _cascade_revert(reverting_to_version, m, **kws):
@@ -434,13 +446,13 @@ def version_number_of(hm):
     Args:
         hm: Historical record instance.
     """
-    if getattr(hm.version_info.instance, '_version_number', None) is None:
+    number = hm.history_version_number
+    if number is None:
+        # Created before version numbers were stored.
         date = hm.version_info.date
         obj = hm.version_info._object
-        hm.version_info.instance._version_number = len(
-            get_versions(obj).filter(history_date__lte=date)
-        )
-    return hm.version_info.instance._version_number
+        number = get_versions(obj).filter(history_date__lte=date).count()
+    return number
 
 
 class HistoricalMetaInfo(object):
@@ -451,6 +463,9 @@ class HistoricalMetaInfo(object):
     def __getattr__(self, name):
         return getattr(self.__dict__['instance'], 'history_%s' % name)
 
+    def version_number(self):
+        return version_number_of(self.__dict__['instance'])
+
     def __setattr__(self, name, val):
         if name == 'instance':
             self.__dict__['instance'] = val
@@ -484,6 +499,10 @@ class HistoricalObjectDescriptor(object):
     def __get__(self, instance, owner):
         values = []
         for f in self.model._meta.fields:
+            if f.name in LAST_EDIT_FIELDS:
+                # Not kept in the historical records.
+                values.append(f.get_default())
+                continue
             related = getattr(f, 'related', None)
             if related and is_versioned(related.parent_model):
                 # If the field points to a related, versioned model then
@@ -0,0 +1,51 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db.models import get_model, get_models
+
+from versionutils.versioning import archive
+from versionutils.versioning.utils import get_versions, is_versioned
+
+
+class Command(BaseCommand):
+    help = ('Moves old historical records to the archive tables.  Archives '
+            'every versioned model unless given some.\n'
+            'Usage: localwiki-manage archive_history [app_label.Model ..]')
+    option_list = BaseCommand.option_list + (
+        make_option('--days', dest='days', type='int', default=None,
+            help=('Archive records older than this many days.  Defaults to '
+                  'VERSIONUTILS_ARCHIVE_AFTER_DAYS.')),
+        make_option('--batch-size', dest='batch_size', type='int',
+            default=1000, help='Records to move per transaction.'),
+    )
+
+    def handle(self, *labels, **options):
+        if labels:
+            models = []
+            for label in labels:
+                model = '.' in label and get_model(*label.split('.', 1))
+                if not model or not is_versioned(model):
+                    raise CommandError('"%s" is not a versioned model.' % label)
+                models.append(model)
+        else:
+            models = [m for m in get_models() if is_versioned(m) and
+                      not m._meta.proxy]
+
+        if options['days'] is None:
+            before = archive.archive_before()
+        else:
+            before = (datetime.datetime.now() -
+                      datetime.timedelta(days=options['days']))
+
+        for model in models:
+            hist_model = get_versions(model).model
+            if hist_model._meta.many_to_many or hist_model._meta.parents:
+                self.stdout.write("Skipping %s: its history can't be archived.\n" %
+                                  model._meta.object_name)
+                continue
+            count = archive.archive_history(model, before,
+                batch_size=options['batch_size'])
+            self.stdout.write('Archived %d %s records older than %s\n' % (
+                count, model._meta.object_name, before.date()))
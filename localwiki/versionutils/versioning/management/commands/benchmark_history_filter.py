@@ -0,0 +1,66 @@
+import datetime
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db.models import get_model, get_models
+
+from versionutils.versioning.manager import (compute_lookup_rewrites,
+    rewrite_lookup, translate_lookup)
+from versionutils.versioning.utils import get_versions, is_versioned
+
+
+class Command(BaseCommand):
+    help = ('Times rewriting historical filter() lookups, finding the '
+            'related models on every call versus once per model, along '
+            'with building the filtered querysets.  Nothing is queried.\n'
+            'Usage: localwiki-manage benchmark_history_filter [app_label.Model ..]')
+    option_list = BaseCommand.option_list + (
+        make_option('--calls', dest='calls', type='int', default=10000,
+            help='Number of filter() calls per model.'),
+    )
+
+    def handle(self, *labels, **options):
+        if labels:
+            models = [get_model(*label.split('.', 1)) for label in labels
+                      if '.' in label]
+            if len(models) != len(labels) or not all(
+                    m and is_versioned(m) for m in models):
+                raise CommandError('Provide versioned models, e.g. pages.Page.')
+        else:
+            models = [m for m in get_models() if is_versioned(m) and
+                      not m._meta.proxy]
+
+        calls = options['calls']
+        for model in models:
+            hist_model = get_versions(model).model
+            # Like the lookups of the activity and user views.
+            lookups = ['version_info__user', 'version_info__type__in',
+                       'history_date__gte', 'id']
+
+            start = time.time()
+            for i in range(calls):
+                rewrites = compute_lookup_rewrites(hist_model)
+                for k in lookups:
+                    rewrite_lookup(k, *rewrites)
+            uncached = time.time() - start
+
+            start = time.time()
+            for i in range(calls):
+                for k in lookups:
+                    translate_lookup(hist_model, k)
+            cached = time.time() - start
+
+            kws = {'version_info__user': None,
+                   'history_date__gte': datetime.datetime(2012, 1, 1)}
+            start = time.time()
+            for i in range(calls):
+                get_versions(model).filter(**kws)
+            building = time.time() - start
+
+            self.stdout.write(
+                '%s: rewriting %.1f us per call before, %.1f us after; '
+                'filter() %.1f us per call\n' % (
+                model._meta.object_name, uncached * 1e6 / calls,
+                cached * 1e6 / calls, building * 1e6 / calls))
@@ -0,0 +1,130 @@
+import random
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connections, router
+from django.db.models import get_model
+
+from versionutils.versioning import delta
+from versionutils.versioning.archive import archived_values_list, update_archived
+from versionutils.versioning.utils import get_versions, is_versioned
+
+
+class Command(BaseCommand):
+    help = ('Stores the delta fields of existing historical records as '
+            'deltas, or expands them back with --expand, and reports the '
+            'storage saved and the time taken to rebuild a version.\n'
+            'Usage: localwiki-manage compress_history <app_label.Model>')
+    option_list = BaseCommand.option_list + (
+        make_option('--expand', action='store_true', dest='expand',
+            default=False, help='Store every version in full again.'),
+        make_option('--benchmark', dest='benchmark', type='int', default=100,
+            help='Number of stored deltas to time rebuilding.'),
+    )
+
+    def handle(self, label=None, **options):
+        if label is None or '.' not in label:
+            raise CommandError("You must provide a model, e.g. pages.Page.")
+        model = get_model(*label.split('.', 1))
+        if model is None or not is_versioned(model):
+            raise CommandError('"%s" is not a versioned model.' % label)
+        fields = model._changes_tracker.delta_fields
+        if not fields:
+            raise CommandError('"%s" has no delta fields.' % label)
+
+        hist_model = get_versions(model).model
+        before = self._stored_bytes(hist_model, fields)
+        start = time.time()
+        if options['expand']:
+            updated = self._expand(hist_model, fields)
+        else:
+            updated = self._compress(hist_model, fields)
+        self.stdout.write('Updated %d versions in %.1f s\n' % (
+            updated, time.time() - start))
+
+        after = self._stored_bytes(hist_model, fields)
+        self.stdout.write('Stored: %d bytes before, %d bytes after (%.1f%%)\n' % (
+            before, after, after * 100.0 / (before or 1)))
+        if options['benchmark']:
+            self._benchmark(hist_model, fields, options['benchmark'])
+
+    def _stored_bytes(self, hist_model, fields):
+        cursor = connections[router.db_for_read(hist_model)].cursor()
+        qn = cursor.db.ops.quote_name
+        cursor.execute('SELECT %s FROM %s' % (
+            ' + '.join(['coalesce(sum(octet_length(%s)), 0)' % qn(f)
+                        for f in fields]),
+            qn(hist_model._meta.db_table)))
+        return cursor.fetchone()[0]
+
+    def _versions(self, hist_model, fields):
+        pk_name = hist_model._original_model._meta.pk.name
+        versions = hist_model._base_manager.order_by(
+            pk_name, '-history_date', '-history_id')
+        return versions.values_list(
+            'history_id', pk_name, 'history_version_number', *fields)
+
+    def _compress(self, hist_model, fields):
+        # Newest first for each object, like ChangesTracker.store_deltas
+        # does as versions are saved.
+        updated = 0
+        newer = None
+        for row in self._versions(hist_model, fields).iterator():
+            history_id, pk, version_number = row[:3]
+            stored = dict(zip(fields, row[3:]))
+            full = dict([(f, delta.expand(hist_model, v, f))
+                         for f, v in stored.iteritems()])
+            if (newer and newer[1] == pk and
+                    not delta.is_keyframe(version_number)):
+                changed = {}
+                for f in fields:
+                    value = delta.compress(newer[0], newer[2][f], full[f])
+                    if value != stored[f]:
+                        changed[f] = value
+                if changed:
+                    hist_model._base_manager.filter(pk=history_id).update(
+                        **changed)
+                    updated += 1
+            newer = (history_id, pk, full)
+        return updated
+
+    def _expand(self, hist_model, fields):
+        updated = 0
+        for row in self._versions(hist_model, fields).iterator():
+            stored = dict(zip(fields, row[3:]))
+            changed = dict([(f, delta.expand(hist_model, v, f))
+                            for f, v in stored.iteritems() if delta.is_delta(v)])
+            if changed:
+                hist_model._base_manager.filter(pk=row[0]).update(**changed)
+                updated += 1
+        # Archived deltas, too, while their bases are around.
+        for row in archived_values_list(hist_model._base_manager.all(),
+                                        'history_id', *fields):
+            stored = dict(zip(fields, row[1:]))
+            changed = dict([(f, delta.expand(hist_model, v, f))
+                            for f, v in stored.iteritems() if delta.is_delta(v)])
+            if changed:
+                update_archived(hist_model, [row[0]], **changed)
+                updated += 1
+        return updated
+
+    def _benchmark(self, hist_model, fields, count):
+        field = fields[0]
+        deltas = list(hist_model._base_manager.filter(
+            **{'%s__startswith' % field: delta.PREFIX}
+        ).values_list('history_id', flat=True)[:count * 10])
+        if not deltas:
+            self.stdout.write('No stored deltas to benchmark.\n')
+            return
+        sample = random.sample(deltas, min(count, len(deltas)))
+
+        start = time.time()
+        for pk in sample:
+            value = hist_model._base_manager.filter(pk=pk).values_list(
+                field, flat=True)[0]
+            delta.expand(hist_model, value, field)
+        elapsed = time.time() - start
+        self.stdout.write('Rebuilt %d versions: %.2f ms per version\n' % (
+            len(sample), elapsed * 1000 / len(sample)))
@@ -0,0 +1,18 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from versionutils.versioning import writebehind
+
+
+class Command(BaseCommand):
+    help = ('Writes the queued historical records of VERSIONUTILS_WRITE_BEHIND '
+            'models, e.g. after the task queue was down.')
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int',
+            default=500, help='Records to write per transaction.'),
+    )
+
+    def handle(self, *args, **options):
+        count = writebehind.flush(batch_size=options['batch_size'])
+        self.stdout.write('Wrote %d queued historical records\n' % count)
@@ -3,6 +3,8 @@ from django.db.models.query import QuerySet
 
 from utils import *
 from decorators import *
+from archive import archived, HistoryWithArchive
+import writebehind
 
 
 class HistoryDescriptor(object):
@@ -35,55 +37,113 @@ def HistoricalMetaInfoQuerySet(model=None):
     return _HistoricalMetaInfoQuerySet(model=model)
 
 
+# Most lookups come from code, so there are few distinct ones, but don't
+# let the translations grow without bound.
+MAX_LOOKUP_TRANSLATIONS = 1000
+
+
+def compute_lookup_rewrites(model):
+    """
+    Args:
+        model: A historical model.
+
+    Returns:
+        A tuple (versioned_vars, versioned_parents): the variable names of
+        related, versioned objects and the lookup names of versioned
+        parent models.
+    """
+    # Get the variable names of related, versioned objects.
+    rels = model._original_model._meta.get_all_related_objects()
+    versioned_vars = frozenset(
+        [o.var_name for o in rels if is_versioned(o.model)])
+
+    # Get the lookup names of versioned parent models.
+    parents = model._original_model._meta.parents
+    versioned_parents = []
+    for k, v in parents.iteritems():
+        if is_versioned(k):
+            versioned_parents.append(v.name)
+    return (versioned_vars, frozenset(versioned_parents))
+
+
+def rewrite_lookup(k, versioned_vars, versioned_parents):
+    """
+    Returns:
+        The lookup `k` rewritten for the historical model.
+    """
+    k_new = k
+    parts = k.split(models.constants.LOOKUP_SEP)
+    # Replace all instances of version_info__whatever with
+    # history_whatever.
+    if len(parts) > 1 and parts[0] == 'version_info':
+        rest = models.constants.LOOKUP_SEP.join(parts[2:])
+        if rest:
+            rest = "%s%s" % (models.constants.LOOKUP_SEP, rest)
+        k_new = 'history_%s%s' % (parts[1], rest)
+    # Replace all instances of fk__whatever with
+    # fk_hist__whatever if fk is a versioned model.
+    if parts[0] in versioned_vars:
+        rest = models.constants.LOOKUP_SEP.join(parts[2:])
+        if rest:
+            rest = "%s%s" % (models.constants.LOOKUP_SEP, rest)
+        k_new = '%s_hist%s' % (parts[0], rest)
+    # Replace all instances of parent_ptr__whatever
+    # with parent_hist_ptr__whatever if parent's versioned.
+    if parts[0] in versioned_parents:
+        rest = models.constants.LOOKUP_SEP.join(parts[2:])
+        if rest:
+            rest = "%s%s" % (models.constants.LOOKUP_SEP, rest)
+        # -4 will remove '_ptr' from the original string.
+        k_new = '%s_hist_ptr%s' % (parts[0][:-4], rest)
+    return k_new
+
+
+def translate_lookup(model, k):
+    """
+    Returns:
+        The lookup `k` rewritten for the historical model `model`.  The
+        related models are found the first time a model's queried, and the
+        rewritten lookups remembered.
+    """
+    # Not inherited by historical subclasses, which have their own.
+    translations = model.__dict__.get('_lookup_translations')
+    if translations is None:
+        # All the models are loaded by the time we're filtering, so the
+        # related objects are complete.
+        model._lookup_rewrites = compute_lookup_rewrites(model)
+        translations = model._lookup_translations = {}
+    try:
+        return translations[k]
+    except KeyError:
+        pass
+    k_new = rewrite_lookup(k, *model._lookup_rewrites)
+    if len(translations) >= MAX_LOOKUP_TRANSLATIONS:
+        translations.clear()
+    translations[k] = k_new
+    return k_new
+
+
 class BaseHistoricalMetaInfoQuerySet(object):
     """
     Simple QuerySet to make filtering intuitive.
     """
     def filter(self, *args, **kws):
-        # Get the variable names of related, versioned objects.
-        rels = self.model._original_model._meta.get_all_related_objects()
-        versioned_vars = [o.var_name for o in rels if is_versioned(o.model)]
-
-        # Get the lookup names of versioned parent models.
-        parents = self.model._original_model._meta.parents
-        versioned_parents = []
-        for k, v in parents.iteritems():
-            if is_versioned(k):
-                versioned_parents.append(v.name)
-
-        # Iterate through the provided keywords, replacing certain
-        # attributes with ones that correspond to historical models.
+        # Replace lookups of version_info, related versioned objects and
+        # versioned parents with their historical model counterparts.
         kws_new = {}
         for k, v in kws.iteritems():
-            k_new = k
-            parts = k.split(models.constants.LOOKUP_SEP)
-            # Replace all instances of version_info__whatever with
-            # history_whatever.
-            if len(parts) > 1 and parts[0] == 'version_info':
-                rest = models.constants.LOOKUP_SEP.join(parts[2:])
-                if rest:
-                    rest = "%s%s" % (models.constants.LOOKUP_SEP, rest)
-                k_new = 'history_%s%s' % (parts[1], rest)
-            # Replace all instances of fk__whatever with
-            # fk_hist__whatever if fk is a versioned model.
-            if parts[0] in versioned_vars:
-                rest = models.constants.LOOKUP_SEP.join(parts[2:])
-                if rest:
-                    rest = "%s%s" % (models.constants.LOOKUP_SEP, rest)
-                k_new = '%s_hist%s' % (parts[0], rest)
-            # Replace all instances of parent_ptr__whatever
-            # with parent_hist_ptr__whatever if parent's versioned.
-            if parts[0] in versioned_parents:
-                rest = models.constants.LOOKUP_SEP.join(parts[2:])
-                if rest:
-                    rest = "%s%s" % (models.constants.LOOKUP_SEP, rest)
-                # -4 will remove '_ptr' from the original string.
-                k_new = '%s_hist_ptr%s' % (parts[0][:-4], rest)
-
-            kws_new[k_new] = v
+            kws_new[translate_lookup(self.model, k)] = v
 
         return super(BaseHistoricalMetaInfoQuerySet, self).filter(*args, **kws_new)
 
+    def with_archive(self):
+        """
+        Returns:
+            The records of this queryset, followed through into the
+            archive of older records.  See archive.py.
+        """
+        return HistoryWithArchive(self)
+
 
 class HistoryManager(models.Manager):
     def __init__(self, model, instance=None):
@@ -108,6 +168,23 @@ class HistoryManager(models.Manager):
         if self.instance is None:
             return HistoricalMetaInfoQuerySet(model=self.model)
 
+        # Read-your-writes: the instance's history includes its queued
+        # historical records.
+        writebehind.flush_instance(self.instance)
+
+        return HistoricalMetaInfoQuerySet(model=self.model).filter(
+            **self.lookup_values())
+
+    def lookup_values(self):
+        """
+        Returns:
+            The {lookup: value} dictionary that picks out the instance's
+            historical records.
+
+        Raises:
+            NoUniqueValuesError: The instance has no unique values to look
+                its records up by.
+        """
         # TODO: Explore using natural_key() here if it exists on the
         # model. One idea: SHA-1 an escaped, string form of the
         # natural_key() and store it as an indexed field in the
@@ -151,8 +228,7 @@ class HistoryManager(models.Manager):
                     "Wasn't passed an active (existing) instance and model "
                     "has no unique fields or no unique_together defined!"
                 )
-
-        return HistoricalMetaInfoQuerySet(model=self.model).filter(**filter)
+        return filter
 
     def most_recent(self):
         """
@@ -185,13 +261,18 @@ class HistoryManager(models.Manager):
         Raises:
             DoesNotExist: Instance hasn't been created yet.
         """
+        if version and version > 0:
+            versions = self.filter(history_version_number=version)
+        elif date:
+            versions = self.filter(history_date__lte=date)
         try:
-            if version and version > 0:
-                v = self.all().order_by('history_date')[version - 1]
-            elif date:
-                v = self.filter(history_date__lte=date)[0]
+            v = versions[0]
         except IndexError:
-            raise self.instance.DoesNotExist("%s hasn't been created yet." %
+            # Older records may have been archived.
+            v = (archived(versions, limit=1) or [None])[0]
+            if v is None:
+                raise self.instance.DoesNotExist(
+                    "%s hasn't been created yet." %
                     self.instance._meta.object_name)
 
         return v
@@ -4,6 +4,8 @@ from collections import defaultdict
 
 from django.db import models
 from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 from django.db.models.options import DEFAULT_NAMES as ALL_META_OPTIONS
 from django.utils.translation import string_concat
 
@@ -14,11 +16,51 @@ from history_model_methods import get_history_fields
 from history_model_methods import get_history_methods
 import fields
 import manager
+import delta
+import writebehind
+from archive import archived_values_list, update_archived, delete_archived
+
+
+class LastEditFields(models.Model):
+    """
+    Denormalized information about a versioned model's most recent
+    historical record, kept up to date by ChangesTracker.  Subclass this
+    to show when, and by whom, an object was last edited without querying
+    its history.
+    """
+    last_edit_date = models.DateTimeField(null=True, editable=False)
+    last_editor = models.ForeignKey(User, null=True, editable=False,
+        related_name='+', on_delete=models.SET_NULL)
+    version_count = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta:
+        abstract = True
+
+
+class PendingHistoricalRecord(models.Model):
+    """
+    A historical record waiting to be written.  See versioning.writebehind.
+    """
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.CharField(max_length=255, db_index=True)
+    # The saved object, serialized.
+    data = models.TextField()
+    history_type = models.SmallIntegerField()
+    history_date = models.DateTimeField()
+    history_user = fields.AutoUserField(null=True)
+    history_user_ip = fields.AutoIPAddressField(null=True)
+    history_comment = models.CharField(max_length=200, blank=True, null=True)
+    # The primary key of the historical record reverted to, if any.
+    history_reverted_to_version = models.PositiveIntegerField(null=True)
+
+    class Meta:
+        ordering = ('id',)
 
 
 class ChangesTracker(object):
-    def connect(self, m, manager_name=None):
+    def connect(self, m, manager_name=None, delta_fields=None):
         self.manager_name = manager_name
+        self.delta_fields = tuple(delta_fields or ())
 
         if m._meta.abstract:
             # We can't do anything on the abstract model.
@@ -62,6 +104,10 @@ class ChangesTracker(object):
             models.signals.post_save.connect(_post_save, weak=False)
             models.signals.pre_delete.connect(_pre_delete, weak=False)
             models.signals.post_delete.connect(_post_delete, weak=False)
+            if self.delta_fields and not m._meta.proxy:
+                models.signals.pre_delete.connect(
+                    self.historical_pre_delete, sender=history_model,
+                    weak=False)
 
             self.wrap_model_fields(m)
 
@@ -69,6 +115,7 @@ class ChangesTracker(object):
         setattr(m, self.manager_name, descriptor)
         # Being able to look this up is intensely helpful.
         setattr(m, '_history_manager_name', self.manager_name)
+        setattr(m, '_changes_tracker', self)
 
         setattr(m, '__getstate__', pickle_friendly__getstate__)
 
@@ -255,6 +302,8 @@ class ChangesTracker(object):
 
         for field in (model._meta.local_fields +
                       model._meta.local_many_to_many):
+            if field.name in LAST_EDIT_FIELDS:
+                continue
             field = copy.deepcopy(field)
 
             if isinstance(field, models.AutoField):
@@ -434,6 +483,10 @@ class ChangesTracker(object):
                 history_type = TYPE_REVERTED_ADDED if is_revert else TYPE_ADDED
             else:
                 history_type = history_type or TYPE_UPDATED
+        if (instance._track_changes and
+                writebehind.is_write_behind(instance.__class__)):
+            writebehind.enqueue(instance, history_type)
+            return
         hist_instance = self.create_historical_record(instance, history_type)
         self.m2m_init(instance, hist_instance)
 
@@ -514,8 +567,12 @@ class ChangesTracker(object):
                 vs = instance.versions.filter(history_date__lt=hist_instance.version_info.date)
             else:
                 vs = instance.versions.all()
+            # Archived ones first: they're older, so nothing left depends
+            # on them, and deleting the others needn't expand them.
+            delete_archived(vs)
             for h in vs:
                 h.delete()
+            renumber_versions(instance.versions.all())
 
     def m2m_init(self, instance, hist_instance):
         """
@@ -570,8 +627,110 @@ class ChangesTracker(object):
         # then we don't auto-create a revision here.
         if not instance._track_changes:
             return
+        attrs = self.historical_record_attrs(instance)
+        hist_instance = manager.create(history_type=type, **attrs)
+        self.store_deltas(hist_instance)
+        self.update_last_edit(instance, hist_instance)
+        return hist_instance
+
+    def update_last_edit(self, instance, hist_instance):
+        """
+        Updates the LastEditFields of the instance, if it has them, from
+        its new historical record.
+        """
+        if not hasattr(instance, 'last_edit_date'):
+            return
+        if hist_instance.history_type in DELETED_TYPES:
+            return
+        values = {
+            'last_edit_date': hist_instance.history_date,
+            'last_editor': hist_instance.history_user_id,
+            'version_count': hist_instance.history_version_number,
+        }
+        instance.__class__._base_manager.filter(pk=instance.pk).update(**values)
+        instance.last_edit_date = values['last_edit_date']
+        instance.last_editor_id = values['last_editor']
+        instance.version_count = values['version_count']
+
+    def store_deltas(self, hist_instance):
+        """
+        Stores the delta fields of the version before `hist_instance` as
+        deltas from it, unless that version is a keyframe.
+        """
+        if not self.delta_fields:
+            return
+        hist_model = hist_instance.__class__
+        pk_name = hist_model._original_model._meta.pk.name
+        raw = hist_instance.__dict__
+        previous = hist_model._base_manager.filter(
+            **{pk_name: raw[pk_name],
+               'history_date__lte': raw['history_date']}
+        ).exclude(pk=hist_instance.pk).order_by('-history_date', '-history_id')
+        previous = previous.values('history_id', 'history_version_number',
+                                   *self.delta_fields)[:1]
+        if not previous:
+            return
+        stored = self.deltas_from(hist_instance, previous[0])
+        if stored:
+            hist_model._base_manager.filter(
+                pk=previous[0]['history_id']).update(**stored)
+
+    def deltas_from(self, hist_instance, previous):
+        """
+        Args:
+            previous: A dictionary of the history_id, history_version_number
+                and delta fields of the version before `hist_instance`.
+
+        Returns:
+            A dictionary of the delta fields of `previous` to store as
+            deltas from `hist_instance`.  Empty if `previous` is a keyframe.
+        """
+        if delta.is_keyframe(previous['history_version_number']):
+            return {}
+        raw = hist_instance.__dict__
+        stored = {}
+        for name in self.delta_fields:
+            value = delta.compress(hist_instance.pk, raw[name], previous[name])
+            if value != previous[name]:
+                stored[name] = value
+        return stored
+
+    def historical_pre_delete(self, sender, instance, **kws):
+        """
+        Expands the deltas stored from `instance`, a historical record,
+        before it goes away.  They may have been archived.
+        """
+        pk_name = sender._original_model._meta.pk.name
+        prefix = delta.delta_prefix(instance.pk)
+        for name in self.delta_fields:
+            dependents = sender._base_manager.filter(**{
+                pk_name: instance.__dict__[pk_name],
+                '%s__startswith' % name: prefix,
+            })
+            for pk, value in dependents.values_list('history_id', name):
+                sender._base_manager.filter(pk=pk).update(
+                    **{name: delta.expand(sender, value, name)})
+            for pk, value in archived_values_list(dependents, 'history_id',
+                                                  name):
+                update_archived(sender, [pk],
+                                **{name: delta.expand(sender, value, name)})
+
+    def historical_record_attrs(self, instance, version_number=None):
+        """
+        Args:
+            version_number: The record's version number, if the caller's
+                locked the instance's row and looked it up already (see
+                bulk.py).
+
+        Returns:
+            A dictionary of the field values of the historical record for
+            the instance as it is now.
+        """
+        manager = getattr(instance, self.manager_name)
         attrs = {}
         for field in instance._meta.fields:
+            if field.name in LAST_EDIT_FIELDS:
+                continue
             if isinstance(field, models.fields.related.ForeignKey):
                 is_fk_to_self = (field.related.parent_model ==
                                  instance.__class__)
@@ -603,7 +762,15 @@ class ChangesTracker(object):
             attrs[field.attname] = getattr(instance, field.attname)
 
         attrs.update(self._get_save_with_attrs(instance))
-        return manager.create(history_type=type, **attrs)
+        if version_number is None:
+            # Lock the object's row until the transaction ends, so
+            # concurrent saves of it can't both take the next version
+            # number.
+            list(instance.__class__._base_manager.select_for_update().filter(
+                pk=instance.pk).values_list('pk', flat=True))
+            version_number = next_version_number(manager)
+        attrs['history_version_number'] = version_number
+        return attrs
 
     def _get_save_with_attrs(self, instance):
         """
@@ -629,6 +796,7 @@ class ChangesTracker(object):
             return
 
         manager = getattr(instance, self.manager_name)
+        delete_archived(manager.all())
         for entry in manager.all():
             entry.delete()
 
@@ -1,7 +1,8 @@
 from utils import is_versioned
 
 
-def register(cls, manager_name='versions', changes_tracker=None):
+def register(cls, manager_name='versions', changes_tracker=None,
+             delta_fields=None):
     """
     Registers the model class `cls` as a versioned model.  After
     registration (and a call to syncdb) changes to the model will be
@@ -12,6 +13,8 @@ def register(cls, manager_name='versions', changes_tracker=None):
       manager_name: Optional name of the manager that's added to cls
         instances of cls. This is set to 'versions' by default.
       changes_tracker: An optional instance of ChangesTracker.
+      delta_fields: Optional list of names of large text fields to store
+        as deltas in the historical records.  See versioning.delta.
     """
     from models import ChangesTracker
 
@@ -22,4 +25,4 @@ def register(cls, manager_name='versions', changes_tracker=None):
         return
 
     tracker = changes_tracker()
-    tracker.connect(cls, manager_name=manager_name)
+    tracker.connect(cls, manager_name=manager_name, delta_fields=delta_fields)
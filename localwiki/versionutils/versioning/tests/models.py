@@ -1,6 +1,7 @@
 from django.db import models
 
 from versionutils import versioning
+from versionutils.versioning.models import LastEditFields
 
 """
 TODO: It would be cool to write a little thing to randomly generate
@@ -357,6 +358,20 @@ class M31(models.Model):
 versioning.register(M31)
 
 
+class M32LastEdit(LastEditFields):
+    a = models.CharField(max_length=200, unique=True)
+    b = models.TextField()
+
+versioning.register(M32LastEdit)
+
+
+class M33Delta(models.Model):
+    a = models.CharField(max_length=200, unique=True)
+    b = models.TextField()
+
+versioning.register(M33Delta, delta_fields=['b'])
+
+
 TEST_MODELS = [
     M1, M2, M3BigInteger, M4Date, M5Decimal, M6Email, M7Numbers,
     M8Time, M9URL, M10File, M11Image, M12ForeignKey, M13ForeignKeySelf,
@@ -370,5 +385,5 @@ TEST_MODELS = [
     MUniqueAndFK, MUniqueAndFK2,
     NonVersionedModel, M27FKToNonVersioned,
     M28OneToOneNonVersioned,
-    M29, M30, M31,
+    M29, M30, M31, M32LastEdit, M33Delta,
 ]
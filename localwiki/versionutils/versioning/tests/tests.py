@@ -354,6 +354,313 @@ class ChangesTrackingTest(TestCase):
             m_old = m.versions.as_of(version=i)
             self.assertEqual(m_old.c, i)
 
+    def test_version_number_stored(self):
+        m = M16Unique(a="Stored", b="B!", c=1)
+        m.save()
+        m.b = "B!!"
+        m.save()
+        m.b = "B!!!"
+        m.save()
+        numbers = [v.history_version_number for v in m.versions.all()]
+        self.assertEqual(numbers, [3, 2, 1])
+
+        # Older versions go away, the rest are numbered from 1 again.
+        m.delete(delete_older_versions=True)
+        self.assertEqual(
+            [v.version_info.version_number() for v in m.versions.all()], [1])
+
+    def test_bulk_save(self):
+        from versionutils.versioning import bulk_save, bulk_saved
+
+        sent = []
+        def _bulk_saved(sender, instances, created, **kws):
+            sent.append((sender, len(instances), len(created)))
+        bulk_saved.connect(_bulk_saved, sender=M16Unique)
+        try:
+            ms = [M16Unique(a="Bulk %s" % i, b="B!", c=i) for i in range(3)]
+            bulk_save(ms, comment="Imported")
+            ms[0].b = "B!!"
+            bulk_save(ms[:1])
+        finally:
+            bulk_saved.disconnect(_bulk_saved, sender=M16Unique)
+
+        self.assertEqual(sent, [(M16Unique, 3, 3), (M16Unique, 1, 0)])
+        for m in ms:
+            self.assertTrue(M16Unique.objects.filter(pk=m.pk).exists())
+        self.assertEqual(M16Unique.objects.get(a="Bulk 0").b, "B!!")
+
+        v2, v1 = ms[0].versions.all()
+        self.assertEqual(v1.version_info.type, TYPE_ADDED)
+        self.assertEqual(v1.version_info.comment, "Imported")
+        self.assertEqual(v2.version_info.type, TYPE_UPDATED)
+        self.assertEqual(v2.version_info.version_number(), 2)
+        self.assertEqual(ms[1].versions.count(), 1)
+
+    @override_settings(VERSIONUTILS_DELTA_KEYFRAME_INTERVAL=3)
+    def test_bulk_save_versions(self):
+        from versionutils.versioning import bulk_save
+
+        ms = [M32LastEdit(a="Bulk last edit %s" % i, b="B!") for i in range(2)]
+        bulk_save(ms)
+        # An object listed twice gets a record, and number, for each.
+        ms[0].b = "B!!"
+        bulk_save([ms[0], ms[1], ms[0]])
+        self.assertEqual(
+            [v.history_version_number for v in ms[0].versions.all()],
+            [3, 2, 1])
+        self.assertEqual(
+            [v.history_version_number for v in ms[1].versions.all()], [2, 1])
+        for m in ms:
+            saved = M32LastEdit.objects.get(pk=m.pk)
+            self.assertEqual(saved.version_count, m.versions.count())
+            self.assertEqual(saved.last_edit_date,
+                             m.versions.most_recent().version_info.date)
+
+        m, texts = self._save_delta_versions("Bulk deltas", 4)
+        lines = texts[-1].splitlines(True)
+        for i in range(4):
+            lines[-1 - i] = u"<p>Bulk edit %d</p>\n" % i
+            m.b = u"".join(lines)
+            bulk_save([m])
+            texts.append(m.b)
+        self.assertEqual(self._stored_deltas(m), {
+            1: True, 2: True, 3: False, 4: True, 5: True, 6: False,
+            7: True, 8: False})
+        for i, text in enumerate(texts, 1):
+            self.assertEqual(m.versions.as_of(version=i).b, text)
+
+    def test_last_edit_fields(self):
+        m = M32LastEdit(a="Last edit", b="B!")
+        m.save()
+        m.b = "B!!"
+        m.save()
+        m = M32LastEdit.objects.get(pk=m.pk)
+        most_recent = m.versions.most_recent()
+        self.assertEqual(m.version_count, 2)
+        self.assertEqual(m.last_edit_date, most_recent.version_info.date)
+        self.assertEqual(m.last_editor, None)
+        # They aren't kept in the historical records.
+        self.assertFalse('version_count' in
+            [f.name for f in M32LastEdit.versions.model._meta.fields])
+        self.assertEqual(most_recent.version_info._object.b, "B!!")
+
+    @override_settings(VERSIONUTILS_WRITE_BEHIND=['tests.M16Unique'])
+    def test_write_behind(self):
+        from versionutils.versioning.models import PendingHistoricalRecord
+
+        m = M16Unique(a="Written later", b="B!", c=1)
+        m.save(comment="First")
+        m.b = "B!!"
+        m.save(comment="Second")
+        self.assertEqual(PendingHistoricalRecord.objects.count(), 2)
+        self.assertEqual(
+            len(M16Unique.versions.filter(a="Written later")), 0)
+
+        # Reading the object's history writes its queued records.
+        self.assertEqual(m.versions.count(), 2)
+        self.assertEqual(PendingHistoricalRecord.objects.count(), 0)
+        first, second = m.versions.as_of(version=1), m.versions.as_of(version=2)
+        self.assertEqual(first.b, "B!")
+        self.assertEqual(first.version_info.comment, "First")
+        self.assertEqual(first.version_info.type, TYPE_ADDED)
+        self.assertEqual(second.b, "B!!")
+        self.assertEqual(second.version_info.type, TYPE_UPDATED)
+
+        # Deletes are written right away, after the queued records.
+        m.b = "B!!!"
+        m.save()
+        m.delete()
+        self.assertEqual(
+            len(M16Unique.versions.filter(a="Written later")), 4)
+        self.assertEqual(PendingHistoricalRecord.objects.count(), 0)
+
+    @override_settings(VERSIONUTILS_WRITE_BEHIND=['tests.M16Unique'])
+    def test_write_behind_pending(self):
+        from django.contrib.auth.models import User
+        from versionutils.versioning import writebehind
+        from versionutils.versioning.models import PendingHistoricalRecord
+
+        user = User.objects.create_user('writebehind', 'wb@example.org', 'pw')
+        m = M16Unique(a="Pending", b="B!", c=1)
+        m.save(comment="Queued", user=user)
+
+        # Read without writing the queued record.
+        pending = writebehind.most_recent_pending(m)
+        self.assertEqual(pending.version_info.comment, "Queued")
+        self.assertEqual(pending.version_info.user, user)
+        self.assertEqual(PendingHistoricalRecord.objects.count(), 1)
+
+        writebehind.flush_user(user)
+        self.assertEqual(PendingHistoricalRecord.objects.count(), 0)
+        self.assertEqual(
+            M16Unique.versions.filter(version_info__user=user).count(), 1)
+        self.assertEqual(writebehind.most_recent_pending(m), None)
+
+    def test_translate_lookup(self):
+        from versionutils.versioning.manager import translate_lookup
+
+        hist_model = M2.versions.model
+        self.assertEqual(translate_lookup(hist_model, 'version_info__user'),
+                         'history_user')
+        self.assertEqual(
+            translate_lookup(hist_model, 'version_info__date__gte'),
+            'history_date__gte')
+        self.assertEqual(translate_lookup(hist_model, 'c'), 'c')
+        self.assertEqual(translate_lookup(hist_model, 'm17foreignkeyversioned'),
+                         'm17foreignkeyversioned_hist')
+        self.assertTrue('version_info__user' in hist_model._lookup_translations)
+
+    @skipIf(is_sqlite(), 'Archive tables need PostgreSQL')
+    def test_archive_history(self):
+        from versionutils.versioning.archive import archive_history
+
+        m = M16Unique(a="Archived", b="B!", c=1)
+        m.save()
+        m.b = "B!!"
+        m.save()
+        m.b = "B!!!"
+        m.save()
+        long_ago = datetime.datetime.now() - datetime.timedelta(days=1000)
+        for i, v in enumerate(reversed(list(m.versions.all()))):
+            m.versions.filter(pk=v.pk).update(
+                history_date=long_ago + datetime.timedelta(days=i))
+
+        before = datetime.datetime.now() - datetime.timedelta(days=365)
+        self.assertEqual(archive_history(M16Unique, before), 2)
+        # The most recent version stays.
+        self.assertEqual(m.versions.count(), 1)
+        self.assertEqual(m.versions.most_recent().b, "B!!!")
+
+        self.assertEqual(m.versions.as_of(version=1).b, "B!")
+        self.assertEqual(m.versions.as_of(date=long_ago).b, "B!")
+        history = m.versions.all().with_archive()
+        self.assertEqual(history.count(), 3)
+        self.assertEqual([v.b for v in history], ["B!!!", "B!!", "B!"])
+        self.assertEqual([v.b for v in history[1:2]], ["B!!"])
+
+    @skipIf(is_sqlite(), 'Archive tables need PostgreSQL')
+    def test_archive_delete_older_versions(self):
+        from versionutils.versioning.archive import archive_history
+
+        m = M16Unique(a="Archived then deleted", b="B!", c=1)
+        m.save()
+        m.b = "B!!"
+        m.save()
+        m.b = "B!!!"
+        m.save()
+        long_ago = datetime.datetime.now() - datetime.timedelta(days=1000)
+        for i, v in enumerate(reversed(list(m.versions.all()))):
+            m.versions.filter(pk=v.pk).update(
+                history_date=long_ago + datetime.timedelta(days=i))
+        before = datetime.datetime.now() - datetime.timedelta(days=365)
+        self.assertEqual(archive_history(M16Unique, before), 2)
+
+        # The archived versions go, too.
+        m.delete(delete_older_versions=True)
+        history = m.versions.all().with_archive()
+        self.assertEqual(history.count(), 1)
+        self.assertEqual(history[0].version_info.version_number(), 1)
+
+    def test_delta_round_trip(self):
+        from versionutils.versioning import delta
+
+        base = u"<p>One</p>\n<p>Two</p><p>Three</p>" * 20
+        text = base.replace(u"<p>Two</p>", u"<p>Deux</p>", 3) + u"<p>Four"
+        stored = delta.compress(7, base, text)
+        self.assertTrue(delta.is_delta(stored))
+        self.assertTrue(stored.startswith(delta.delta_prefix(7)))
+        self.assertTrue(len(stored) < len(text))
+        base_pk, ops = delta.decode(stored)
+        self.assertEqual(base_pk, 7)
+        self.assertEqual(delta.apply_delta(base, ops), text)
+        # Not worth storing a delta of a short value.
+        self.assertEqual(delta.compress(7, base, u"<p>Hi</p>"), u"<p>Hi</p>")
+
+    def _save_delta_versions(self, a, count):
+        """
+        Saves `count` versions of an M33Delta, each changing one line of
+        a long text.
+
+        Returns:
+            (the object, the text of each version, in order)
+        """
+        base = [u"<p>Line %d of the page</p>\n" % i for i in range(40)]
+        texts = []
+        m = M33Delta(a=a)
+        for i in range(count):
+            lines = list(base)
+            lines[i] = u"<p>Edit %d</p>\n" % i
+            m.b = u"".join(lines)
+            m.save()
+            texts.append(m.b)
+        return m, texts
+
+    def _stored_deltas(self, m):
+        # Version number -> whether its text is stored as a delta.
+        from versionutils.versioning import delta
+
+        stored = M33Delta.versions.model._base_manager.filter(a=m.a)
+        return dict([(number, delta.is_delta(value)) for number, value in
+                     stored.values_list('history_version_number', 'b')])
+
+    @override_settings(VERSIONUTILS_DELTA_KEYFRAME_INTERVAL=3)
+    def test_delta_versions(self):
+        m, texts = self._save_delta_versions("Deltas", 8)
+        # The latest version and every third are kept in full.
+        self.assertEqual(self._stored_deltas(m), {
+            1: True, 2: True, 3: False, 4: True, 5: True, 6: False,
+            7: True, 8: False})
+        for i, text in enumerate(texts, 1):
+            self.assertEqual(m.versions.as_of(version=i).b, text)
+        self.assertEqual([v.b for v in m.versions.all()],
+                         list(reversed(texts)))
+
+    @override_settings(VERSIONUTILS_DELTA_KEYFRAME_INTERVAL=3)
+    def test_delta_base_deleted(self):
+        m, texts = self._save_delta_versions("Delta base deleted", 8)
+        # Version 4 is stored as a delta from version 5.
+        m.versions.as_of(version=5).delete()
+        stored = self._stored_deltas(m)
+        self.assertFalse(5 in stored)
+        self.assertFalse(stored[4])
+        for i, text in enumerate(texts, 1):
+            if i != 5:
+                self.assertEqual(m.versions.as_of(version=i).b, text)
+
+    @override_settings(VERSIONUTILS_DELTA_KEYFRAME_INTERVAL=3)
+    def test_delta_revert(self):
+        m, texts = self._save_delta_versions("Delta reverted", 8)
+        m.versions.as_of(version=2).revert_to()
+        m = M33Delta.objects.get(a="Delta reverted")
+        self.assertEqual(m.b, texts[1])
+        self.assertEqual(m.versions.most_recent().b, texts[1])
+        self.assertEqual(m.versions.most_recent().version_info.type,
+                         TYPE_REVERTED)
+        for i, text in enumerate(texts, 1):
+            self.assertEqual(m.versions.as_of(version=i).b, text)
+
+    @skipIf(is_sqlite(), 'Archive tables need PostgreSQL')
+    @override_settings(VERSIONUTILS_DELTA_KEYFRAME_INTERVAL=3)
+    def test_delta_archived(self):
+        from versionutils.versioning.archive import archive_history
+
+        m, texts = self._save_delta_versions("Delta archived", 8)
+        long_ago = datetime.datetime.now() - datetime.timedelta(days=1000)
+        for i, v in enumerate(reversed(list(m.versions.all()))):
+            m.versions.filter(pk=v.pk).update(
+                history_date=long_ago + datetime.timedelta(days=i))
+        before = datetime.datetime.now() - datetime.timedelta(days=365)
+        self.assertEqual(archive_history(M33Delta, before), 7)
+
+        # Archived deltas are rebuilt from archived and hot bases.
+        for i, text in enumerate(texts, 1):
+            self.assertEqual(m.versions.as_of(version=i).b, text)
+
+        # Version 7, archived, is a delta from version 8.
+        m.versions.most_recent().delete()
+        for i, text in enumerate(texts[:7], 1):
+            self.assertEqual(m.versions.as_of(version=i).b, text)
+
     def test_version_date_grab(self):
         m = M2(a="Yay versioning!", b="Hey!", c=1)
         m.save()
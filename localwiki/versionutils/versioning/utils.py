@@ -32,6 +32,164 @@ def is_versioned(m):
         return m == model_thats_versioned
 
 
+def next_version_number(versions):
+    """
+    Args:
+        versions: The historical records of an object, e.g. m.versions.
+
+    Returns:
+        The version number of the object's next historical record.  Only
+        stays the next one while the object's row is locked (see
+        `ChangesTracker.historical_record_attrs`).
+    """
+    try:
+        latest = versions.aggregate(
+            latest=models.Max('history_version_number'))['latest']
+        if latest is None:
+            # No versions, or only ones created before version numbers
+            # were stored.
+            latest = versions.count()
+    except versions.NoUniqueValuesError:
+        latest = 0
+    return latest + 1
+
+
+def next_version_numbers(instances):
+    """
+    Like next_version_number(), for many objects at once: one query per
+    set of lookup names (see HistoryManager.lookup_values) rather than
+    per object.
+
+    Args:
+        instances: Saved instances of a versioned model.  An object may
+            be listed more than once, for each of its new records.
+
+    Returns:
+        A list of the version numbers of the instances' next historical
+        records, in order.
+    """
+    from manager import translate_lookup
+
+    numbers = [None] * len(instances)
+    groups = {}
+    for i, instance in enumerate(instances):
+        versions = get_versions(instance)
+        try:
+            lookup = versions.lookup_values()
+        except versions.NoUniqueValuesError:
+            numbers[i] = 1
+            continue
+        names = tuple(sorted(lookup))
+        # Related objects are looked up, and come back, as their keys.
+        key = tuple([getattr(lookup[name], 'pk', lookup[name])
+                     for name in names])
+        groups.setdefault(names, []).append((i, key))
+
+    for names, members in groups.iteritems():
+        hist_model = get_versions(instances[members[0][0]]).model
+        columns = [translate_lookup(hist_model, name) for name in names]
+        filter = {}
+        for n, column in enumerate(columns):
+            filter['%s__in' % column] = set([key[n] for i, key in members])
+        # The lookups of other objects may match, too, but they're grouped
+        # apart.
+        rows = hist_model._base_manager.filter(**filter).order_by().values(
+            *columns).annotate(latest=models.Max('history_version_number'),
+                               count=models.Count('pk'))
+        latest = {}
+        for row in rows:
+            key = tuple([row[column] for column in columns])
+            # As in next_version_number().
+            latest[key] = (row['latest'] if row['latest'] is not None
+                           else row['count'])
+        for i, key in members:
+            latest[key] = latest.get(key, 0) + 1
+            numbers[i] = latest[key]
+    return numbers
+
+
+def renumber_versions(versions):
+    """
+    Numbers the historical records of an object from 1, in order, e.g.
+    after some of them were deleted.  Archived records come first.
+
+    Args:
+        versions: The historical records of an object, e.g. m.versions.all().
+    """
+    from archive import archived_values_list, update_archived
+
+    hist_model = versions.model
+    pk_name = hist_model._meta.pk.name
+    versions = versions.order_by('history_date')
+    archived = archived_values_list(versions, 'history_date', pk_name)
+    hot = list(versions.values_list('history_date', pk_name))
+    archived_pks = set([pk for date, pk in archived])
+    for number, (date, pk) in enumerate(sorted(archived + hot), 1):
+        if pk in archived_pks:
+            update_archived(hist_model, [pk], history_version_number=number)
+        else:
+            hist_model.objects.filter(pk=pk).update(
+                history_version_number=number)
+
+
+def backfill_version_numbers(db, table, partition_by, joins='',
+                             batch_size=10000):
+    """
+    Stores the version numbers of the existing historical records in a
+    table, committing after each batch.  For use in South migrations.
+
+    Args:
+        db: south.db.db
+        table: The historical model's table, e.g. 'pages_page_hist'.
+        partition_by: SQL for the columns identifying an object's
+            records (its unique fields), e.g. 'h.slug, h.region_id'.  The
+            table is aliased as h.
+        joins: SQL joins needed by `partition_by`.
+    """
+    db.execute("""
+        CREATE TEMPORARY TABLE version_numbers AS
+        SELECT h.history_id, row_number() OVER (
+            PARTITION BY %s ORDER BY h.history_date, h.history_id) AS number
+        FROM %s h %s""" % (partition_by, db.quote_name(table), joins))
+    db.execute("CREATE INDEX version_numbers_history_id "
+               "ON version_numbers (history_id)")
+    low, high = db.execute("SELECT min(history_id), max(history_id) "
+                           "FROM version_numbers")[0]
+    if low is not None:
+        for start in range(low, high + 1, batch_size):
+            db.execute("""
+                UPDATE %s h SET history_version_number = v.number
+                FROM version_numbers v
+                WHERE v.history_id = h.history_id
+                AND h.history_id >= %%s AND h.history_id < %%s""" %
+                db.quote_name(table), [start, start + batch_size])
+            db.commit_transaction()
+            db.start_transaction()
+    db.execute("DROP TABLE version_numbers")
+
+
+def backfill_last_edit(db, table, hist_table):
+    """
+    Fills in the LastEditFields of the existing rows of a table from their
+    most recent historical records.  For use in South migrations.
+
+    Args:
+        db: south.db.db
+        table: The versioned model's table, e.g. 'pages_page'.
+        hist_table: Its historical model's table, e.g. 'pages_page_hist'.
+    """
+    db.execute("""
+        UPDATE %s o SET last_edit_date = h.history_date,
+            last_editor_id = h.history_user_id,
+            version_count = coalesce(h.history_version_number, 0)
+        FROM (
+            SELECT DISTINCT ON (id) id, history_date, history_user_id,
+                history_version_number
+            FROM %s ORDER BY id, history_date DESC, history_id DESC
+        ) h
+        WHERE h.id = o.id""" % (db.quote_name(table), db.quote_name(hist_table)))
+
+
 def get_versions(m):
     """
     Args:
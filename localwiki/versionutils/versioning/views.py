@@ -33,6 +33,10 @@ class VersionsList(ListView):
     revert_view_name = None
 
     def get_context_data(self, **kwargs):
+        # A full listing reaches back into the archived history.
+        object_list = kwargs.get('object_list')
+        if hasattr(object_list, 'with_archive'):
+            kwargs['object_list'] = object_list.with_archive()
         context = super(VersionsList, self).get_context_data(**kwargs)
         context['slug'] = self.kwargs.get('slug')
         return context
@@ -0,0 +1,281 @@
+"""
+Write-behind historical records.
+
+Saving a versioned object normally writes its historical record, which
+means looking up its version number and its related historical records
+and updating the historical tables' indexes, before the save returns.
+When lots of people save at once, e.g. during an edit-a-thon, that's
+where they wait on each other.
+
+Models listed in the VERSIONUTILS_WRITE_BEHIND setting, e.g.
+
+    VERSIONUTILS_WRITE_BEHIND = ['pages.Page']
+
+instead queue a PendingHistoricalRecord when saved: the object's field
+values along with the date, user, IP address and comment of the save.
+The queue is a database table, so nothing's lost if a worker dies, and
+a queued record is rolled back along with its save.  A Celery task writes
+the queued records, in order, in batches.
+
+Reading an object's history (obj.versions.all(), most_recent(), as_of(),
+..) first writes the object's queued records, so editors, and everyone
+else, always see the edits in its history.  Listings of a user's edits
+should call flush_user() first.  Other listings across objects, like
+recent changes, catch up when the queue is flushed.  Code that only needs
+the who, when and why of the latest save, e.g. notifications sent as the
+object's saved, can read it with most_recent_pending() instead, without
+writing anything.
+
+Inside a transaction, e.g. a request's, queued records are written in a
+savepoint, so reading history never commits the rest of the transaction.
+
+Related historical records (e.g. a map's page) are looked up when the
+record is written, not when the object was saved.  Deletes, and models
+whose history has many-to-many fields, always write their historical
+records right away.
+"""
+import datetime
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core import serializers
+from django.core.cache import cache
+from django.db import router, transaction
+from django.db.models import F
+
+from celery import shared_task
+
+from utils import get_versions, unique_lookup_values_for
+from bulk import _insert
+
+# Saves within this many seconds of each other are written in one batch.
+FLUSH_DELAY = 5
+
+FLUSH_SCHEDULED_KEY = 'versioning:write_behind_flush'
+
+_local = threading.local()
+
+
+def is_write_behind(model):
+    """
+    Returns:
+        True if saving instances of `model` queues their historical
+        records.
+    """
+    label = '%s.%s' % (model._meta.app_label, model._meta.object_name)
+    if label not in getattr(settings, 'VERSIONUTILS_WRITE_BEHIND', ()):
+        return False
+    return not get_versions(model).model._meta.many_to_many
+
+
+def enqueue(instance, history_type):
+    """
+    Queues the historical record of the just-saved `instance`.
+    """
+    from models import PendingHistoricalRecord
+
+    save_with = getattr(instance, '_save_with', {})
+    reverted_to = save_with.get('reverted_to_version')
+    pending = PendingHistoricalRecord(
+        content_type=ContentType.objects.get_for_model(
+            instance, for_concrete_model=False),
+        object_id=instance.pk,
+        data=serializers.serialize('json', [instance]),
+        history_type=history_type,
+        history_date=datetime.datetime.now(),
+        history_user=save_with.get('user'),
+        history_user_ip=save_with.get('user_ip'),
+        history_comment=save_with.get('comment'),
+        history_reverted_to_version=reverted_to and reverted_to.pk,
+    )
+    # AutoTrackUserInfoMiddleware fills in the user and IP address.
+    pending.save()
+
+    if hasattr(instance, 'last_edit_date'):
+        # Shown right away, along with the edit.  The historical record
+        # will get this version number.
+        instance.__class__._base_manager.filter(pk=instance.pk).update(
+            last_edit_date=pending.history_date,
+            last_editor=pending.history_user_id,
+            version_count=F('version_count') + 1)
+        instance.last_edit_date = pending.history_date
+        instance.last_editor_id = pending.history_user_id
+        instance.version_count = (instance.version_count or 0) + 1
+
+    if cache.add(FLUSH_SCHEDULED_KEY, True, FLUSH_DELAY):
+        _async_flush.apply_async(countdown=FLUSH_DELAY)
+
+
+def _write(pending):
+    model = pending.content_type.model_class()
+    tracker = model._changes_tracker
+    hist_model = get_versions(model).model
+
+    obj = serializers.deserialize('json', pending.data).next().object
+    obj._save_with = {'comment': pending.history_comment,
+                      'user_ip': pending.history_user_ip}
+    hist = hist_model(
+        history_type=pending.history_type,
+        history_date=pending.history_date,
+        history_user_id=pending.history_user_id,
+        history_reverted_to_version_id=pending.history_reverted_to_version,
+        **tracker.historical_record_attrs(obj))
+    # Without signals: the user info is the saver's, not the current
+    # request's.
+    _insert(hist_model, [hist], router.db_for_write(hist_model))
+    tracker.store_deltas(hist)
+
+
+@contextmanager
+def _batch_transaction():
+    """
+    Writes a batch in its own transaction or, inside another transaction,
+    in a savepoint, so we don't commit the rest of it.
+    """
+    if not transaction.is_managed():
+        with transaction.commit_on_success():
+            yield
+        return
+    sid = transaction.savepoint()
+    try:
+        yield
+    except:
+        transaction.savepoint_rollback(sid)
+        raise
+    transaction.savepoint_commit(sid)
+
+
+def flush(content_type=None, object_id=None, batch_size=500):
+    """
+    Writes queued historical records, in the order they were queued.
+
+    Args:
+        content_type, object_id: Only write the records of this object.
+
+    Returns:
+        The number of records written.
+    """
+    from models import PendingHistoricalRecord
+
+    if getattr(_local, 'flushing', False):
+        # Writing a record looks up the object's history.
+        return 0
+    _local.flushing = True
+    written = 0
+    try:
+        while True:
+            with _batch_transaction():
+                # Locked, so concurrent flushes don't write them twice.
+                pending = PendingHistoricalRecord.objects.select_for_update()
+                if content_type is not None:
+                    pending = pending.filter(content_type=content_type,
+                                             object_id=object_id)
+                batch = list(pending.order_by('id')[:batch_size])
+                for p in batch:
+                    _write(p)
+                PendingHistoricalRecord.objects.filter(
+                    id__in=[p.id for p in batch]).delete()
+            written += len(batch)
+            if len(batch) < batch_size:
+                return written
+    finally:
+        _local.flushing = False
+
+
+def flush_instance(instance):
+    """
+    Writes the queued historical records of `instance`, so that reading
+    its history sees all of its saves.
+    """
+    from models import PendingHistoricalRecord
+
+    model = instance.__class__
+    if getattr(_local, 'flushing', False) or not is_write_behind(model):
+        return
+    pk = instance.pk
+    if pk is None:
+        # E.g. Page(slug=.., region=..).versions
+        unique = unique_lookup_values_for(instance)
+        if not unique:
+            return
+        pks = model._default_manager.filter(**unique).values_list(
+            'pk', flat=True)[:1]
+        if not pks:
+            return
+        pk = pks[0]
+    content_type = ContentType.objects.get_for_model(
+        model, for_concrete_model=False)
+    if PendingHistoricalRecord.objects.filter(
+            content_type=content_type, object_id=pk).exists():
+        flush(content_type, pk)
+
+
+def flush_instances(model, pks):
+    """
+    Like flush_instance(), for the instances of `model` with the primary
+    keys `pks`, looking for their queued records in one query.
+    """
+    from models import PendingHistoricalRecord
+
+    if getattr(_local, 'flushing', False) or not is_write_behind(model):
+        return
+    content_type = ContentType.objects.get_for_model(
+        model, for_concrete_model=False)
+    pending = PendingHistoricalRecord.objects.filter(
+        content_type=content_type, object_id__in=list(pks)).values_list(
+        'object_id', flat=True).distinct()
+    for object_id in pending:
+        flush(content_type, object_id)
+
+
+def flush_user(user):
+    """
+    Writes the queued historical records of the objects `user` has saved,
+    so that listing the user's edits sees all of them.
+    """
+    from models import PendingHistoricalRecord
+
+    if getattr(_local, 'flushing', False) or user is None:
+        return
+    # Object by object, so each object's records are written in order.
+    objects = PendingHistoricalRecord.objects.filter(
+        history_user=user).values_list('content_type', 'object_id').distinct()
+    for content_type_id, object_id in objects:
+        flush(ContentType.objects.get_for_id(content_type_id), object_id)
+
+
+def most_recent_pending(instance):
+    """
+    Returns:
+        An unsaved historical record with the date, type, user, IP
+        address and comment of the most recent queued save of `instance`,
+        or None if it has none queued.  Unlike most_recent(), this doesn't
+        write the queued records.
+    """
+    from models import PendingHistoricalRecord
+
+    model = instance.__class__
+    if instance.pk is None or not is_write_behind(model):
+        return None
+    content_type = ContentType.objects.get_for_model(
+        model, for_concrete_model=False)
+    pending = PendingHistoricalRecord.objects.filter(
+        content_type=content_type, object_id=instance.pk).order_by('-id')[:1]
+    if not pending:
+        return None
+    pending = pending[0]
+    return get_versions(model).model(
+        history_type=pending.history_type,
+        history_date=pending.history_date,
+        history_user_id=pending.history_user_id,
+        history_user_ip=pending.history_user_ip,
+        history_comment=pending.history_comment,
+    )
+
+
+@shared_task(ignore_result=True)
+def _async_flush():
+    cache.delete(FLUSH_SCHEDULED_KEY)
+    flush()